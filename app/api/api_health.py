@@ -0,0 +1,25 @@
+# app/api/api_health.py
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+router = APIRouter()
+
+from ..dependencies import model_pool
+
+@router.get("/health/live")
+async def live():
+    """Liveness: the process is up and the event loop responds."""
+    return {"status": "alive"}
+
+@router.get("/health/ready")
+async def ready():
+    """Readiness: at least one warmed-up model instance takes requests."""
+    body = {
+        "status": "ready" if model_pool.ready else "not_ready",
+        "pool_state": model_pool.state,
+        "instances_ready": len(model_pool.model_instances),
+        "instances_expected": model_pool.num_instances,
+    }
+    if not model_pool.ready:
+        return JSONResponse(status_code=503, content=body, headers={"Retry-After": "5"})
+    return body
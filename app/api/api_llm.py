@@ -1,9 +1,9 @@
 # app/routes/generate.py
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 from fastapi.responses import StreamingResponse
-from typing import Union
+from typing import AsyncIterator, Optional, Union
 import logging
-from ..schemas.frontend import FrontendPayload
+from ..schemas.frontend import FrontendPayload, RephrasePayload
 from ..schemas.llm_request import LLMRequest
 from ..models.model_pool import ParallelModelPool
 
@@ -12,10 +12,27 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 # Assume model_pool is initialized elsewhere and imported
-from ..dependencies import model_pool
+from ..dependencies import model_pool, tenant_policy
+
+async def start_stream(stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Runs a stream up to its first chunk, so failures before it (no free slot in
+    time, a failed prefill) are raised before the response headers are sent.
+    """
+    first = await stream.__anext__()
+
+    async def chunks():
+        try:
+            yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+    return chunks()
 
 @router.post("/generate")
-async def generate(request: FrontendPayload):
+async def generate(request: FrontendPayload, x_api_key: Optional[str] = Header(None)):
+    ticket = None
     try:
         # Parse `history_messages` if it's a string
         if isinstance(request.history_messages, str):
@@ -28,9 +45,38 @@ async def generate(request: FrontendPayload):
             query=request.query,
             history_messages=history_messages,
             temperature=request.temperature,
-            top_p=request.top_p
+            top_p=request.top_p,
+            session_id=request.session_id
         )
         context = {}
+        tenant, priority = tenant_policy.resolve(x_api_key, request.priority)
+
+        # Reject early, before the stream starts, if no slot can be had in time
+        ticket = model_pool.admit(deadline=request.deadline)
+
+        # Resolve the subqueries of a multi-part question into the context of the answer
+        if request.plan if request.plan is not None else model_pool.query_planning:
+            plan_query, plan_history = llm_request.query, llm_request.history_messages
+            # A standalone rewrite carries what the plan needs from the history
+            if request.rephrase if request.rephrase is not None else model_pool.query_rephrasing:
+                plan_query = await model_pool.query_rephraser.rephrase(
+                    llm_request.query,
+                    llm_request.history_messages,
+                    timeout=request.deadline,
+                    tenant=tenant,
+                    priority=priority,
+                    ticket=ticket.nested()
+                )
+                plan_history = None
+            # The stages wait for slots under the request's ticket, so they take no extra queue places
+            context = await model_pool.query_planner.run(
+                plan_query,
+                plan_history,
+                timeout=request.deadline,
+                tenant=tenant,
+                priority=priority,
+                ticket=ticket.nested()
+            )
 
         # Pass the parsed request to the model
         response_stream = model_pool.generate_text_stream(
@@ -39,11 +85,58 @@ async def generate(request: FrontendPayload):
             history_messages=llm_request.history_messages,
             max_new_tokens=llm_request.max_new_tokens,
             temperature=llm_request.temperature,
-            top_p=llm_request.top_p
+            top_p=llm_request.top_p,
+            timeout=request.deadline,
+            session_id=llm_request.session_id,
+            tenant=tenant,
+            priority=priority,
+            speculative=request.speculative,
+            ticket=ticket
         )
 
-        # Wrap response stream in StreamingResponse
-        return StreamingResponse(response_stream, media_type="text/event-stream")
+        # Wrap response stream in StreamingResponse once it holds a slot
+        return StreamingResponse(await start_stream(response_stream), media_type="text/event-stream")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # The slot wait consumes the ticket; this only frees it if the request failed earlier
+        if ticket is not None:
+            ticket.release()
+
+@router.post("/rephrase")
+async def rephrase(request: RephrasePayload, x_api_key: Optional[str] = Header(None)):
+    """Rewrites a follow-up query into a standalone one; queries without history come back unchanged."""
+    ticket = None
+    try:
+        tenant, priority = tenant_policy.resolve(x_api_key, request.priority)
+        if isinstance(request.history_messages, str):
+            history_messages = [{"role": "user", "content": request.history_messages}]
+        else:
+            history_messages = request.history_messages
+        if not history_messages:
+            return {"query": request.query}
+
+        # Same gate as /generate: rejects before queueing if the pool is not ready,
+        # the queue is full or no slot can be had in time
+        ticket = model_pool.admit(deadline=request.deadline)
+        query = await model_pool.query_rephraser.rephrase(
+            request.query,
+            history_messages,
+            timeout=request.deadline,
+            tenant=tenant,
+            priority=priority,
+            ticket=ticket
+        )
+        return {"query": query}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Rephrase error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # Unused if the rephrase came from the cache or joined one in flight
+        if ticket is not None:
+            ticket.release()
@@ -5,9 +5,52 @@ from ..models.model_pool import ParallelModelPool
 router = APIRouter()
 
 # Assume model_pool is initialized elsewhere and imported
-from ..dependencies import model_pool
+from ..dependencies import autoscaler, model_pool, memory_maintainer
+from ..utils.memory_maintenance import current_rss_bytes
 
 @router.get("/model-pool-status")
 async def get_model_pool_status():
-    status = [{'device': instance['device'], 'in_use': instance['in_use']} for instance in model_pool.model_instances]
-    return {"model_instances": status}
+    status = [
+        {
+            'device': instance['device'],
+            'in_use': instance['in_use'],
+            'shares_weights': instance['shares_weights'],
+            'load_seconds': instance['load_seconds'],
+            'rss_bytes': instance['rss_bytes'],
+            'scheduler': instance['scheduler'].get_stats(),
+            'kv_cache': instance['kv_cache'].get_stats(),
+            'prefix_cache': instance['prefix_cache'].get_stats() if instance['prefix_cache'] else None
+        }
+        for instance in model_pool.model_instances
+    ]
+    kv_stats = [instance['kv_cache'] for instance in status]
+    kv_summary = {
+        key: sum(stats[key] for stats in kv_stats)
+        for key in ('used_blocks', 'peak_used_blocks', 'allocated_blocks', 'max_blocks', 'tokens_stored', 'used_bytes', 'allocated_bytes')
+    }
+    kv_summary['occupancy'] = kv_summary['used_blocks'] / kv_summary['max_blocks'] if kv_summary['max_blocks'] else 0.0
+    return {
+        "model_instances": status,
+        "startup_seconds": model_pool.startup_seconds,
+        "first_ready_seconds": model_pool.first_ready_seconds,
+        "rss_bytes": current_rss_bytes(),
+        "kv_cache": kv_summary,
+        "pool_state": model_pool.state,
+        "quantization": model_pool.quantization,
+        "prompt_tokenizer": model_pool.prompt_tokenizer.get_stats() if model_pool.prompt_tokenizer else None,
+        "prompt_templates": model_pool.prompt_templates.get_stats() if model_pool.prompt_templates else None,
+        "context_cache": model_pool.context_cache.get_stats(),
+        "query_planner": model_pool.query_planner.get_stats() if model_pool.query_planner else None,
+        "query_rephraser": model_pool.query_rephraser.get_stats() if model_pool.query_rephraser else None,
+        "tools": model_pool.tool_runtime.get_stats() if model_pool.tool_runtime else None,
+        "tool_cache": (
+            model_pool.tool_runtime.cache.get_stats()
+            if model_pool.tool_runtime and model_pool.tool_runtime.cache else None
+        ),
+        "json_constraints": model_pool.get_json_constraint_stats(),
+        "sessions": model_pool.sessions.get_stats(),
+        "admission": model_pool.get_admission_stats(),
+        "slot_scheduler": model_pool.slots.get_stats(),
+        "memory_maintenance": memory_maintainer.get_stats(),
+        "autoscaler": autoscaler.get_stats()
+    }
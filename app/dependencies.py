@@ -3,10 +3,170 @@ import os
 import torch
 from dotenv import load_dotenv
 from .models.model_pool import ParallelModelPool
+from .models.tenants import TenantPolicy
+from .tools.local_tools import register_local_tools
+from .tools.result_cache import ToolResultCache
+from .tools.runtime import ToolRuntime
+from .utils.autoscaler import PoolAutoscaler
+from .utils.memory_maintenance import MemoryMaintainer
+from .utils.system_prompt import function_definitions_list
 
 load_dotenv()  # Load environment variables from .env
 
 MODEL_PATH = os.getenv("MODEL_PATH", "meta-llama/Llama-3.2-1B-Instruct")
+MODEL_DTYPE = getattr(torch, os.getenv("MODEL_DTYPE", "float16"))
+# "int8-dynamic" or "int8-weight", see app/models/quantization.py
+QUANTIZATION = os.getenv("QUANTIZATION") or None
 NUM_INSTANCES = int(os.getenv("NUM_INSTANCES", torch.cuda.device_count() or 1))
+# Comma-separated devices, e.g. "cuda:0,cuda:1". Defaults to all CUDA devices, or the CPU
+DEVICES = [device.strip() for device in os.getenv("DEVICES", "").split(",") if device.strip()] or None
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))
+KV_BLOCK_SIZE = int(os.getenv("KV_BLOCK_SIZE", 16))
+KV_CACHE_MAX_BLOCKS = int(os.getenv("KV_CACHE_MAX_BLOCKS", 2048))
+PREFIX_CACHE_MAX_BLOCKS = int(os.getenv("PREFIX_CACHE_MAX_BLOCKS", 512))
+STREAM_FLUSH_TOKENS = int(os.getenv("STREAM_FLUSH_TOKENS", 4))
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", 0.05))
+PROMPT_CACHE_ENTRIES = int(os.getenv("PROMPT_CACHE_ENTRIES", 4096))
+SESSION_TTL = float(os.getenv("SESSION_TTL", 1800))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 64))
+# Share of each instance's KV cache blocks that sessions may keep pinned between turns
+SESSION_PINNED_FRACTION = float(os.getenv("SESSION_PINNED_FRACTION", 0.25))
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", 4096)) or None
+CONTEXT_RANKING = os.getenv("CONTEXT_RANKING", "1").lower() not in ("0", "false", "no")
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", 0.9)) or None
+CONTEXT_CACHE_MB = float(os.getenv("CONTEXT_CACHE_MB", 64))
+# Decompose queries into concurrently resolved subqueries unless the request says otherwise
+QUERY_PLANNING = os.getenv("QUERY_PLANNING", "0").lower() in ("1", "true", "yes")
+PLAN_MAX_TOKENS = int(os.getenv("PLAN_MAX_TOKENS", 512))
+SUBQUERY_MAX_TOKENS = int(os.getenv("SUBQUERY_MAX_TOKENS", 256))
+# Rewrite follow-up queries into standalone ones before planning unless the request says otherwise
+QUERY_REPHRASING = os.getenv("QUERY_REPHRASING", "0").lower() in ("1", "true", "yes")
+REPHRASE_MAX_TOKENS = int(os.getenv("REPHRASE_MAX_TOKENS", 64))
+REPHRASE_CACHE_ENTRIES = int(os.getenv("REPHRASE_CACHE_ENTRIES", 1024))
+# Mask the logits of query plans and function calls against their JSON schema
+CONSTRAINED_DECODING = os.getenv("CONSTRAINED_DECODING", "1").lower() not in ("0", "false", "no")
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", 10.0))
+# Comma-separated tool:seconds pairs, e.g. "google_search:5,query_sales_data:20"
+TOOL_TIMEOUTS = {
+    tool.strip(): float(seconds)
+    for tool, seconds in (pair.split(":") for pair in os.getenv("TOOL_TIMEOUTS", "").split(",") if pair.strip())
+}
+TOOL_WORKERS = int(os.getenv("TOOL_WORKERS", 8))
+TOOL_CACHE_MB = float(os.getenv("TOOL_CACHE_MB", 16))
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", 300))
+# Comma-separated tool:seconds pairs; 0 disables caching of a tool, e.g. "get_current_date:60,google_search:0"
+TOOL_CACHE_TTLS = {
+    tool.strip(): float(seconds)
+    for tool, seconds in (pair.split(":") for pair in os.getenv("TOOL_CACHE_TTLS", "").split(",") if pair.strip())
+}
+# Serve the declared functions with the synthetic stand-ins of app/tools/local_tools.py
+LOCAL_TOOLS = os.getenv("LOCAL_TOOLS", "0").lower() in ("1", "true", "yes")
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", 64))
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 30)) or None
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", 5))
+SPECULATIVE_MAX_NGRAM = int(os.getenv("SPECULATIVE_MAX_NGRAM", 3))
+MODEL_LOAD_WORKERS = int(os.getenv("MODEL_LOAD_WORKERS", 0)) or None
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR") or None
+WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", 8))
+# "thread" (one process) or "process" (one worker process per instance, pinned to its share of the cores)
+EXECUTION_BACKEND = os.getenv("EXECUTION_BACKEND", "thread")
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 0)) or None
+SCHEDULING_POLICY = os.getenv("SCHEDULING_POLICY", "fifo")
+# Comma-separated tenant:weight pairs, e.g. "team-a:2,team-b:1"
+TENANT_WEIGHTS = {
+    tenant.strip(): float(weight)
+    for tenant, weight in (pair.split(":") for pair in os.getenv("TENANT_WEIGHTS", "").split(",") if pair.strip())
+}
+# Comma-separated api_key:tenant pairs; other keys are accounted to a hash of the key
+API_KEY_TENANTS = {
+    key.strip(): tenant.strip()
+    for key, tenant in (pair.rsplit(":", 1) for pair in os.getenv("API_KEY_TENANTS", "").split(",") if pair.strip())
+}
+# Comma-separated tenant:class pairs giving the most urgent priority class a tenant may use
+TENANT_MAX_PRIORITY = {
+    tenant.strip(): priority.strip()
+    for tenant, priority in (pair.split(":") for pair in os.getenv("TENANT_MAX_PRIORITY", "").split(",") if pair.strip())
+}
+DEFAULT_MAX_PRIORITY = os.getenv("DEFAULT_MAX_PRIORITY", "default")
+AUTOSCALE_MIN_INSTANCES = int(os.getenv("AUTOSCALE_MIN_INSTANCES", NUM_INSTANCES))
+AUTOSCALE_MAX_INSTANCES = int(os.getenv("AUTOSCALE_MAX_INSTANCES", NUM_INSTANCES))
+AUTOSCALE_CHECK_INTERVAL = float(os.getenv("AUTOSCALE_CHECK_INTERVAL", 5.0))
+AUTOSCALE_COOLDOWN = float(os.getenv("AUTOSCALE_COOLDOWN", 60.0))
+AUTOSCALE_QUEUE_DEPTH = int(os.getenv("AUTOSCALE_QUEUE_DEPTH", 4))
+AUTOSCALE_MIN_FREE_MEMORY_MB = float(os.getenv("AUTOSCALE_MIN_FREE_MEMORY_MB", 1024))
+GC_CHECK_INTERVAL = float(os.getenv("GC_CHECK_INTERVAL", 5.0))
+GC_IDLE_SECONDS = float(os.getenv("GC_IDLE_SECONDS", 30.0))
+GC_RSS_LIMIT_MB = float(os.getenv("GC_RSS_LIMIT_MB", 0)) or None
 
-model_pool = ParallelModelPool(MODEL_PATH, num_instances=1, devices = ["cuda:0"])
+tenant_policy = TenantPolicy(API_KEY_TENANTS, TENANT_MAX_PRIORITY, DEFAULT_MAX_PRIORITY)
+
+tool_runtime = ToolRuntime(
+    function_definitions_list,
+    default_timeout=TOOL_TIMEOUT,
+    timeouts=TOOL_TIMEOUTS,
+    max_workers=TOOL_WORKERS,
+    cache=ToolResultCache(
+        max_bytes=int(TOOL_CACHE_MB * 2**20), default_ttl=TOOL_CACHE_TTL, ttls=TOOL_CACHE_TTLS
+    ) if TOOL_CACHE_MB > 0 else None
+)
+if LOCAL_TOOLS:
+    register_local_tools(tool_runtime)
+
+model_pool = ParallelModelPool(
+    MODEL_PATH,
+    num_instances=NUM_INSTANCES,
+    dtype=MODEL_DTYPE,
+    devices=DEVICES,
+    max_batch_size=MAX_BATCH_SIZE,
+    kv_block_size=KV_BLOCK_SIZE,
+    kv_cache_max_blocks=KV_CACHE_MAX_BLOCKS,
+    prefix_cache_max_blocks=PREFIX_CACHE_MAX_BLOCKS,
+    stream_flush_tokens=STREAM_FLUSH_TOKENS,
+    stream_flush_interval=STREAM_FLUSH_INTERVAL,
+    prompt_cache_entries=PROMPT_CACHE_ENTRIES,
+    session_ttl=SESSION_TTL,
+    max_sessions=SESSION_MAX_ENTRIES,
+    session_pinned_fraction=SESSION_PINNED_FRACTION,
+    max_queue_depth=MAX_QUEUE_DEPTH,
+    request_deadline=REQUEST_DEADLINE,
+    scheduling_policy=SCHEDULING_POLICY,
+    # Every configured tenant gets its own share; other API keys share "default"
+    tenant_weights={**{tenant: 1.0 for tenant in API_KEY_TENANTS.values()}, **TENANT_WEIGHTS},
+    num_draft_tokens=SPECULATIVE_DRAFT_TOKENS,
+    draft_max_ngram=SPECULATIVE_MAX_NGRAM,
+    load_workers=MODEL_LOAD_WORKERS,
+    snapshot_dir=SNAPSHOT_DIR,
+    warmup_tokens=WARMUP_TOKENS,
+    execution_backend=EXECUTION_BACKEND,
+    worker_threads=WORKER_THREADS,
+    quantization=QUANTIZATION,
+    context_max_tokens=CONTEXT_MAX_TOKENS,
+    context_ranking=CONTEXT_RANKING,
+    context_dedup_threshold=CONTEXT_DEDUP_THRESHOLD,
+    context_cache_bytes=int(CONTEXT_CACHE_MB * 2**20),
+    query_planning=QUERY_PLANNING,
+    plan_max_tokens=PLAN_MAX_TOKENS,
+    subquery_max_tokens=SUBQUERY_MAX_TOKENS,
+    tool_runtime=tool_runtime,
+    constrained_decoding=CONSTRAINED_DECODING,
+    query_rephrasing=QUERY_REPHRASING,
+    rephrase_max_tokens=REPHRASE_MAX_TOKENS,
+    rephrase_cache_entries=REPHRASE_CACHE_ENTRIES
+)
+
+memory_maintainer = MemoryMaintainer(
+    model_pool,
+    check_interval=GC_CHECK_INTERVAL,
+    idle_seconds=GC_IDLE_SECONDS,
+    rss_limit_mb=GC_RSS_LIMIT_MB
+)
+
+autoscaler = PoolAutoscaler(
+    model_pool,
+    min_instances=AUTOSCALE_MIN_INSTANCES,
+    max_instances=AUTOSCALE_MAX_INSTANCES,
+    check_interval=AUTOSCALE_CHECK_INTERVAL,
+    cooldown=AUTOSCALE_COOLDOWN,
+    scale_up_queue_depth=AUTOSCALE_QUEUE_DEPTH,
+    min_free_memory_mb=AUTOSCALE_MIN_FREE_MEMORY_MB
+)
@@ -1,75 +1,258 @@
+# app/handlers/context_handler.py
+import logging
 from collections.abc import Iterable
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.handlers.context_ranker import ContextRanker
+
+logger = logging.getLogger(__name__)
+
+# Context types in the order they are kept when the token budget runs out
+DEFAULT_TYPE_PRIORITY = {
+    'Action': 0,
+    'RAG': 1,
+    'Reasoning': 2,
+}
+
+
+def approximate_token_count(text: str) -> int:
+    """Rough token count (about four characters per token) for when no tokenizer is at hand."""
+    return (len(text) + 3) // 4
+
+
+class PreparedContext:
+    """
+    Context text built by `ContextPreparer.prepare`, with its size and what the budget cut.
+    """
+    def __init__(
+        self,
+        text: str,
+        token_count: int,
+        num_sources: int,
+        dropped_sources: int,
+        truncated_sources: int,
+        duplicate_sources: int = 0,
+        query_dependent: bool = False
+    ):
+        self.text = text
+        self.token_count = token_count
+        self.num_sources = num_sources
+        self.dropped_sources = dropped_sources
+        self.truncated_sources = truncated_sources
+        self.duplicate_sources = duplicate_sources
+        # Whether the query decided which sources were kept
+        self.query_dependent = query_dependent
+
+    def get_stats(self) -> dict:
+        return {
+            "tokens": self.token_count,
+            "sources": self.num_sources,
+            "dropped_sources": self.dropped_sources,
+            "truncated_sources": self.truncated_sources,
+            "duplicate_sources": self.duplicate_sources,
+        }
+
 
 class ContextPreparer:
-    def __init__(self):
+    """
+    Formats the context payload of a request into the text placed in the prompt.
+
+    Every source becomes one entry. Entries are collected once and joined in a
+    single pass. With a token budget, entries are kept by priority: first by
+    context type (`type_priority`), then by relevance to the query if a
+    `ContextRanker` is set, then by their position in the payload. Entries that
+    do not fit in what is left of the budget are skipped and smaller ones further
+    down are still taken; the best skipped entry is then truncated into the room
+    that remains, if it is large enough. The ranker also drops near-duplicates of
+    higher-ranked entries. Kept entries stay in payload order.
+    """
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        type_priority: Optional[Dict[str, int]] = None,
+        min_truncated_tokens: int = 32,
+        ranker: Optional[ContextRanker] = None
+    ):
+        """
+        Args:
+            max_tokens (Optional[int]): Token budget of the context. None means unlimited.
+            count_tokens (Optional[Callable[[str], int]]): Counts the tokens of a text, e.g. with
+                                                           the model's tokenizer. Defaults to
+                                                           `approximate_token_count`.
+            type_priority (Optional[Dict[str, int]]): Rank of each context type; lower is kept first.
+            min_truncated_tokens (int): Smallest remaining budget worth filling with a truncated entry.
+            ranker (Optional[ContextRanker]): Scores entries against the query and finds duplicates.
+        """
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or approximate_token_count
+        self.type_priority = type_priority or DEFAULT_TYPE_PRIORITY
+        self.min_truncated_tokens = min_truncated_tokens
+        self.ranker = ranker
         self.handlers = {
-            'RAG': self.prepare_rag_context,
-            'Action': self.prepare_function_call_context,
-            'Reasoning': self.prepare_reasoning_context
+            'RAG': self.rag_entries,
+            'Action': self.function_call_entries,
+            'Reasoning': self.reasoning_entries
             # Add other types here if needed
         }
 
-    def prepare_context(self, context):
-        context_str = ""
+    def prepare_context(self, context, query: Optional[str] = None) -> str:
+        """
+        Returns the context text. See `prepare` for its size.
+        """
+        return self.prepare(context, query).text
+
+    def prepare(self, context, query: Optional[str] = None) -> PreparedContext:
+        """
+        Builds the context text within the token budget.
+
+        Args:
+            context: Mapping of subquery to `{"Type": ..., "Source": [...]}` details.
+            query (Optional[str]): Question the context should answer, used for ranking.
+
+        Returns:
+            PreparedContext: The text, its token count and how many sources were cut.
+        """
+        # (rank, position, text) per entry
+        entries = []
+        contents = []
         if isinstance(context, dict):  # Check if context is a dictionary
-            for subquery, details in context.items():
+            for details in context.values():
                 if not isinstance(details, dict) or 'Type' not in details:
                     continue  # Skip if details are not a dictionary or 'Type' is missing
                 handler = self.handlers.get(details['Type'])
+                rank = self.type_priority.get(details['Type'], len(self.type_priority))
                 if handler:
-                    context_str += handler(details)
+                    source_entries = handler(details)
                 else:
-                    context_str += f"\n- Unknown Type: {details.get('Type', 'None')}\n"
-        return context_str
+                    unknown = f"\n- Unknown Type: {details.get('Type', 'None')}\n"
+                    source_entries = [(unknown, unknown)]
+                for text, content in source_entries:
+                    entries.append((rank, len(entries), text))
+                    contents.append(content)
+
+        texts = [text for _, _, text in entries]
+        scores = self.ranker.score(query, texts) if self.ranker is not None and query and texts else [0.0] * len(texts)
+        # Best first: context type, then relevance, then payload order
+        entries.sort(key=lambda entry: (entry[0], -scores[entry[1]], entry[1]))
+        duplicates = set()
+        if self.ranker is not None:
+            duplicates = {entries[i][1] for i in self.ranker.duplicates([contents[position] for _, position, _ in entries])}
+            entries = [entry for entry in entries if entry[1] not in duplicates]
+
+        counts = {position: self.count_tokens(text) for _, position, text in entries}
+        total = sum(counts.values())
+        if self.max_tokens is None or total <= self.max_tokens:
+            # Which of a set of duplicates survives depends on the ranking by the query
+            return PreparedContext(
+                "".join(texts[position] for position in sorted(counts)),
+                total, len(texts), len(duplicates), 0, len(duplicates),
+                query_dependent=bool(duplicates) and bool(query) and self.ranker is not None
+            )
+
+        kept: Dict[int, str] = {}
+        remaining = self.max_tokens
+        truncated = 0
+        # Best-ranked entry that did not fit, truncated into the room left at the end
+        candidate = None
+        for rank, position, text in entries:
+            if counts[position] <= remaining:
+                kept[position] = text
+                remaining -= counts[position]
+            elif candidate is None:
+                candidate = (position, text)
+        if candidate is not None and remaining >= self.min_truncated_tokens:
+            position, text = candidate
+            kept[position] = self._truncate(text, counts[position], remaining)
+            truncated += 1
+
+        kept_texts = [kept[position] for position in sorted(kept)]
+        token_count = sum(self.count_tokens(text) for text in kept_texts)
+        dropped = len(texts) - len(kept)
+        logger.info(
+            f"Context of {total} tokens cut to {token_count} (budget {self.max_tokens}): "
+            f"{dropped} sources dropped ({len(duplicates)} duplicates), {truncated} truncated"
+        )
+        return PreparedContext(
+            "".join(kept_texts), token_count, len(texts), dropped, truncated, len(duplicates),
+            query_dependent=self.ranker is not None and bool(query)
+        )
 
-    def prepare_rag_context(self, details):
-        context_str = ""
+    def _truncate(self, text: str, token_count: int, max_tokens: int) -> str:
+        """
+        Cuts the tail of an entry, where its text or output field is, to fit `max_tokens`.
+        """
+        marker = " [truncated]\n"
+        budget = max_tokens - self.count_tokens(marker)
+        cut = len(text) * budget // token_count
+        while cut > 0 and self.count_tokens(text[:cut]) > budget:
+            cut = cut * 9 // 10
+        return text[:cut].rstrip() + marker
+
+    # Entry handlers return (entry, content) pairs: the text placed in the prompt and
+    # the source content it carries, which duplicate detection compares
+
+    def rag_entries(self, details) -> List[Tuple[str, str]]:
         sources = details.get('Source', [])
         if not isinstance(sources, list):  # Ensure 'Source' is a list
             sources = []
 
+        entries = []
         for source in sources:
             name = source.get('name', 'Unnamed Source')
             text = source.get('text', 'None')
             url = source.get('url', '#')
             page = source.get('page', '#')
-            # context_str += f"\n- Document: [{name}]({url})\n  Text: {text}\n"
-            context_str += f"\n- name: {name}\n  page: {page}\n  url: {url}\n  text: {text}\n"
-        return context_str
+            entries.append((f"\n- name: {name}\n  page: {page}\n  url: {url}\n  text: {text}\n", str(text)))
+        return entries
 
-    def prepare_function_call_context(self, details):
-        context_str = ""
+    def function_call_entries(self, details) -> List[Tuple[str, str]]:
         sources = details.get('Source', [])
         if not isinstance(sources, list):  # Ensure 'Source' is treated as a list
             sources = []
 
+        entries = []
         for source in sources:
             function_calls = source.get('FunctionName', [])
             if not isinstance(function_calls, list):  # Ensure function calls are a list
                 function_calls = []
 
             output = source.get('Output', 'No Output')
+            # Outputs reused from an earlier identical call carry the time of that call
+            cached = f"  Cached: result of a call at {source['Cached']}\n" if source.get('Cached') else ""
 
             for function_call in function_calls:
                 function_name = function_call.get('name', 'Unknown Function')
                 arguments = function_call.get('arguments', {})
                 if not isinstance(arguments, dict):  # Ensure arguments are a dictionary
                     arguments = {}
-                context_str += f"\n- Function: [{function_name}]\n"
-                context_str += f"  Arguments: {arguments}\n"
-                context_str += f"  Output: {output}\n"
-
-        return context_str
+                entries.append((
+                    f"\n- Function: [{function_name}]\n"
+                    f"  Arguments: {arguments}\n"
+                    f"  Output: {output}\n"
+                    f"{cached}",
+                    f"{function_name} {arguments} {output}"
+                ))
+        return entries
 
-    def prepare_reasoning_context(self, details):
-        context_str = ""
+    def reasoning_entries(self, details) -> List[Tuple[str, str]]:
         sources = details.get('Source', [])
         if not isinstance(sources, list):  # Ensure 'Source' is a list
             sources = []
 
+        entries = []
         for source in sources:
             name = source.get('name', 'Unnamed Source')
             text = source.get('text', 'None')
             url = source.get('url', '#')
-            context_str += f"\n- Non-document: [{name}]({url})\n  Text: {text}\n"
-        return context_str
+            entries.append((f"\n- Non-document: [{name}]({url})\n  Text: {text}\n", str(text)))
+        return entries
+
+    def prepare_rag_context(self, details) -> str:
+        return "".join(entry for entry, _ in self.rag_entries(details))
+
+    def prepare_function_call_context(self, details) -> str:
+        return "".join(entry for entry, _ in self.function_call_entries(details))
+
+    def prepare_reasoning_context(self, details) -> str:
+        return "".join(entry for entry, _ in self.reasoning_entries(details))
@@ -0,0 +1,111 @@
+# app/handlers/context_ranker.py
+import math
+import re
+from collections import Counter
+from typing import List, Optional, Sequence, Set
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens used for scoring and duplicate detection."""
+    return _WORD.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a small in-memory set of documents, e.g. the sources of one request.
+    """
+    def __init__(self, documents: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            documents (Sequence[str]): Texts to index.
+            k1 (float): Term frequency saturation.
+            b (float): Strength of the document length normalization.
+        """
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(tokenize(document)) for document in documents]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        document_frequency = Counter(term for counts in self.term_counts for term in counts)
+        num_documents = len(self.term_counts)
+        self.idf = {
+            term: math.log(1 + (num_documents - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def score(self, query: str) -> List[float]:
+        """
+        Scores every document against a query.
+
+        Returns:
+            List[float]: One score per document, in index order. 0 means no shared terms.
+        """
+        terms = set(tokenize(query)) & self.idf.keys()
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_length) if self.avg_length else self.k1
+            scores.append(sum(
+                self.idf[term] * counts[term] * (self.k1 + 1) / (counts[term] + norm)
+                for term in terms if term in counts
+            ))
+        return scores
+
+
+def shingles(text: str, size: int = 3) -> Set[tuple]:
+    """Word n-grams of a text; texts shorter than `size` words give one shingle."""
+    words = tokenize(text)
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class ContextRanker:
+    """
+    Scores context sources against the query and finds near-duplicate sources.
+
+    Relevance is BM25 over the sources of the request itself, so no index has to be
+    built ahead of time. Duplicates are detected by the Jaccard similarity of word
+    trigram sets, which catches the same chunk retrieved from two collections or
+    with different whitespace or metadata.
+    """
+    def __init__(self, dedup_threshold: Optional[float] = 0.9, shingle_size: int = 3, k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            dedup_threshold (Optional[float]): Jaccard similarity above which a source counts as a
+                                               duplicate of a higher-ranked one. None disables it.
+            shingle_size (int): Words per shingle for duplicate detection.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 length normalization.
+        """
+        self.dedup_threshold = dedup_threshold
+        self.shingle_size = shingle_size
+        self.k1 = k1
+        self.b = b
+
+    def score(self, query: str, texts: Sequence[str]) -> List[float]:
+        """BM25 score of every text against the query."""
+        return BM25Index(texts, k1=self.k1, b=self.b).score(query)
+
+    def duplicates(self, texts: Sequence[str]) -> Set[int]:
+        """
+        Finds near-duplicates among texts given best first.
+
+        Returns:
+            Set[int]: Indexes of texts that duplicate an earlier one.
+        """
+        if self.dedup_threshold is None:
+            return set()
+        kept: List[Set[tuple]] = []
+        duplicates = set()
+        for i, text in enumerate(texts):
+            text_shingles = shingles(text, self.shingle_size)
+            if any(
+                len(text_shingles & other) / len(text_shingles | other) >= self.dedup_threshold
+                for other in kept
+            ):
+                duplicates.add(i)
+            else:
+                kept.append(text_shingles)
+        return duplicates
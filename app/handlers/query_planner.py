@@ -0,0 +1,287 @@
+# app/handlers/query_planner.py
+import asyncio
+import json
+import logging
+import re
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# `{Subquery-1.answer}` placeholders in dependent questions
+_ANSWER_REFERENCE = re.compile(r"\{(Subquery-\d+)\.answer\}")
+
+# Resolves one subquery given its question with the dependencies' answers filled in, and the
+# keyword arguments of the planner's completions. Returns the answer passed to dependents and
+# the context details (`{"Type": ..., "Source": [...]}`) placed in the prompt, or None for no context
+Resolver = Callable[..., Awaitable[Tuple[str, Optional[dict]]]]
+
+# Output of the query decomposition prompt: `Subquery-N` names mapped to their subquery
+SUBQUERY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Question": {"type": "string"},
+        "Keywords": {"type": "array", "items": {"type": "string"}},
+        "Category": {"type": "string", "enum": ["Information Seeking", "Function Calling"]},
+        "ExpectedAnswerFormat": {"type": "string"},
+        "DependsOn": {"type": "array", "items": {"type": "string"}},
+        "DependencyUsage": {"type": "string"},
+    },
+    "required": ["Question", "Category", "DependsOn"],
+    "additionalProperties": False,
+}
+PLAN_SCHEMA = {"type": "object", "additionalProperties": SUBQUERY_SCHEMA, "minProperties": 1}
+
+
+class Subquery:
+    """
+    One step of a decomposed query.
+    """
+    def __init__(self, name: str, question: str, category: str = "Information Seeking",
+                 keywords: Optional[List[str]] = None, depends_on: Optional[List[str]] = None):
+        self.name = name
+        self.question = question
+        self.category = category
+        self.keywords = keywords or []
+        self.depends_on = depends_on or []
+
+    def resolve_question(self, answers: Dict[str, str]) -> str:
+        """The question with `{Subquery-N.answer}` replaced by the answers known so far."""
+        return _ANSWER_REFERENCE.sub(lambda match: answers.get(match.group(1), match.group(0)), self.question)
+
+
+def extract_json(text: str):
+    """Parses the outermost JSON object or list in a model output, ignoring prose and code fences."""
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError("No JSON in the model output")
+    start = min(starts)
+    end = text.rfind("}" if text[start] == "{" else "]")
+    return json.loads(text[start:end + 1])
+
+
+def parse_plan(text: str, max_subqueries: int = 8) -> Dict[str, Subquery]:
+    """
+    Parses the output of the query decomposition prompt into a DAG of subqueries.
+
+    Dependencies on unknown subqueries are dropped, and answer placeholders count as
+    dependencies even if `DependsOn` misses them.
+
+    Args:
+        text (str): Model output, a JSON object of `Subquery-N` entries (a list is accepted too).
+        max_subqueries (int): Subqueries kept; later ones are dropped.
+
+    Returns:
+        Dict[str, Subquery]: Subqueries by name, in plan order.
+
+    Raises:
+        ValueError: If the output is not a plan or its dependencies form a cycle.
+    """
+    data = extract_json(text)
+    if isinstance(data, list):
+        data = {f"Subquery-{i + 1}": entry for i, entry in enumerate(data)}
+    if not isinstance(data, dict):
+        raise ValueError("The plan is not a JSON object")
+
+    plan: Dict[str, Subquery] = {}
+    for name, entry in list(data.items())[:max_subqueries]:
+        if not isinstance(entry, dict) or not str(entry.get("Question", "")).strip():
+            continue
+        depends_on = entry.get("DependsOn") or []
+        plan[name] = Subquery(
+            name,
+            str(entry["Question"]).strip(),
+            category=str(entry.get("Category", "Information Seeking")),
+            keywords=[str(keyword) for keyword in entry.get("Keywords") or []],
+            depends_on=[str(dependency) for dependency in depends_on] if isinstance(depends_on, list) else []
+        )
+    if not plan:
+        raise ValueError("The plan has no subqueries")
+
+    for subquery in plan.values():
+        dependencies = dict.fromkeys([*subquery.depends_on, *_ANSWER_REFERENCE.findall(subquery.question)])
+        subquery.depends_on = [name for name in dependencies if name in plan and name != subquery.name]
+
+    # Depth-first search for cycles, which would leave subqueries waiting on each other
+    visiting, done = set(), set()
+
+    def visit(name: str):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle through {name}")
+        visiting.add(name)
+        for dependency in plan[name].depends_on:
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+
+    for name in plan:
+        visit(name)
+    return plan
+
+
+def format_history(history_messages: Optional[List[Dict]]) -> str:
+    """Conversation history as `role: content` lines for the planning prompt."""
+    lines = [f"{message.get('role', 'user')}: {message.get('content', '')}" for message in history_messages or []]
+    return "\n".join(lines) or "None"
+
+
+class QueryPlanner:
+    """
+    Decomposes a query into subqueries and resolves them into a context payload.
+
+    The decomposition prompt turns the query into `Subquery-N` entries with
+    `DependsOn` edges. Each subquery runs as its own task as soon as the subqueries
+    it depends on are resolved, so independent ones run concurrently (they share the
+    decode batch) and the whole plan takes its critical path. Subqueries are resolved
+    by the resolver of their category; the results fill the context dict that
+    `ContextPreparer` formats, keyed by subquery name.
+    """
+    def __init__(
+        self,
+        complete: Callable[..., Awaitable[str]],
+        templates,
+        resolvers: Optional[Dict[str, Resolver]] = None,
+        max_plan_tokens: int = 512,
+        max_answer_tokens: int = 256,
+        max_subqueries: int = 8
+    ):
+        """
+        Args:
+            complete (Callable[..., Awaitable[str]]): Returns the model's answer to chat messages,
+                                                      e.g. `ParallelModelPool.complete`. Takes a
+                                                      `json_schema` its answer should follow.
+            templates (PromptTemplateRegistry): Holds the "query_decomposition" template.
+            resolvers (Optional[Dict[str, Resolver]]): Resolver per subquery category. Categories
+                                                       without one default to answering the question
+                                                       with the model.
+            max_plan_tokens (int): Token limit of the decomposition output.
+            max_answer_tokens (int): Token limit of a subquery answer.
+            max_subqueries (int): Subqueries kept from a plan.
+        """
+        self.complete = complete
+        self.templates = templates
+        self.resolvers: Dict[str, Resolver] = dict(resolvers or {})
+        self.max_plan_tokens = max_plan_tokens
+        self.max_answer_tokens = max_answer_tokens
+        self.max_subqueries = max_subqueries
+        self.stats = {
+            "plans": 0,
+            "plan_failures": 0,
+            "subqueries": 0,
+            "subquery_failures": 0,
+            "plan_seconds": 0.0,
+            "resolve_seconds": 0.0,
+        }
+
+    def register_resolver(self, category: str, resolver: Resolver):
+        """Resolves subqueries of `category` with `resolver`, e.g. a tool runtime for "Function Calling"."""
+        self.resolvers[category] = resolver
+
+    async def plan(self, query: str, history_messages: Optional[List[Dict]] = None, **completion_kwargs) -> Dict[str, Subquery]:
+        """
+        Runs the decomposition prompt. A plan that cannot be parsed falls back to the query itself.
+
+        Args:
+            query (str): The user's question.
+            history_messages (Optional[List[Dict]]): Previous messages in the conversation.
+            **completion_kwargs: Passed to `complete`, e.g. timeout, tenant and priority.
+
+        Returns:
+            Dict[str, Subquery]: Subqueries by name.
+        """
+        prompt = self.templates.render("query_decomposition", history=format_history(history_messages), user_query=query)
+        output = await self.complete(
+            [prompt.message("user")], max_new_tokens=self.max_plan_tokens, temperature=0.0,
+            json_schema=PLAN_SCHEMA, **completion_kwargs
+        )
+        try:
+            return parse_plan(output, self.max_subqueries)
+        except ValueError as e:
+            logger.warning(f"Could not parse the query plan ({e}), answering the query as-is: {output!r}")
+            self.stats["plan_failures"] += 1
+            return {"Subquery-1": Subquery("Subquery-1", query)}
+
+    async def answer(self, subquery: Subquery, question: str, **completion_kwargs) -> Tuple[str, Optional[dict]]:
+        """
+        Default resolver: answers the question with the model and adds the answer as Reasoning context.
+        """
+        answer = (await self.complete(
+            [{"role": "user", "content": question}],
+            max_new_tokens=self.max_answer_tokens, temperature=0.0, **completion_kwargs
+        )).strip()
+        return answer, {"Type": "Reasoning", "Source": [{"name": question, "text": answer, "url": "#"}]}
+
+    async def run(self, query: str, history_messages: Optional[List[Dict]] = None, **completion_kwargs) -> Dict[str, dict]:
+        """
+        Plans the query and resolves its subqueries.
+
+        A plan of a single information-seeking subquery adds nothing the final answer
+        would not, so it is not resolved. A subquery whose dependency failed is skipped.
+
+        Args:
+            query (str): The user's question.
+            history_messages (Optional[List[Dict]]): Previous messages in the conversation.
+            **completion_kwargs: Passed to `complete`, e.g. timeout, tenant and priority.
+
+        Returns:
+            Dict[str, dict]: Context payload for `ContextPreparer`, keyed by subquery name.
+        """
+        start = time.perf_counter()
+        plan = await self.plan(query, history_messages, **completion_kwargs)
+        planned = time.perf_counter()
+        self.stats["plans"] += 1
+        self.stats["plan_seconds"] += planned - start
+        logger.info(f"Query plan: {[(s.name, s.question, s.category, s.depends_on) for s in plan.values()]}")
+
+        if len(plan) == 1 and next(iter(plan.values())).category not in self.resolvers:
+            return {}
+
+        answers: Dict[str, str] = {}
+        context: Dict[str, dict] = {}
+        tasks: Dict[str, asyncio.Task] = {}
+
+        async def resolve(subquery: Subquery) -> bool:
+            # Every dependency has its own task, started before this one awaits it
+            if not all(await asyncio.gather(*(tasks[name] for name in subquery.depends_on))):
+                logger.warning(f"Skipping {subquery.name}: a dependency failed")
+                return False
+            question = subquery.resolve_question(answers)
+            resolver = self.resolvers.get(subquery.category)
+            try:
+                if resolver is not None:
+                    answer, details = await resolver(subquery, question, **completion_kwargs)
+                else:
+                    answer, details = await self.answer(subquery, question, **completion_kwargs)
+            except Exception as e:
+                logger.warning(f"Subquery {subquery.name} failed: {e}")
+                self.stats["subquery_failures"] += 1
+                return False
+            answers[subquery.name] = answer
+            if details is not None:
+                context[subquery.name] = details
+            return True
+
+        tasks.update({name: asyncio.ensure_future(resolve(subquery)) for name, subquery in plan.items()})
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+        self.stats["subqueries"] += len(plan)
+        self.stats["resolve_seconds"] += time.perf_counter() - planned
+        # Plan order, not completion order, so equal plans give equal (cacheable) contexts
+        return {name: context[name] for name in plan if name in context}
+
+    def get_stats(self) -> dict:
+        plans = self.stats["plans"]
+        return {
+            "plans": plans,
+            "plan_failures": self.stats["plan_failures"],
+            "subqueries": self.stats["subqueries"],
+            "subquery_failures": self.stats["subquery_failures"],
+            "avg_plan_seconds": self.stats["plan_seconds"] / plans if plans else 0.0,
+            "avg_resolve_seconds": self.stats["resolve_seconds"] / plans if plans else 0.0,
+        }
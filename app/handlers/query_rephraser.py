@@ -0,0 +1,156 @@
+# app/handlers/query_rephraser.py
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.handlers.query_planner import format_history
+
+logger = logging.getLogger(__name__)
+
+# Labels the model sometimes puts before the query despite the prompt
+_LABEL = re.compile(r"^\s*(?:rephrased query|rephrased|response|query)\s*:\s*", re.IGNORECASE)
+
+
+def rephrase_key(query: str, history_messages: List[Dict]) -> str:
+    """
+    Key of a rephrase: a hash of the history window and the whitespace-normalized query.
+    """
+    canonical = json.dumps(
+        [[[message.get("role", "user"), message.get("content", "")] for message in history_messages], " ".join(query.split())],
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def clean_rephrase(output: str, query: str) -> str:
+    """
+    The rephrased query from the model output: its first line without labels or quotes.
+    Falls back to the query if the output is empty, a refusal or implausibly long.
+    """
+    line = next((line.strip() for line in output.strip().splitlines() if line.strip()), "")
+    line = _LABEL.sub("", line).strip().strip('"“”\'').strip()
+    if not line or line.lower().startswith("i cannot rephrase") or len(line) > 4 * len(query) + 200:
+        return query
+    return line
+
+
+class QueryRephraser:
+    """
+    Rewrites a follow-up query into a standalone one using the conversation history.
+
+    A query without history is already standalone and returned as-is, without
+    generating. Rephrases are cached by history and query (greedy decoding makes them
+    deterministic), identical requests in flight share one generation, and the output
+    is capped at a few dozen tokens since the answer is a single line. The prompt puts
+    its fixed rules before the history, so their KV blocks come from the prefix cache.
+    """
+    def __init__(
+        self,
+        complete: Callable[..., Awaitable[str]],
+        templates,
+        max_new_tokens: int = 64,
+        max_history_messages: int = 6,
+        max_entries: int = 1024
+    ):
+        """
+        Args:
+            complete (Callable[..., Awaitable[str]]): Returns the model's answer to chat messages,
+                                                      e.g. `ParallelModelPool.complete`.
+            templates (PromptTemplateRegistry): Holds the "query_rephrase" template.
+            max_new_tokens (int): Token limit of the rephrased query.
+            max_history_messages (int): Most recent history messages shown to the model.
+            max_entries (int): Rephrases kept in the LRU cache. 0 disables it.
+        """
+        self.complete = complete
+        self.templates = templates
+        self.max_new_tokens = max_new_tokens
+        self.max_history_messages = max_history_messages
+        self.max_entries = max_entries
+        self.cache: "OrderedDict[str, str]" = OrderedDict()
+        # Running generations by key, awaited by identical requests that arrive meanwhile
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        self.stats = {
+            "requests": 0,
+            "skipped": 0,
+            "hits": 0,
+            "coalesced": 0,
+            "generated": 0,
+            "failures": 0,
+            "generate_seconds": 0.0,
+        }
+
+    async def rephrase(self, query: str, history_messages: Optional[List[Dict]] = None, **completion_kwargs) -> str:
+        """
+        Rephrases a query in the context of the conversation. A failed rephrase returns the query.
+
+        Args:
+            query (str): The user's question.
+            history_messages (Optional[List[Dict]]): Previous messages in the conversation.
+            **completion_kwargs: Passed to `complete`, e.g. timeout, tenant and priority.
+
+        Returns:
+            str: The standalone query.
+        """
+        self.stats["requests"] += 1
+        history = [
+            message for message in (history_messages or [])[-self.max_history_messages:]
+            if str(message.get("content", "")).strip()
+        ] if self.max_history_messages > 0 else []
+        if not history:
+            self.stats["skipped"] += 1
+            return query
+
+        key = rephrase_key(query, history)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
+            self.stats["hits"] += 1
+            return cached
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(key, query, history, **completion_kwargs))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        try:
+            # Shielded, so a caller that gives up does not cancel the generation others wait for
+            return await asyncio.shield(task)
+        except Exception as e:
+            logger.warning(f"Could not rephrase the query, using it as-is: {e}")
+            return query
+
+    async def _generate(self, key: str, query: str, history: List[Dict], **completion_kwargs) -> str:
+        start = time.perf_counter()
+        prompt = self.templates.render("query_rephrase", history=format_history(history), user_query=query)
+        try:
+            output = await self.complete(
+                [prompt.message("user")], max_new_tokens=self.max_new_tokens, temperature=0.0, **completion_kwargs
+            )
+        except Exception:
+            self.stats["failures"] += 1
+            raise
+        rephrased = clean_rephrase(output, query)
+        self.stats["generated"] += 1
+        self.stats["generate_seconds"] += time.perf_counter() - start
+        if self.max_entries > 0:
+            self.cache[key] = rephrased
+            if len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return rephrased
+
+    def get_stats(self) -> dict:
+        generated = self.stats["generated"]
+        lookups = self.stats["hits"] + self.stats["coalesced"] + generated + self.stats["failures"]
+        return {
+            **{name: value for name, value in self.stats.items() if name != "generate_seconds"},
+            "entries": len(self.cache),
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "avg_generate_seconds": self.stats["generate_seconds"] / generated if generated else 0.0,
+        }
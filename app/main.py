@@ -5,7 +5,7 @@ import asyncio
 from fastapi.middleware.cors import CORSMiddleware
 from .utils.lifespan import lifespan
 from .utils.logging_config import setup_logging
-from .api import api_llm, api_status 
+from .api import api_health, api_llm, api_status 
 
 # Setup logging
 logger = setup_logging()
@@ -25,6 +25,7 @@ app.add_middleware(
 # Include API routers
 app.include_router(api_llm.router)
 app.include_router(api_status.router)
+app.include_router(api_health.router)
 
 # Root endpoint (optional)
 @app.get("/")
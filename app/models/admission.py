@@ -0,0 +1,183 @@
+# app/models/admission.py
+import logging
+import math
+from typing import Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionTicket:
+    """
+    A request's place in the queue, held from admission until the request gets a
+    batch slot or gives up. Releasing it more than once is a no-op.
+
+    Internal stages of a request (rephrasing, planning, function calls) wait for
+    slots with a `nested` ticket, which holds no place of its own: the request's
+    ticket already counts it once until its answer gets a slot.
+    """
+    def __init__(self, controller: "AdmissionController", counted: bool = True):
+        self.controller = controller
+        self.counted = counted
+        self.released = False
+
+    def nested(self) -> "AdmissionTicket":
+        """Ticket for an internal stage of the same request."""
+        return AdmissionTicket(self.controller, counted=False)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            if self.counted:
+                self.controller.waiting -= 1
+
+
+class AdmissionController:
+    """
+    Decides at arrival whether a request can be served before its deadline.
+
+    The estimated wait comes from the number of requests queued ahead, the number
+    of batch slots and an exponentially weighted average of the per-request service
+    time (generated tokens / streaming tokens per second). Requests beyond the queue
+    depth are rejected with 429, and requests whose estimated wait exceeds their
+    deadline with 503. Both carry a Retry-After header, so clients back off instead
+    of holding a connection the server cannot serve in time.
+
+    An admitted request counts as queued from the moment it is admitted, through an
+    `AdmissionTicket`, so a burst of arrivals cannot all pass the queue bound before
+    any of them starts waiting for a slot.
+    """
+    def __init__(
+        self,
+        num_slots: int,
+        max_queue_depth: int = 64,
+        default_deadline: Optional[float] = 30.0,
+        smoothing: float = 0.2,
+        initial_service_time: float = 5.0
+    ):
+        """
+        Args:
+            num_slots (int): Batch slots across all instances.
+            max_queue_depth (int): Maximum number of requests waiting for a slot.
+            default_deadline (Optional[float]): Seconds a request may wait for a slot when it
+                                                sets no deadline. None waits indefinitely.
+            smoothing (float): Weight of the latest completion in the moving averages.
+            initial_service_time (float): Service time assumed before any request completed.
+        """
+        self.num_slots = num_slots
+        self.max_queue_depth = max_queue_depth
+        self.default_deadline = default_deadline
+        self.smoothing = smoothing
+        self.avg_tokens: Optional[float] = None
+        self.avg_tokens_per_second: Optional[float] = None
+        self.initial_service_time = initial_service_time
+        self.waiting = 0
+        self.stats = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_deadline": 0,
+            "timed_out": 0,
+        }
+
+    @property
+    def service_time(self) -> float:
+        """Estimated seconds a request holds a batch slot."""
+        if not self.avg_tokens or not self.avg_tokens_per_second:
+            return self.initial_service_time
+        return self.avg_tokens / self.avg_tokens_per_second
+
+    def estimated_wait(self, free_slots: int) -> float:
+        """
+        Estimated seconds until a newly arriving request gets a batch slot.
+        """
+        if free_slots > self.waiting:
+            return 0.0
+        # Slots free up in waves of `num_slots`; the request is served in the wave after those queued ahead
+        waves = math.floor((self.waiting - free_slots) / max(self.num_slots, 1)) + 1
+        return waves * self.service_time
+
+    def resolve_deadline(self, deadline: Optional[float]) -> Optional[float]:
+        return deadline if deadline is not None else self.default_deadline
+
+    def _reject_queue_full(self, retry_after: str):
+        self.stats["rejected_queue_full"] += 1
+        logger.warning(f"Rejecting request: {self.waiting} requests queued")
+        raise HTTPException(
+            429, "Too many queued requests. Please try again later.", headers={"Retry-After": retry_after}
+        )
+
+    def _ticket(self) -> AdmissionTicket:
+        self.waiting += 1
+        return AdmissionTicket(self)
+
+    def reserve(self) -> AdmissionTicket:
+        """
+        Queue position for a completion that did not go through `admit` and is not a
+        stage of an admitted request. The queue bound applies, the deadline check does not.
+
+        Raises:
+            HTTPException: 429 if the queue is full.
+        """
+        if self.waiting >= self.max_queue_depth:
+            self._reject_queue_full(str(max(1, math.ceil(self.service_time))))
+        return self._ticket()
+
+    def admit(self, free_slots: int, deadline: Optional[float] = None) -> AdmissionTicket:
+        """
+        Admits a request or raises an HTTPException with a Retry-After header.
+
+        Args:
+            free_slots (int): Batch slots currently free.
+            deadline (Optional[float]): Seconds the request may wait for a slot.
+
+        Returns:
+            AdmissionTicket: The request's queue position, to be passed to the slot wait.
+
+        Raises:
+            HTTPException: 429 if the queue is full, 503 if the deadline cannot be met.
+        """
+        deadline = self.resolve_deadline(deadline)
+        wait = self.estimated_wait(free_slots)
+        retry_after = str(max(1, math.ceil(wait)))
+
+        if self.waiting >= self.max_queue_depth:
+            self._reject_queue_full(retry_after)
+        if deadline is not None and wait > deadline:
+            self.stats["rejected_deadline"] += 1
+            logger.warning(f"Rejecting request: estimated wait {wait:.1f}s exceeds deadline {deadline:.1f}s")
+            raise HTTPException(
+                503, "Estimated wait exceeds the request deadline. Please try again later.",
+                headers={"Retry-After": retry_after}
+            )
+        self.stats["admitted"] += 1
+        return self._ticket()
+
+    def record_timeout(self):
+        self.stats["timed_out"] += 1
+
+    def record_completion(self, tokens: int, latency: float):
+        """
+        Updates the service time estimate with a finished request.
+        """
+        if tokens <= 0 or latency <= 0:
+            return
+        tokens_per_second = tokens / latency
+        if self.avg_tokens is None:
+            self.avg_tokens = float(tokens)
+            self.avg_tokens_per_second = tokens_per_second
+        else:
+            self.avg_tokens += self.smoothing * (tokens - self.avg_tokens)
+            self.avg_tokens_per_second += self.smoothing * (tokens_per_second - self.avg_tokens_per_second)
+
+    def get_stats(self, free_slots: int) -> dict:
+        return {
+            **self.stats,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_queue_depth,
+            "free_slots": free_slots,
+            "num_slots": self.num_slots,
+            "service_time": self.service_time,
+            "tokens_per_second": self.avg_tokens_per_second or 0.0,
+            "estimated_wait": self.estimated_wait(free_slots),
+        }
@@ -0,0 +1,83 @@
+# app/models/async_streamer.py
+import asyncio
+import time as time_module
+from typing import List, Optional
+
+from transformers import TextStreamer
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    Streamer that hands decoded text to an asyncio consumer without blocking threads.
+
+    The producer (the batch scheduler thread) calls `put`/`end` as with any Hugging
+    Face streamer. Finalized text is buffered and pushed into an `asyncio.Queue`
+    through `loop.call_soon_threadsafe`, at most once every `flush_tokens` tokens or
+    `flush_interval` seconds, whichever comes first. The consumer iterates with
+    `async for`, so no executor thread is parked per request.
+    """
+    def __init__(
+        self,
+        tokenizer,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        skip_prompt: bool = False,
+        flush_tokens: int = 4,
+        flush_interval: float = 0.05,
+        **decode_kwargs
+    ):
+        """
+        Initializes the streamer.
+
+        Args:
+            tokenizer: Tokenizer used to decode tokens.
+            loop (Optional[asyncio.AbstractEventLoop]): Loop of the consumer. Defaults to the running loop.
+            skip_prompt (bool): Whether the first `put` call carries the prompt and should be skipped.
+            flush_tokens (int): Number of tokens after which buffered text is flushed.
+            flush_interval (float): Seconds after which buffered text is flushed.
+            **decode_kwargs: Passed to `tokenizer.decode`.
+        """
+        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.flush_tokens = flush_tokens
+        self.flush_interval = flush_interval
+
+        self._buffer: List[str] = []
+        self._buffered_tokens = 0
+        self._last_flush = time_module.perf_counter()
+        self.flushes = 0
+
+    def put(self, value):
+        super().put(value)
+        self._buffered_tokens += 1
+        if self._buffer and (
+            self._buffered_tokens >= self.flush_tokens
+            or time_module.perf_counter() - self._last_flush >= self.flush_interval
+        ):
+            self._flush()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self._buffer.append(text)
+        if stream_end:
+            self._flush()
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered_tokens = 0
+        self._last_flush = time_module.perf_counter()
+        self.flushes += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        text = await self.queue.get()
+        if text is None:
+            raise StopAsyncIteration
+        return text
@@ -0,0 +1,595 @@
+# app/models/batch_scheduler.py
+import itertools
+import logging
+import threading
+import time as time_module
+from collections import deque
+from typing import Callable, Deque, Iterable, List, Optional
+
+import torch
+from transformers import DynamicCache
+
+from app.models.kv_cache import PagedKVCache
+from app.models.speculative import propose_prompt_lookup
+
+logger = logging.getLogger(__name__)
+
+
+def sample_next_token(logits: torch.Tensor, temperature: float, top_p: float) -> int:
+    """
+    Picks the next token for a single sequence.
+
+    Args:
+        logits (torch.Tensor): Logits over the vocabulary for the last position, shape [vocab].
+        temperature (float): Sampling temperature. Values <= 0 select greedily.
+        top_p (float): Top-p (nucleus) sampling threshold.
+
+    Returns:
+        int: The selected token id.
+    """
+    if temperature <= 0:
+        return int(torch.argmax(logits).item())
+
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if 0 < top_p < 1.0:
+        sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        # Keep the smallest set of tokens whose cumulative probability exceeds top_p
+        sorted_probs[(cumulative - sorted_probs) > top_p] = 0.0
+        choice = torch.multinomial(sorted_probs, num_samples=1)
+        return int(sorted_ids[choice].item())
+    return int(torch.multinomial(probs, num_samples=1).item())
+
+
+class Sequence:
+    """
+    State of a single request inside the continuous batching loop.
+    """
+    _ids = itertools.count()
+
+    def __init__(
+        self,
+        prompt_ids: List[int],
+        streamer,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        pin_blocks: bool = False,
+        num_draft_tokens: int = 0,
+        constraint=None,
+    ):
+        self.seq_id = next(self._ids)
+        self.prompt_ids = list(prompt_ids)
+        self.output_ids: List[int] = []
+        self.streamer = streamer
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        # Keep the KV blocks referenced after a normal finish (see `pinned_blocks`)
+        self.pin_blocks = pin_blocks
+        self.pinned_blocks: List[int] = []
+        self.cached_tokens = 0
+        # Speculative decoding with prompt-lookup drafts; 0 disables it
+        self.num_draft_tokens = num_draft_tokens
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.verify_steps = 0
+        # Masks the logits before sampling and ends the sequence once complete, e.g. a `JSONConstraint`
+        self.constraint = constraint
+
+        self.cancelled = False
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+        self.preemptions = 0
+        self.submitted_at = time_module.perf_counter()
+        self.first_token_at: Optional[float] = None
+
+    @property
+    def context_ids(self) -> List[int]:
+        """Tokens whose keys and values must be cached before the next decode step."""
+        return self.prompt_ids + self.output_ids[:-1]
+
+    @property
+    def last_token(self) -> int:
+        return self.output_ids[-1]
+
+
+class ContinuousBatchScheduler:
+    """
+    Step-level (continuous batching) scheduler for a single model instance.
+
+    A background thread owns the model. On every iteration it prefills newly
+    submitted sequences, runs one batched decode step over all running
+    sequences and retires the ones that finished, so a long generation no
+    longer blocks short requests that arrive after it. Keys and values are
+    kept in a `PagedKVCache`; when it runs out of blocks the most recently
+    admitted sequence is preempted and later resumed by recomputing its cache.
+
+    Sequences submitted with `num_draft_tokens` decode speculatively: tokens
+    proposed by prompt lookup are verified in one forward pass of the sequence,
+    which emits every accepted draft token plus one sampled token per pass.
+
+    Sequences submitted with a `constraint` sample only the tokens it allows and
+    finish as soon as it is complete, e.g. when a JSON value closes.
+    """
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 8,
+        eos_token_ids: Optional[Iterable[int]] = None,
+        kv_cache: Optional[PagedKVCache] = None,
+        name: str = "batch-scheduler",
+        draft_max_ngram: int = 3,
+    ):
+        """
+        Initializes the scheduler and starts its decode loop.
+
+        Args:
+            model: A causal LM supporting `past_key_values`, `attention_mask` and `position_ids`.
+            max_batch_size (int): Maximum number of sequences decoded in one forward pass.
+            eos_token_ids (Optional[Iterable[int]]): Token ids that terminate a sequence.
+            kv_cache (Optional[PagedKVCache]): Block cache to use. Built from the model config if None.
+            name (str): Name of the background thread.
+            draft_max_ngram (int): Longest trailing n-gram looked up for speculative drafts.
+        """
+        self.model = model
+        self.device = model.device
+        self.max_batch_size = max_batch_size
+        self.eos_token_ids = set(eos_token_ids or [])
+        self.kv_cache = kv_cache or PagedKVCache.for_model(model)
+        self.draft_max_ngram = draft_max_ngram
+
+        self.pending: Deque[Sequence] = deque()
+        self.running: List[Sequence] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        # Pinned block lists handed back by other threads, applied by the loop
+        self._released_blocks: List[List[int]] = []
+        # Asks the owner of pinned blocks to hand back at least the given number, via
+        # `release_blocks`, and returns how many it released. Set by e.g. the session store
+        self.reclaim_blocks: Optional[Callable[[int], int]] = None
+
+        self.stats = {
+            "steps": 0,
+            "tokens_generated": 0,
+            "sequences_finished": 0,
+            "batch_size_sum": 0,
+            "preemptions": 0,
+            "verify_steps": 0,
+            "draft_tokens": 0,
+            "accepted_tokens": 0,
+            "constrained_tokens": 0,
+            "mask_seconds": 0.0,
+        }
+
+        self.kv_cache.publish_stats()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt_ids: List[int],
+        streamer,
+        max_new_tokens: int = 1024,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        pin_blocks: bool = False,
+        num_draft_tokens: int = 0,
+        constraint=None,
+    ) -> Sequence:
+        """
+        Queues a sequence for generation. It joins the running batch on the next step.
+
+        Args:
+            prompt_ids (List[int]): Tokenized prompt.
+            streamer: Object with `put(token_ids)` and `end()` receiving generated tokens.
+            max_new_tokens (int): Maximum number of tokens to generate.
+            temperature (float): Sampling temperature.
+            top_p (float): Top-p sampling threshold.
+            pin_blocks (bool): If the sequence ends with an EOS token, register its full KV
+                               blocks in the prefix cache and keep them referenced in
+                               `Sequence.pinned_blocks` until `release_blocks` is called.
+            num_draft_tokens (int): Prompt-lookup tokens verified per speculative step. 0 disables it.
+            constraint: Object with `apply(logits)`, `advance(token_id)` and `complete` restricting
+                        the sampled tokens, e.g. a `JSONConstraint`. None samples freely.
+
+        Returns:
+            Sequence: Handle that can be cancelled and inspected once `done` is set.
+        """
+        seq = Sequence(prompt_ids, streamer, max_new_tokens, temperature, top_p, pin_blocks, num_draft_tokens, constraint)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler has been stopped")
+            self.pending.append(seq)
+            self._cond.notify()
+        return seq
+
+    def cancel(self, seq: Sequence):
+        """
+        Marks a sequence as cancelled. It is removed from the batch on the next step.
+        """
+        with self._cond:
+            seq.cancelled = True
+            self._cond.notify()
+
+    def release_blocks(self, blocks: List[int]):
+        """
+        Hands back blocks pinned by a finished sequence. Safe to call from any thread.
+        """
+        with self._cond:
+            self._released_blocks.append(blocks)
+            self._cond.notify()
+
+    def stop(self):
+        """
+        Stops the decode loop, ending all pending and running sequences.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    @property
+    def num_active(self) -> int:
+        return len(self.pending) + len(self.running)
+
+    def get_stats(self) -> dict:
+        steps = self.stats["steps"]
+        return {
+            **self.stats,
+            "running": len(self.running),
+            "pending": len(self.pending),
+            "avg_batch_size": self.stats["batch_size_sum"] / steps if steps else 0.0,
+            "draft_acceptance_rate": (
+                self.stats["accepted_tokens"] / self.stats["draft_tokens"] if self.stats["draft_tokens"] else 0.0
+            ),
+        }
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self.pending and not self.running and not self._released_blocks:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                self._apply_released_blocks()
+                admitted = self._admit()
+
+            try:
+                with torch.inference_mode():
+                    for index, seq in enumerate(admitted):
+                        if seq.cancelled:
+                            self._retire(seq)
+                            continue
+                        if not self._prefill(seq):
+                            self._requeue(admitted[index:])
+                            admitted = admitted[:index]
+                            break
+                        if self._is_finished(seq):
+                            self._retire(seq)
+                        else:
+                            self.running.append(seq)
+
+                    self.running = [seq for seq in self.running if not self._retire_if_cancelled(seq)]
+                    self._reserve_decode_slots()
+                    if self.running:
+                        batch = [seq for seq in self.running if not self._speculative_step(seq)]
+                        if batch:
+                            self._decode_step(batch)
+                        still_running = []
+                        for seq in self.running:
+                            if self._is_finished(seq):
+                                self._retire(seq)
+                            else:
+                                still_running.append(seq)
+                        self.running = still_running
+            except Exception as e:
+                logger.error(f"Batch step failed: {e}")
+                for seq in admitted + self.running:
+                    if not seq.done.is_set() and seq not in self.pending:
+                        seq.error = e
+                        self._retire(seq)
+                self.running = []
+            # Status requests read the snapshot instead of the page tables this thread changes
+            self.kv_cache.publish_stats()
+
+        with self._cond:
+            leftovers = list(self.pending) + self.running
+            self.pending.clear()
+            self.running = []
+        for seq in leftovers:
+            seq.cancelled = True
+            self._retire(seq)
+
+    def _apply_released_blocks(self):
+        with self._cond:
+            for blocks in self._released_blocks:
+                self.kv_cache.release_blocks(blocks)
+            self._released_blocks = []
+
+    def _reclaim(self, num_blocks: int) -> bool:
+        """
+        Frees pinned blocks before a sequence is failed or preempted for lack of them.
+
+        Returns:
+            bool: Whether any blocks were released.
+        """
+        if self.reclaim_blocks is None:
+            return False
+        try:
+            released = self.reclaim_blocks(max(num_blocks, 1))
+        except Exception as e:
+            logger.warning(f"Could not reclaim pinned KV blocks: {e}")
+            return False
+        self._apply_released_blocks()
+        return released > 0
+
+    def _admit(self) -> List[Sequence]:
+        """
+        Pops pending sequences that fit in the batch and in the KV cache, in FIFO order.
+        Must be called with the condition held.
+        """
+        admitted = []
+        reserved_blocks = 0
+        while self.pending and len(self.running) + len(admitted) < self.max_batch_size:
+            seq = self.pending[0]
+            # Room for the prompt plus the first decode step
+            needed = self.kv_cache.blocks_needed(len(seq.context_ids) + 1)
+            if not self.kv_cache.can_allocate(reserved_blocks + needed):
+                if not self.running and not admitted:
+                    if self._reclaim(reserved_blocks + needed - self.kv_cache.num_available_blocks()):
+                        continue
+                    # Can never fit, even with the whole cache to itself
+                    self.pending.popleft()
+                    seq.error = MemoryError("Sequence does not fit in the KV cache")
+                    self._retire(seq)
+                    continue
+                break
+            reserved_blocks += needed
+            admitted.append(self.pending.popleft())
+        return admitted
+
+    def _requeue(self, seqs: List[Sequence]):
+        """
+        Puts sequences that could not be prefilled back at the head of the queue.
+        """
+        if not self.running and not self._reclaim(self.kv_cache.blocks_needed(len(seqs[0].context_ids) + 1)):
+            # Nothing will free blocks for them, fail the first one to make progress
+            seqs[0].error = MemoryError("Sequence does not fit in the KV cache")
+            self._retire(seqs[0])
+            seqs = seqs[1:]
+        with self._cond:
+            self.pending.extendleft(reversed(seqs))
+
+    def _reserve_decode_slots(self):
+        """
+        Makes sure every running sequence has room for one more token, preempting
+        the most recently admitted sequences if the cache is full.
+        """
+        i = 0
+        while i < len(self.running):
+            if self.kv_cache.reserve(self.running[i].seq_id, 1):
+                i += 1
+                continue
+            if self._reclaim(1):
+                continue
+            victim = self.running.pop()
+            self.kv_cache.free(victim.seq_id)
+            victim.preemptions += 1
+            self.stats["preemptions"] += 1
+            logger.warning(f"KV cache full, preempting sequence {victim.seq_id}")
+            with self._cond:
+                self.pending.appendleft(victim)
+
+    def _prefill(self, seq: Sequence) -> bool:
+        """
+        Computes the KV cache of a newly admitted sequence, reusing cached prefix blocks.
+
+        Returns:
+            bool: False if the KV cache has no room for the sequence right now.
+        """
+        # A preempted sequence already sampled its last token; only its cache is rebuilt
+        resuming = bool(seq.output_ids)
+        context_ids = seq.context_ids
+        prefix_cache = self.kv_cache.prefix_cache
+        prefix_blocks = prefix_cache.match(context_ids) if prefix_cache is not None else []
+        prefix_length = len(prefix_blocks) * self.kv_cache.block_size
+        seq.cached_tokens = prefix_length
+
+        self.kv_cache.allocate(seq.seq_id, prefix_blocks)
+        if not self.kv_cache.reserve(seq.seq_id, len(context_ids) - prefix_length):
+            self.kv_cache.free(seq.seq_id)
+            return False
+
+        cache = DynamicCache()
+        if prefix_length:
+            layers, _ = self.kv_cache.gather([seq.seq_id])
+            for layer, (keys, values) in enumerate(layers):
+                cache.update(keys[:, :, :prefix_length], values[:, :, :prefix_length], layer)
+
+        outputs = self.model(
+            input_ids=torch.tensor([context_ids[prefix_length:]], device=self.device),
+            attention_mask=torch.ones(1, len(context_ids), dtype=torch.long, device=self.device),
+            position_ids=torch.arange(prefix_length, len(context_ids), device=self.device).unsqueeze(0),
+            past_key_values=cache,
+            use_cache=True,
+        )
+        new_cache = outputs.past_key_values
+        blocks, offsets = self.kv_cache.append_slots(seq.seq_id, len(context_ids) - prefix_length)
+        for layer in range(self.kv_cache.num_layers):
+            keys, values = new_cache[layer]
+            self.kv_cache.write(
+                layer,
+                blocks,
+                offsets,
+                keys[0, :, prefix_length:].transpose(0, 1),
+                values[0, :, prefix_length:].transpose(0, 1),
+            )
+
+        if prefix_cache is not None:
+            prefix_cache.insert(context_ids, self.kv_cache.page_tables[seq.seq_id])
+        if not resuming:
+            self._emit(seq, outputs.logits[0, -1])
+        return True
+
+    def _decode_step(self, batch: List[Sequence]):
+        seq_ids = [seq.seq_id for seq in batch]
+        lengths = [self.kv_cache.seq_lengths[seq_id] for seq_id in seq_ids]
+        layers, padded_length = self.kv_cache.gather(seq_ids)
+
+        cache = DynamicCache()
+        for layer, (keys, values) in enumerate(layers):
+            cache.update(keys, values, layer)
+
+        # Hide the padding and stale slots after each sequence's own length
+        attention_mask = torch.zeros(len(batch), padded_length + 1, dtype=torch.long, device=self.device)
+        for i, length in enumerate(lengths):
+            attention_mask[i, :length] = 1
+        attention_mask[:, padded_length] = 1
+
+        outputs = self.model(
+            input_ids=torch.tensor([[seq.last_token] for seq in batch], device=self.device),
+            attention_mask=attention_mask,
+            position_ids=torch.tensor([[length] for length in lengths], device=self.device),
+            past_key_values=cache,
+            use_cache=True,
+        )
+
+        slots = [self.kv_cache.append_slots(seq_id, 1) for seq_id in seq_ids]
+        blocks = torch.cat([block for block, _ in slots])
+        offsets = torch.cat([offset for _, offset in slots])
+        new_cache = outputs.past_key_values
+        for layer in range(self.kv_cache.num_layers):
+            keys, values = new_cache[layer]
+            self.kv_cache.write(layer, blocks, offsets, keys[:, :, padded_length], values[:, :, padded_length])
+
+        for i, seq in enumerate(batch):
+            self._emit(seq, outputs.logits[i, -1])
+
+        self.stats["steps"] += 1
+        self.stats["batch_size_sum"] += len(batch)
+
+    def _speculative_step(self, seq: Sequence) -> bool:
+        """
+        Verifies a prompt-lookup draft for one sequence in a single forward pass.
+
+        The draft is a fixed guess, so sampling each position from the model and
+        accepting the draft token only if the sample equals it keeps the output
+        distribution unchanged. The first mismatching sample is emitted in place of
+        the draft token, so every pass emits at least one token.
+
+        Returns:
+            bool: False if no draft was proposed or there is no room for it; the
+                  sequence then takes part in the regular batched decode step.
+        """
+        remaining = seq.max_new_tokens - len(seq.output_ids)
+        num_draft_tokens = min(seq.num_draft_tokens, remaining - 1)
+        if num_draft_tokens <= 0:
+            return False
+        draft = propose_prompt_lookup(
+            seq.prompt_ids + seq.output_ids,
+            num_draft_tokens=num_draft_tokens,
+            max_ngram=self.draft_max_ngram
+        )
+        if not draft or not self.kv_cache.reserve(seq.seq_id, len(draft) + 1):
+            return False
+
+        length = self.kv_cache.seq_lengths[seq.seq_id]
+        layers, _ = self.kv_cache.gather([seq.seq_id])
+        cache = DynamicCache()
+        for layer, (keys, values) in enumerate(layers):
+            cache.update(keys[:, :, :length], values[:, :, :length], layer)
+
+        input_ids = [seq.last_token] + draft
+        outputs = self.model(
+            input_ids=torch.tensor([input_ids], device=self.device),
+            attention_mask=torch.ones(1, length + len(input_ids), dtype=torch.long, device=self.device),
+            position_ids=torch.arange(length, length + len(input_ids), device=self.device).unsqueeze(0),
+            past_key_values=cache,
+            use_cache=True,
+        )
+
+        accepted = 0
+        for i in range(len(input_ids)):
+            token_id = self._emit(seq, outputs.logits[0, i])
+            if i < len(draft) and token_id == draft[i]:
+                accepted += 1
+                if not self._is_finished(seq):
+                    continue
+            break
+        emitted = i + 1
+
+        # Only inputs followed by an emitted token become part of the context
+        blocks, offsets = self.kv_cache.append_slots(seq.seq_id, emitted)
+        new_cache = outputs.past_key_values
+        for layer in range(self.kv_cache.num_layers):
+            keys, values = new_cache[layer]
+            self.kv_cache.write(
+                layer,
+                blocks,
+                offsets,
+                keys[0, :, length:length + emitted].transpose(0, 1),
+                values[0, :, length:length + emitted].transpose(0, 1),
+            )
+
+        seq.verify_steps += 1
+        seq.draft_tokens += len(draft)
+        seq.accepted_tokens += accepted
+        self.stats["verify_steps"] += 1
+        self.stats["draft_tokens"] += len(draft)
+        self.stats["accepted_tokens"] += accepted
+        return True
+
+    def _emit(self, seq: Sequence, logits: torch.Tensor) -> int:
+        if seq.constraint is not None:
+            start = time_module.perf_counter()
+            logits = seq.constraint.apply(logits)
+            self.stats["mask_seconds"] += time_module.perf_counter() - start
+        token_id = sample_next_token(logits, seq.temperature, seq.top_p)
+        if seq.constraint is not None:
+            seq.constraint.advance(token_id)
+            self.stats["constrained_tokens"] += 1
+        seq.output_ids.append(token_id)
+        self.stats["tokens_generated"] += 1
+        if seq.first_token_at is None:
+            seq.first_token_at = time_module.perf_counter()
+        if token_id not in self.eos_token_ids:
+            seq.streamer.put(torch.tensor([token_id]))
+        return token_id
+
+    def _is_finished(self, seq: Sequence) -> bool:
+        return (
+            seq.cancelled
+            or seq.output_ids[-1] in self.eos_token_ids
+            or len(seq.output_ids) >= seq.max_new_tokens
+            or (seq.constraint is not None and seq.constraint.complete)
+        )
+
+    def _retire_if_cancelled(self, seq: Sequence) -> bool:
+        if seq.cancelled:
+            self._retire(seq)
+            return True
+        return False
+
+    def _retire(self, seq: Sequence):
+        prefix_cache = self.kv_cache.prefix_cache
+        if (
+            seq.pin_blocks
+            and prefix_cache is not None
+            and not seq.cancelled
+            and seq.error is None
+            and seq.output_ids
+            and seq.output_ids[-1] in self.eos_token_ids
+            and seq.seq_id in self.kv_cache.page_tables
+        ):
+            prefix_cache.insert(seq.context_ids, self.kv_cache.page_tables[seq.seq_id])
+            seq.pinned_blocks = self.kv_cache.detach(seq.seq_id)
+        else:
+            self.kv_cache.free(seq.seq_id)
+        seq.finished = True
+        self.stats["sequences_finished"] += 1
+        try:
+            seq.streamer.end()
+        finally:
+            seq.done.set()
@@ -0,0 +1,112 @@
+# app/models/context_cache.py
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from app.handlers.context_handler import PreparedContext
+
+logger = logging.getLogger(__name__)
+
+
+def context_key(context: Any) -> str:
+    """
+    Content address of a context payload: a hash of its canonical JSON, so payloads
+    that differ only in key order or whitespace share an entry.
+    """
+    canonical = json.dumps(context, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CachedContext:
+    """
+    A formatted context and the token ids of the chat message carrying it.
+    """
+    def __init__(self, prepared: PreparedContext, segment_text: Optional[str] = None, segment_ids: Optional[List[int]] = None):
+        """
+        Args:
+            prepared (PreparedContext): Output of `ContextPreparer.prepare`.
+            segment_text (Optional[str]): Rendered chat-template segment of the context message.
+            segment_ids (Optional[List[int]]): Token ids of `segment_text`.
+        """
+        self.prepared = prepared
+        self.segment_text = segment_text
+        self.segment_ids = segment_ids
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the entry."""
+        size = len(self.prepared.text.encode("utf-8"))
+        if self.segment_text is not None:
+            size += len(self.segment_text.encode("utf-8")) + 8 * len(self.segment_ids)
+        return size
+
+
+class ContextCache:
+    """
+    Content-addressed LRU cache of formatted contexts with a byte budget.
+
+    Requests over the same document set skip formatting, ranking and tokenizing the
+    context. Results that depend on the query (the token budget cut sources by
+    relevance) are stored per query; all others are shared by every query.
+    """
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        """
+        Args:
+            max_bytes (int): Budget for the cached texts and token ids. 0 disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, CachedContext]" = OrderedDict()
+        self.nbytes = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    @staticmethod
+    def _query_key(key: str, query: Optional[str]) -> str:
+        return f"{key}:{hashlib.blake2b((query or '').encode('utf-8'), digest_size=8).hexdigest()}"
+
+    def get(self, key: str, query: Optional[str] = None) -> Optional[CachedContext]:
+        """
+        Looks up the context for a payload key, first shared, then for this query.
+        """
+        for entry_key in (key, self._query_key(key, query)):
+            entry = self.entries.get(entry_key)
+            if entry is not None:
+                self.entries.move_to_end(entry_key)
+                self.stats["hits"] += 1
+                return entry
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, entry: CachedContext, query: Optional[str] = None):
+        """
+        Stores a context, evicting the least recently used ones beyond the byte budget.
+        """
+        size = entry.nbytes
+        if size > self.max_bytes:
+            return
+        if entry.prepared.query_dependent:
+            key = self._query_key(key, query)
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous.nbytes
+        self.entries[key] = entry
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+        }
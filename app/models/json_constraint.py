@@ -0,0 +1,798 @@
+# app/models/json_constraint.py
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import threading
+import time as time_module
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = frozenset(" \t\n\r")
+_DIGITS = frozenset("0123456789")
+_HEX = frozenset("0123456789abcdefABCDEF")
+_ESCAPES = frozenset('"\\/bfnrt')
+
+# Sorts after every character a token text holds, so `prefix + _LAST_CHAR` bounds the texts starting with `prefix`
+_LAST_CHAR = chr(0x10FFFF)
+
+# Schema ids of the unconstrained value, object and array, the same in every grammar
+ANY, ANY_OBJECT, ANY_ARRAY = 0, 1, 2
+
+# Longest run of whitespace between tokens of the value, so sampling cannot stall on blank lines
+MAX_WHITESPACE = 16
+
+# Objects with more declared properties get their masks precomputed for the keys in declared order only
+MAX_SUBSET_PROPERTIES = 6
+
+# Bottom frame of the frame-local walks in `JSONGrammar._frame_mask`
+_ESC = ("ESC",)
+# Feeding a character to `_ESC`: the frame above it completed and its parent must consume the character
+_REFEED = object()
+
+# Parser frames are tuples, so a parser state (a tuple of frames) can key the mask caches:
+#   ("V", sid)                          a value of schema `sid` is expected
+#   ("O", sid, phase, used, count, key) an object; phase 0 after "{", 1 before ":", 2 after a
+#                                       member, 3 after ","; `used` are the declared keys seen
+#                                       (None if not tracked), `key` the declared key before ":"
+#   ("K", sid, content, esc, names)     a key of object `sid` and the declared names it may still
+#                                       become (None if any key is allowed); `sid` and `content` are
+#                                       set if the object declares properties, else the frame is the
+#                                       same for every schema
+#   ("A", sid, phase)                   an array; phase 0 after "[", 2 after an item, 3 after ","
+#   ("S", sid, content, esc)            a string; `sid` and `content` are set for enums only
+#   ("N", integer, phase)               a number
+#   ("L", remaining)                    the rest of true, false or null
+#   ("W", count)                        whitespace between tokens, on top of the frame it belongs to
+# `esc` is 0 outside escapes, 1 after a backslash and 3 to 6 for the hex digits of a \u escape.
+
+
+def token_texts(tokenizer) -> List[str]:
+    """
+    Text of every token as it appears after other text, so SentencePiece word
+    boundaries are kept. Special tokens get an empty text and are never allowed.
+    """
+    anchor = tokenizer.encode("a", add_special_tokens=False)[:1]
+    anchor_text = tokenizer.decode(anchor)
+    size = len(tokenizer)
+    decoded = tokenizer.batch_decode([anchor + [i] for i in range(size)], clean_up_tokenization_spaces=False)
+    special = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}) or {})
+    return [
+        "" if i in special or not text.startswith(anchor_text) else text[len(anchor_text):]
+        for i, text in enumerate(decoded)
+    ]
+
+
+class TokenVocabulary:
+    """
+    Token texts of a tokenizer sorted into an implicit trie for constrained decoding.
+
+    Tokens are kept sorted by text with the length of the prefix each shares with
+    the one before it, so a walk can feed the characters of a shared prefix once
+    and skip every token below a prefix the grammar rejects. Masks of parser
+    frames that do not depend on the schema (strings, numbers, literals) are
+    cached here and shared by all grammars.
+    """
+    def __init__(self, texts: List[str], eos_token_ids: Iterable[int] = ()):
+        """
+        Args:
+            texts (List[str]): Text of each token id, see `token_texts`. Empty texts are never allowed.
+            eos_token_ids (Iterable[int]): Tokens allowed once the value is complete.
+        """
+        self.texts = texts
+        self.size = len(texts)
+        self.eos_token_ids = sorted(set(eos_token_ids))
+        self.order = sorted((i for i, text in enumerate(texts) if text), key=texts.__getitem__)
+        self.sorted_texts = [texts[i] for i in self.order]
+        self.lcp = [0] * len(self.sorted_texts)
+        for j in range(1, len(self.sorted_texts)):
+            previous, text = self.sorted_texts[j - 1], self.sorted_texts[j]
+            limit = min(len(previous), len(text))
+            k = 0
+            while k < limit and previous[k] == text[k]:
+                k += 1
+            self.lcp[j] = k
+        # Sorted index after the run of tokens sharing each token's first character
+        self.first_char_end = [0] * len(self.sorted_texts)
+        end = len(self.sorted_texts)
+        for j in range(len(self.sorted_texts) - 1, -1, -1):
+            self.first_char_end[j] = end
+            if self.lcp[j] == 0:
+                end = j
+        self.shared_frames: Dict[tuple, "_FrameMask"] = {}
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, eos_token_ids: Iterable[int] = ()) -> "TokenVocabulary":
+        return cls(token_texts(tokenizer), eos_token_ids)
+
+    def subtree_end(self, start: int, depth: int) -> int:
+        """End of the run of sorted tokens from `start` sharing its first `depth` characters."""
+        if depth == 0:
+            return len(self.lcp)
+        if depth == 1:
+            return self.first_char_end[start]
+        prefix = self.sorted_texts[start][:depth]
+        return bisect.bisect_right(self.sorted_texts, prefix + _LAST_CHAR, start + 1)
+
+    def skip(self, j: int, dead: int, end: int) -> int:
+        """Next sorted index after `j` that does not share its first `dead + 1` characters."""
+        if dead == 0:
+            return min(self.first_char_end[j], end)
+        prefix = self.sorted_texts[j][:dead + 1]
+        return bisect.bisect_right(self.sorted_texts, prefix + _LAST_CHAR, j + 1, end)
+
+
+class _FrameMask:
+    """
+    Tokens a parser frame accepts whatever is below it: `within` holds tokens consumed
+    without completing the frame (or that complete it exactly), `escapes` the
+    (sorted index, depth) prefixes after which the frame completes and the rest of
+    the token depends on the parent frames.
+    """
+    def __init__(self, within: torch.Tensor, escapes: List[Tuple[int, int]]):
+        self.within = within
+        self.escapes = escapes
+
+
+def _const(schema: Any) -> Any:
+    """Value of a schema that allows a single one (`const` or a one-value `enum`), else None."""
+    if not isinstance(schema, dict):
+        return None
+    if "const" in schema:
+        return schema["const"]
+    enum = schema.get("enum")
+    return enum[0] if isinstance(enum, list) and len(enum) == 1 else None
+
+
+def _union_tag(branches: List[Any]) -> Optional[str]:
+    """
+    Property whose string constant tells the object branches of a `oneOf`/`anyOf` apart,
+    or None if the branches have no such property.
+    """
+    if not all(isinstance(branch, dict) and isinstance(branch.get("properties"), dict) for branch in branches):
+        return None
+    for name in branches[0]["properties"]:
+        values = [_const(branch["properties"].get(name)) for branch in branches]
+        if all(isinstance(value, str) for value in values) and len(set(values)) == len(values):
+            return name
+    return None
+
+
+def _compile_union(branches: List[dict], tag: str, nodes: List[dict]) -> int:
+    """
+    Adds a union of object schemas told apart by the constant of `tag`. The union is an
+    object whose only key is the tag; once its value is known the object continues as
+    the branch it names.
+    """
+    node = {
+        "kind": "object", "properties": {}, "additional": None,
+        "required": frozenset([tag]), "min_properties": 1, "branches": {},
+    }
+    index = len(nodes)
+    nodes.append(node)
+    values = [branch["properties"][tag] for branch in branches]
+    node["properties"][tag] = _compile_schema({"enum": [_const(value) for value in values]}, nodes)
+    for branch in branches:
+        node["branches"][_const(branch["properties"][tag])] = _compile_schema({"type": "object", **branch}, nodes)
+    return index
+
+
+def _compile_schema(schema: Any, nodes: List[dict]) -> int:
+    """Adds a schema to the node table and returns its id. Unsupported keywords are unconstrained."""
+    if not isinstance(schema, dict):
+        return ANY
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), None)
+    branches = schema.get("oneOf") or schema.get("anyOf")
+    if isinstance(branches, list) and branches:
+        tag = _union_tag(branches)
+        return _compile_union(branches, tag, nodes) if tag is not None else ANY
+    if isinstance(schema.get("const"), str):
+        nodes.append({"kind": "enum", "values": (schema["const"],)})
+        return len(nodes) - 1
+    enum = schema.get("enum")
+    if isinstance(enum, list) and enum and all(isinstance(value, str) for value in enum):
+        nodes.append({"kind": "enum", "values": tuple(enum)})
+        return len(nodes) - 1
+    if kind in ("object", "dict"):
+        node = {"kind": "object", "properties": {}, "additional": None}
+        index = len(nodes)
+        nodes.append(node)
+        for name, property_schema in (schema.get("properties") or {}).items():
+            node["properties"][name] = _compile_schema(property_schema, nodes)
+        additional = schema.get("additionalProperties")
+        if isinstance(additional, dict):
+            node["additional"] = _compile_schema(additional, nodes)
+        elif additional is True or (not node["properties"] and additional is not False):
+            node["additional"] = ANY
+        # Required keys that cannot be written would make the object impossible to close
+        node["required"] = frozenset(
+            name for name in schema.get("required") or []
+            if name in node["properties"] or node["additional"] is not None
+        )
+        node["min_properties"] = max(int(schema.get("minProperties", 0)), len(node["required"]))
+        return index
+    if kind == "array":
+        node = {"kind": "array", "items": ANY}
+        index = len(nodes)
+        nodes.append(node)
+        node["items"] = _compile_schema(schema.get("items"), nodes)
+        return index
+    if kind in ("string", "integer", "number", "boolean", "null"):
+        nodes.append({"kind": kind})
+        return len(nodes) - 1
+    return ANY
+
+
+class JSONGrammar:
+    """
+    Character-level pushdown automaton for the JSON values of a schema, with token masks.
+
+    Supports objects (declared properties in any order, `required`, `additionalProperties`,
+    `minProperties`), arrays, strings and string enums and constants, integers, numbers,
+    booleans and null, and `oneOf`/`anyOf` of objects told apart by a string constant
+    property, which must come first in the object; other keywords are not enforced.
+    Objects with declared properties only get other keys if `additionalProperties` is a
+    schema or true; arrays and objects without a schema accept any JSON.
+
+    The mask of a parser state is the union of the frame mask of its top frame, computed
+    once by walking the vocabulary with that frame alone, and the tokens that complete
+    the frame and continue in its parents, checked against the full state. Free strings
+    dominate generation and their frame mask is shared through the vocabulary, so the
+    per-token work is mostly a cache lookup. Full masks are cached per state in an LRU.
+
+    The frames of a schema are finite apart from free keys and the used keys of large
+    objects, so `precompute` walks the vocabulary for all of them when the grammar is
+    compiled; a mask miss while decoding then only walks the tokens that close a frame.
+    """
+    def __init__(self, schema: Any, vocabulary: TokenVocabulary, max_masks: int = 128):
+        """
+        Args:
+            schema (Any): JSON schema of the value to generate.
+            vocabulary (TokenVocabulary): Tokens of the model's tokenizer.
+            max_masks (int): Parser states whose masks are kept.
+        """
+        self.schema = schema
+        self.vocabulary = vocabulary
+        self.nodes: List[dict] = [
+            {"kind": "any"},
+            {"kind": "object", "properties": {}, "additional": ANY, "required": frozenset(), "min_properties": 0},
+            {"kind": "array", "items": ANY},
+        ]
+        self.root = _compile_schema(schema, self.nodes)
+        self.initial = (("V", self.root),)
+        self.frames: Dict[tuple, _FrameMask] = {}
+        self.masks: "OrderedDict[tuple, torch.Tensor]" = OrderedDict()
+        self.max_masks = max_masks
+        self._lock = threading.Lock()
+        self.stats = {
+            "frame_walks": 0,
+            "precomputed_frames": 0,
+            "compile_seconds": 0.0,
+            "mask_hits": 0,
+            "mask_misses": 0,
+        }
+
+    # Parser
+
+    def _start_value(self, sid: int, ch: str) -> Optional[tuple]:
+        """Frame opened by the first character of a value of schema `sid`."""
+        node = self.nodes[sid]
+        kind = node["kind"]
+        if ch == "{" and kind in ("object", "any"):
+            sid = sid if kind == "object" else ANY_OBJECT
+            used = frozenset() if self.nodes[sid]["properties"] else None
+            return ("O", sid, 0, used, 0, None)
+        if ch == "[" and kind in ("array", "any"):
+            return ("A", sid if kind == "array" else ANY_ARRAY, 0)
+        if ch == '"':
+            if kind == "enum":
+                return ("S", sid, "", 0)
+            if kind in ("string", "any"):
+                return ("S", None, None, 0)
+            return None
+        if (ch == "-" or ch in _DIGITS) and kind in ("integer", "number", "any"):
+            phase = "sign" if ch == "-" else "zero" if ch == "0" else "int"
+            return ("N", kind == "integer", phase)
+        if ch == "t" and kind in ("boolean", "any"):
+            return ("L", "rue")
+        if ch == "f" and kind in ("boolean", "any"):
+            return ("L", "alse")
+        if ch == "n" and kind in ("null", "any"):
+            return ("L", "ull")
+        return None
+
+    def _object_can_close(self, frame: tuple) -> bool:
+        node = self.nodes[frame[1]]
+        if frame[4] < node["min_properties"]:
+            return False
+        return frame[3] is None or node["required"] <= frame[3]
+
+    def _object_can_add_key(self, frame: tuple) -> bool:
+        node = self.nodes[frame[1]]
+        return node["additional"] is not None or frame[3] is None or bool(node["properties"].keys() - frame[3])
+
+    def _union_branch(self, frame: tuple, value: str) -> tuple:
+        """Object frame of the union branch whose tag is `value`, right after the tag."""
+        union = self.nodes[frame[1]]
+        sid = union["branches"][value]
+        node = self.nodes[sid]
+        used = frozenset(name for name in union["required"] if name in node["properties"])
+        return ("O", sid, 2, used, min(1, node["min_properties"]), None)
+
+    def feed(self, stack, ch: str):
+        """
+        Advances a parser state by one character.
+
+        Returns:
+            The new state, None if the character is not allowed, or `_REFEED` in
+            frame-local walks when the character belongs to the frame below.
+        """
+        while True:
+            if not stack:
+                # The value is complete; nothing may follow it
+                return None
+            frame = stack[-1]
+            tag = frame[0]
+            rest = stack[:-1]
+
+            if tag == "S" or tag == "K":
+                esc = frame[3]
+                if esc == 1:
+                    if ch == "u":
+                        return rest + (frame[:3] + (6,) + frame[4:],)
+                    if ch in _ESCAPES:
+                        return rest + (frame[:3] + (0,) + frame[4:],)
+                    return None
+                if esc:
+                    if ch not in _HEX:
+                        return None
+                    return rest + (frame[:3] + (0 if esc == 3 else esc - 1,) + frame[4:],)
+                content = frame[2]
+                if ch == '"':
+                    if tag == "S":
+                        if content is None:
+                            return rest
+                        if content not in self.nodes[frame[1]]["values"]:
+                            return None
+                        if rest and rest[-1][0] == "O" and "branches" in self.nodes[rest[-1][1]]:
+                            # The tag of a union: the object goes on as the branch it names
+                            return rest[:-1] + (self._union_branch(rest[-1], content),)
+                        return rest
+                    names = frame[4]
+                    if names is not None and content not in names:
+                        return None
+                    parent = rest[-1]
+                    if parent is _ESC:
+                        return rest
+                    # A finished key: the object now expects ":"
+                    used = parent[3]
+                    if used is not None and content in self.nodes[parent[1]]["properties"]:
+                        used = used | {content}
+                    count = min(parent[4] + 1, self.nodes[parent[1]]["min_properties"])
+                    # Other keys all take the `additionalProperties` schema, so they share a state
+                    key = content if content in self.nodes[parent[1]]["properties"] else None
+                    return rest[:-1] + (("O", parent[1], 1, used, count, key),)
+                if ch == "\\":
+                    # Escapes are not allowed in enum values and declared keys
+                    return rest + (frame[:3] + (1,) + frame[4:],) if content is None else None
+                if ch < " ":
+                    return None
+                if content is None:
+                    return stack
+                content += ch
+                if tag == "S":
+                    if not any(value.startswith(content) for value in self.nodes[frame[1]]["values"]):
+                        return None
+                    return rest + (("S", frame[1], content, 0),)
+                names = frame[4]
+                if names is not None:
+                    # Only the names still possible, so keys sharing them share the frame's mask
+                    names = frozenset(name for name in names if name.startswith(content))
+                    if not names:
+                        return None
+                return rest + (("K", frame[1], content, 0, names),)
+
+            if tag == "W":
+                if ch in _WHITESPACE:
+                    return rest + (("W", frame[1] + 1),) if frame[1] < MAX_WHITESPACE else None
+                stack = rest
+                continue
+
+            if tag == "V":
+                if ch in _WHITESPACE:
+                    return stack + (("W", 1),)
+                started = self._start_value(frame[1], ch)
+                return rest + (started,) if started is not None else None
+
+            if tag == "O":
+                sid, phase = frame[1], frame[2]
+                if ch in _WHITESPACE:
+                    return stack + (("W", 1),)
+                if phase == 1:
+                    if ch != ":":
+                        return None
+                    node = self.nodes[sid]
+                    key = frame[5]
+                    value_sid = node["properties"].get(key) if key is not None else None
+                    if value_sid is None:
+                        value_sid = node["additional"] if node["additional"] is not None else ANY
+                    return rest + (("O", sid, 2, frame[3], frame[4], None), ("V", value_sid))
+                if phase in (0, 3) and ch == '"':
+                    if not self._object_can_add_key(frame):
+                        return None
+                    node = self.nodes[sid]
+                    if node["properties"]:
+                        names = node["properties"].keys() - frame[3] if node["additional"] is None else None
+                        return stack + (("K", sid, "", 0, frozenset(names) if names is not None else None),)
+                    return stack + (("K", None, None, 0, None),)
+                if phase in (0, 2) and ch == "}":
+                    return rest if self._object_can_close(frame) else None
+                if phase == 2 and ch == ",":
+                    return rest + (frame[:2] + (3,) + frame[3:],) if self._object_can_add_key(frame) else None
+                return None
+
+            if tag == "A":
+                sid, phase = frame[1], frame[2]
+                if ch in _WHITESPACE:
+                    return stack + (("W", 1),)
+                if phase in (0, 2) and ch == "]":
+                    return rest
+                if phase == 2:
+                    return rest + (("A", sid, 3),) if ch == "," else None
+                # An item starts with this character
+                stack = rest + (("A", sid, 2), ("V", self.nodes[sid]["items"]))
+                continue
+
+            if tag == "N":
+                integer, phase = frame[1], frame[2]
+                digit = ch in _DIGITS
+                if phase == "sign":
+                    if not digit:
+                        return None
+                    return rest + (("N", integer, "zero" if ch == "0" else "int"),)
+                if phase in ("dot", "exp_sign"):
+                    return rest + (("N", integer, "frac" if phase == "dot" else "exp_digits"),) if digit else None
+                if phase == "exp":
+                    if ch in "+-":
+                        return rest + (("N", integer, "exp_sign"),)
+                    return rest + (("N", integer, "exp_digits"),) if digit else None
+                if digit and phase != "zero":
+                    return stack
+                if ch == "." and phase in ("zero", "int") and not integer:
+                    return rest + (("N", integer, "dot"),)
+                if ch in "eE" and phase in ("zero", "int", "frac") and not integer:
+                    return rest + (("N", integer, "exp"),)
+                if digit:
+                    # No leading zeros
+                    return None
+                # The number ended; the character belongs to the parent
+                stack = rest
+                continue
+
+            if tag == "L":
+                remaining = frame[1]
+                if ch != remaining[0]:
+                    return None
+                return rest + (("L", remaining[1:]),) if len(remaining) > 1 else rest
+
+            if tag == "ESC":
+                return _REFEED
+            return None
+
+    @staticmethod
+    def is_complete(stack) -> bool:
+        """Whether the state holds a whole value; a top-level number may still go on."""
+        return not stack or (len(stack) == 1 and stack[0][0] == "N" and stack[0][2] in ("zero", "int", "frac", "exp_digits"))
+
+    # Masks
+
+    @staticmethod
+    def _schema_free(frame: tuple) -> bool:
+        return frame[0] in ("N", "L", "W") or (frame[0] in ("S", "K") and frame[1] is None)
+
+    @staticmethod
+    def shared_frames() -> Iterable[tuple]:
+        """Every frame that does not depend on the schema: free strings and keys, numbers, literals, whitespace."""
+        for esc in (0, 1, 3, 4, 5, 6):
+            yield ("S", None, None, esc)
+            yield ("K", None, None, esc, None)
+        for phase in ("sign", "zero", "int"):
+            yield ("N", True, phase)
+        for phase in ("sign", "zero", "int", "dot", "frac", "exp", "exp_sign", "exp_digits"):
+            yield ("N", False, phase)
+        for literal in ("rue", "alse", "ull"):
+            for start in range(len(literal)):
+                yield ("L", literal[start:])
+        for count in range(1, MAX_WHITESPACE + 1):
+            yield ("W", count)
+
+    def _frame_mask(self, frame: tuple) -> _FrameMask:
+        """
+        Walks the vocabulary with `frame` on top of `_ESC`, collecting the tokens it
+        accepts on its own and the prefixes after which it completes.
+        """
+        cache = self.vocabulary.shared_frames if self._schema_free(frame) else self.frames
+        entry = cache.get(frame)
+        if entry is not None:
+            return entry
+
+        vocabulary = self.vocabulary
+        texts, lcp, order = vocabulary.sorted_texts, vocabulary.lcp, vocabulary.order
+        within = torch.zeros(vocabulary.size, dtype=torch.bool)
+        escapes = set()
+        states = [(_ESC, frame)]
+        # Sorted index where the prefix of each depth first appeared
+        starts = [0]
+        j = 0
+        while j < len(texts):
+            text = texts[j]
+            depth = min(lcp[j], len(states) - 1)
+            del states[depth + 1:]
+            del starts[depth + 1:]
+            state = states[depth]
+            dead = None
+            while depth < len(text):
+                if state == (_ESC,):
+                    # The frame completed with the prefix; the rest depends on its parents
+                    escapes.add((starts[depth], depth))
+                    dead = depth
+                    break
+                state = self.feed(state, text[depth])
+                if state is _REFEED:
+                    escapes.add((starts[depth], depth))
+                    dead = depth
+                    break
+                if state is None:
+                    dead = depth
+                    break
+                depth += 1
+                states.append(state)
+                starts.append(j)
+            if dead is None:
+                within[order[j]] = True
+                j += 1
+                continue
+            # Skip every token below the prefix that ended the walk
+            j = vocabulary.skip(j, dead, len(texts))
+
+        entry = _FrameMask(within, sorted(escapes))
+        cache[frame] = entry
+        self.stats["frame_walks"] += 1
+        return entry
+
+    def _object_frames(self, sid: int, node: dict) -> Iterable[tuple]:
+        """Object and key frames of an object schema, for the used keys `precompute` covers."""
+        names = list(node["properties"])
+        additional = node["additional"] is not None
+        if not names:
+            used_sets = [None]
+        elif len(names) <= MAX_SUBSET_PROPERTIES:
+            used_sets = [frozenset(c) for size in range(len(names) + 1) for c in itertools.combinations(names, size)]
+        else:
+            used_sets = [frozenset(names[:size]) for size in range(len(names) + 1)]
+        minimum = node["min_properties"]
+        for used in used_sets:
+            least = min(len(used), minimum) if used else 0
+            counts = range(least, minimum + 1) if additional or used is None else (least,)
+            for count in counts:
+                if not used and count == 0:
+                    yield ("O", sid, 0, used, count, None)
+                for phase in (2, 3):
+                    yield ("O", sid, phase, used, count, None)
+                if additional or used is None:
+                    yield ("O", sid, 1, used, count, None)
+                for key in used or ():
+                    yield ("O", sid, 1, used, count, key)
+            if names:
+                remaining = None if additional else frozenset(names) - used
+                for name in (names if additional else remaining):
+                    for end in range(len(name) + 1):
+                        prefix = name[:end]
+                        yield ("K", sid, prefix, 0, None if additional else frozenset(
+                            other for other in remaining if other.startswith(prefix)
+                        ))
+
+    def _schema_frames(self) -> Iterable[tuple]:
+        """Frames of the schema's values, arrays, enum strings and objects."""
+        for sid, node in enumerate(self.nodes):
+            yield ("V", sid)
+            if node["kind"] == "array":
+                for phase in (0, 2, 3):
+                    yield ("A", sid, phase)
+            elif node["kind"] == "enum":
+                prefixes = {value[:end] for value in node["values"] for end in range(len(value) + 1)}
+                for prefix in sorted(prefixes):
+                    yield ("S", sid, prefix, 0)
+            elif node["kind"] == "object":
+                yield from self._object_frames(sid, node)
+
+    def precompute(self):
+        """
+        Walks the vocabulary for every frame of the schema up front, so decoding does
+        not. Frames outside the enumeration (free keys of objects with declared
+        properties, unusual key orders of large objects) are still walked on first use.
+        """
+        start = time_module.perf_counter()
+        walks = self.stats["frame_walks"]
+        for frame in self._schema_frames():
+            self._frame_mask(frame)
+        self.stats["precomputed_frames"] += self.stats["frame_walks"] - walks
+        self.stats["compile_seconds"] += time_module.perf_counter() - start
+
+    def _walk(self, start: int, depth: int, stack, mask: torch.Tensor):
+        """Marks the tokens below a sorted prefix that the full parser state accepts."""
+        vocabulary = self.vocabulary
+        texts, lcp, order = vocabulary.sorted_texts, vocabulary.lcp, vocabulary.order
+        end = vocabulary.subtree_end(start, depth)
+        states = [stack]
+        base = depth
+        j = start
+        while j < end:
+            text = texts[j]
+            level = base if j == start else min(max(lcp[j], base), base + len(states) - 1)
+            del states[level - base + 1:]
+            state = states[-1]
+            dead = None
+            while level < len(text):
+                state = self.feed(state, text[level])
+                if state is None:
+                    dead = level
+                    break
+                level += 1
+                states.append(state)
+            if dead is None:
+                mask[order[j]] = True
+                j += 1
+                continue
+            j = vocabulary.skip(j, dead, end)
+
+    def mask(self, stack) -> torch.Tensor:
+        """
+        Tokens allowed in a parser state, as a bool tensor over the vocabulary.
+        """
+        with self._lock:
+            cached = self.masks.get(stack)
+            if cached is not None:
+                self.masks.move_to_end(stack)
+                self.stats["mask_hits"] += 1
+                return cached
+        self.stats["mask_misses"] += 1
+
+        vocabulary = self.vocabulary
+        if not stack:
+            mask = torch.zeros(vocabulary.size, dtype=torch.bool)
+        else:
+            entry = self._frame_mask(stack[-1])
+            mask = entry.within.clone()
+            for start, depth in entry.escapes:
+                state = stack
+                for ch in vocabulary.sorted_texts[start][:depth]:
+                    state = self.feed(state, ch)
+                    if state is None:
+                        break
+                if state is not None:
+                    self._walk(start, depth, state, mask)
+        if self.is_complete(stack):
+            mask[vocabulary.eos_token_ids] = True
+
+        with self._lock:
+            self.masks[stack] = mask
+            if len(self.masks) > self.max_masks:
+                self.masks.popitem(last=False)
+        return mask
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "frames": len(self.frames), "masks": len(self.masks)}
+
+
+class JSONConstraint:
+    """
+    Per-sequence state of a `JSONGrammar`: masks the logits before sampling and
+    advances with every sampled token. The sequence is done once the value closes.
+    """
+    def __init__(self, grammar: JSONGrammar):
+        self.grammar = grammar
+        self.schema = grammar.schema
+        self.stack = grammar.initial
+
+    @property
+    def complete(self) -> bool:
+        return not self.stack
+
+    def apply(self, logits: torch.Tensor) -> torch.Tensor:
+        """Returns the logits with every token the grammar rejects set to -inf."""
+        mask = self.grammar.mask(self.stack)
+        if not mask.any():
+            # Should not happen with a complete vocabulary; end the sequence rather than loop
+            mask = mask.clone()
+            mask[self.grammar.vocabulary.eos_token_ids] = True
+        size = logits.shape[-1]
+        if mask.shape[0] < size:
+            mask = torch.cat([mask, torch.zeros(size - mask.shape[0], dtype=torch.bool)])
+        return logits.masked_fill(~mask[:size].to(logits.device), float("-inf"))
+
+    def advance(self, token_id: int):
+        """
+        Feeds a sampled token to the parser.
+
+        Raises:
+            ValueError: If the token is not allowed, e.g. sampled without `apply`.
+        """
+        if token_id in self.grammar.vocabulary.eos_token_ids:
+            return
+        for ch in self.grammar.vocabulary.texts[token_id]:
+            stack = self.grammar.feed(self.stack, ch)
+            if stack is None or stack is _REFEED:
+                raise ValueError(f"Token {token_id} is not allowed by the JSON schema")
+            self.stack = stack
+
+
+def schema_key(schema: Any) -> str:
+    canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class JSONGrammarCache:
+    """
+    Compiled grammars by schema, so requests with the same schema share their masks.
+    """
+    def __init__(self, vocabulary: TokenVocabulary, max_grammars: int = 32):
+        self.vocabulary = vocabulary
+        self.max_grammars = max_grammars
+        self.grammars: "OrderedDict[str, JSONGrammar]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, schema: Any) -> JSONGrammar:
+        """
+        The grammar of a schema, compiled with its frame masks on first use. Compiling
+        walks the vocabulary, so callers keep it off the decode loop.
+        """
+        key = schema_key(schema)
+        with self._lock:
+            grammar = self.grammars.get(key)
+            if grammar is not None:
+                self.grammars.move_to_end(key)
+                return grammar
+        grammar = JSONGrammar(schema, self.vocabulary)
+        grammar.precompute()
+        with self._lock:
+            # A concurrent first use may have compiled it too; either copy is complete
+            grammar = self.grammars.setdefault(key, grammar)
+            if len(self.grammars) > self.max_grammars:
+                self.grammars.popitem(last=False)
+            return grammar
+
+    def constraint(self, schema: Any) -> JSONConstraint:
+        """A fresh constraint for one sequence."""
+        return JSONConstraint(self.get(schema))
+
+    def warm_up(self, schemas: Iterable[Any] = ()):
+        """
+        Computes the frame masks every schema shares, then compiles the given schemas.
+        Free strings and keys are the walks that visit most of the vocabulary.
+        """
+        grammar = JSONGrammar({"type": "string"}, self.vocabulary)
+        for frame in JSONGrammar.shared_frames():
+            grammar._frame_mask(frame)
+        for schema in schemas:
+            self.get(schema)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            grammars = list(self.grammars.values())
+        return {
+            "grammars": len(grammars),
+            "shared_frames": len(self.vocabulary.shared_frames),
+            "frame_walks": sum(grammar.stats["frame_walks"] for grammar in grammars),
+            "precomputed_frames": sum(grammar.stats["precomputed_frames"] for grammar in grammars),
+            "compile_seconds": sum(grammar.stats["compile_seconds"] for grammar in grammars),
+            "mask_hits": sum(grammar.stats["mask_hits"] for grammar in grammars),
+            "mask_misses": sum(grammar.stats["mask_misses"] for grammar in grammars),
+        }
@@ -0,0 +1,298 @@
+# app/models/kv_cache.py
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class PagedKVCache:
+    """
+    Block-based KV cache shared by every sequence of one model instance.
+
+    Keys and values live in fixed-size pages of `block_size` tokens. Each sequence
+    owns a page table (list of block ids) that grows one block at a time, so memory
+    tracks the tokens actually stored instead of `max_new_tokens`. Freed blocks go
+    back to a free list and are reused by later requests without reallocating.
+    The backing storage starts at `initial_blocks` and doubles on demand up to
+    `max_blocks`; it is never released while the process runs.
+
+    Blocks are reference counted so that full blocks of a common prompt prefix
+    can be shared between sequences through an attached `PrefixCache`.
+    """
+    def __init__(
+        self,
+        num_layers: int,
+        num_kv_heads: int,
+        head_dim: int,
+        block_size: int = 16,
+        initial_blocks: int = 64,
+        max_blocks: int = 2048,
+        dtype=torch.float16,
+        device="cpu",
+    ):
+        """
+        Initializes the block storage.
+
+        Args:
+            num_layers (int): Number of transformer layers.
+            num_kv_heads (int): Number of key/value heads per layer.
+            head_dim (int): Dimension of each attention head.
+            block_size (int): Number of tokens stored per block.
+            initial_blocks (int): Number of blocks allocated up front.
+            max_blocks (int): Upper bound on the number of blocks.
+            dtype: Data type of the stored keys and values.
+            device: Device holding the storage.
+        """
+        self.num_layers = num_layers
+        self.num_kv_heads = num_kv_heads
+        self.head_dim = head_dim
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.dtype = dtype
+        self.device = torch.device(device)
+
+        self.key_blocks: List[torch.Tensor] = []
+        self.value_blocks: List[torch.Tensor] = []
+        self.capacity = 0
+        self.free_blocks: List[int] = []
+        self.ref_counts: List[int] = []
+        self.peak_used_blocks = 0
+        # Set by PrefixCache when prefix sharing is enabled
+        self.prefix_cache = None
+
+        self.page_tables: Dict[int, List[int]] = {}
+        self.seq_lengths: Dict[int, int] = {}
+        # Last stats snapshot taken by the thread that owns the cache, see `publish_stats`
+        self.published_stats: Optional[dict] = None
+
+        self._grow(min(initial_blocks, max_blocks))
+
+    @classmethod
+    def for_model(cls, model, **kwargs) -> "PagedKVCache":
+        """
+        Builds a cache matching a Hugging Face causal LM's attention layout.
+        """
+        config = model.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        return cls(
+            num_layers=config.num_hidden_layers,
+            num_kv_heads=getattr(config, "num_key_value_heads", None) or config.num_attention_heads,
+            head_dim=head_dim,
+            dtype=model.dtype,
+            device=model.device,
+            **kwargs,
+        )
+
+    @property
+    def block_bytes(self) -> int:
+        """Bytes used by one block across all layers, keys and values."""
+        element_size = torch.empty(0, dtype=self.dtype).element_size()
+        return 2 * self.num_layers * self.num_kv_heads * self.block_size * self.head_dim * element_size
+
+    def _grow(self, num_blocks: int):
+        if num_blocks <= 0:
+            return
+        shape = (num_blocks, self.num_kv_heads, self.block_size, self.head_dim)
+        for layer in range(self.num_layers):
+            new_keys = torch.zeros(shape, dtype=self.dtype, device=self.device)
+            new_values = torch.zeros(shape, dtype=self.dtype, device=self.device)
+            if self.capacity:
+                self.key_blocks[layer] = torch.cat([self.key_blocks[layer], new_keys])
+                self.value_blocks[layer] = torch.cat([self.value_blocks[layer], new_values])
+            else:
+                self.key_blocks.append(new_keys)
+                self.value_blocks.append(new_values)
+        self.ref_counts.extend([0] * num_blocks)
+        # Hand out low block ids first
+        self.free_blocks.extend(reversed(range(self.capacity, self.capacity + num_blocks)))
+        self.capacity += num_blocks
+        logger.debug(f"KV cache grown to {self.capacity} blocks")
+
+    def blocks_needed(self, num_tokens: int) -> int:
+        return -(-num_tokens // self.block_size)
+
+    def num_available_blocks(self) -> int:
+        """Blocks that can still be handed out, including storage not yet allocated."""
+        evictable = self.prefix_cache.num_evictable() if self.prefix_cache is not None else 0
+        return len(self.free_blocks) + evictable + self.max_blocks - self.capacity
+
+    def can_allocate(self, num_blocks: int) -> bool:
+        return self.num_available_blocks() >= num_blocks
+
+    def _allocate_block(self) -> int:
+        if not self.free_blocks:
+            if self.capacity < self.max_blocks:
+                self._grow(min(max(self.capacity, 1), self.max_blocks - self.capacity))
+            elif self.prefix_cache is None or not self.prefix_cache.evict(1):
+                raise MemoryError("KV cache is out of blocks")
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        self.peak_used_blocks = max(self.peak_used_blocks, self.capacity - len(self.free_blocks))
+        return block
+
+    def _release_block(self, block: int):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] > 0:
+            return
+        if self.prefix_cache is not None and self.prefix_cache.holds(block):
+            # Keep the contents around until the prefix cache evicts it
+            self.prefix_cache.mark_evictable(block)
+        else:
+            self.free_blocks.append(block)
+
+    def allocate(self, seq_id: int, shared_blocks: Sequence[int] = ()):
+        """
+        Registers a new sequence, optionally starting with full blocks shared from the prefix cache.
+        """
+        for block in shared_blocks:
+            self.ref_counts[block] += 1
+            if self.prefix_cache is not None:
+                self.prefix_cache.acquire(block)
+        self.page_tables[seq_id] = list(shared_blocks)
+        self.seq_lengths[seq_id] = len(shared_blocks) * self.block_size
+
+    def free(self, seq_id: int):
+        """
+        Releases every block of a sequence. Unshared blocks go back to the free list.
+        """
+        blocks = self.page_tables.pop(seq_id, [])
+        self.seq_lengths.pop(seq_id, None)
+        # Release the deepest blocks first so eviction never orphans a cached prefix
+        for block in reversed(blocks):
+            self._release_block(block)
+
+    def detach(self, seq_id: int) -> List[int]:
+        """
+        Removes a sequence but keeps references to its full blocks for the caller.
+        The partially filled last block, if any, is released.
+
+        Returns:
+            List[int]: Block ids still referenced; hand them back with `release_blocks`.
+        """
+        blocks = self.page_tables.pop(seq_id, [])
+        full_blocks = self.seq_lengths.pop(seq_id, 0) // self.block_size
+        for block in reversed(blocks[full_blocks:]):
+            self._release_block(block)
+        return blocks[:full_blocks]
+
+    def release_blocks(self, blocks: Sequence[int]):
+        """
+        Drops references taken by `detach`.
+        """
+        for block in reversed(blocks):
+            self._release_block(block)
+
+    def reserve(self, seq_id: int, num_tokens: int) -> bool:
+        """
+        Ensures the page table of a sequence covers `num_tokens` more tokens.
+
+        Returns:
+            bool: False if the cache ran out of blocks. Blocks reserved so far are kept.
+        """
+        table = self.page_tables[seq_id]
+        needed = self.blocks_needed(self.seq_lengths[seq_id] + num_tokens) - len(table)
+        try:
+            for _ in range(needed):
+                table.append(self._allocate_block())
+        except MemoryError:
+            return False
+        return True
+
+    def append_slots(self, seq_id: int, num_tokens: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Claims the next `num_tokens` positions of a sequence.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Block ids and in-block offsets of each position.
+        """
+        if not self.reserve(seq_id, num_tokens):
+            raise MemoryError("KV cache is out of blocks")
+        start = self.seq_lengths[seq_id]
+        positions = torch.arange(start, start + num_tokens)
+        table = torch.tensor(self.page_tables[seq_id])
+        self.seq_lengths[seq_id] = start + num_tokens
+        blocks = table[positions // self.block_size].to(self.device)
+        offsets = (positions % self.block_size).to(self.device)
+        return blocks, offsets
+
+    def write(self, layer: int, blocks: torch.Tensor, offsets: torch.Tensor, keys: torch.Tensor, values: torch.Tensor):
+        """
+        Stores keys and values of shape [num_tokens, kv_heads, head_dim] into their slots.
+        """
+        self.key_blocks[layer][blocks, :, offsets] = keys.to(self.dtype)
+        self.value_blocks[layer][blocks, :, offsets] = values.to(self.dtype)
+
+    def gather(self, seq_ids: Sequence[int]) -> Tuple[List[Tuple[torch.Tensor, torch.Tensor]], int]:
+        """
+        Copies the pages of several sequences into padded contiguous tensors.
+
+        Returns:
+            Tuple[List[Tuple[torch.Tensor, torch.Tensor]], int]: Per-layer (keys, values) of shape
+            [batch, kv_heads, padded_length, head_dim] and the padded length. Positions past a
+            sequence's own length hold stale data and must be masked out.
+        """
+        tables = [self.page_tables[seq_id] for seq_id in seq_ids]
+        max_table = max(1, max(len(table) for table in tables))
+        padded = torch.zeros(len(tables), max_table, dtype=torch.long)
+        for i, table in enumerate(tables):
+            padded[i, :len(table)] = torch.tensor(table, dtype=torch.long)
+        padded = padded.to(self.device)
+
+        padded_length = max_table * self.block_size
+        layers = []
+        for layer in range(self.num_layers):
+            # [batch, max_table, heads, block, dim] -> [batch, heads, max_table * block, dim]
+            keys = self.key_blocks[layer][padded].transpose(1, 2).reshape(
+                len(tables), self.num_kv_heads, padded_length, self.head_dim
+            )
+            values = self.value_blocks[layer][padded].transpose(1, 2).reshape(
+                len(tables), self.num_kv_heads, padded_length, self.head_dim
+            )
+            layers.append((keys, values))
+        return layers, padded_length
+
+    def publish_stats(self):
+        """
+        Takes a stats snapshot, with the attached prefix cache's. Called by the thread
+        that allocates and frees sequences, so other threads never walk the page
+        tables while they change.
+        """
+        self.published_stats = self._collect_stats()
+        if self.prefix_cache is not None:
+            self.prefix_cache.publish_stats()
+
+    def get_stats(self) -> dict:
+        """
+        Occupancy statistics for sizing the pool, from the last published snapshot if any.
+        """
+        stats = self.published_stats
+        return stats if stats is not None else self._collect_stats()
+
+    def _collect_stats(self) -> dict:
+        # Cached prefix blocks nobody references can be reclaimed at any time
+        evictable = self.prefix_cache.num_evictable() if self.prefix_cache is not None else 0
+        used_blocks = self.capacity - len(self.free_blocks) - evictable
+        tokens_stored = sum(self.seq_lengths.values())
+        wasted_slots = sum(
+            len(table) * self.block_size - self.seq_lengths[seq_id]
+            for seq_id, table in self.page_tables.items()
+        )
+        return {
+            "block_size": self.block_size,
+            "block_bytes": self.block_bytes,
+            "allocated_blocks": self.capacity,
+            "max_blocks": self.max_blocks,
+            "used_blocks": used_blocks,
+            "free_blocks": len(self.free_blocks),
+            "evictable_blocks": evictable,
+            "peak_used_blocks": self.peak_used_blocks,
+            "occupancy": used_blocks / self.max_blocks if self.max_blocks else 0.0,
+            "sequences": len(self.page_tables),
+            "tokens_stored": tokens_stored,
+            # Slots reserved in partially filled blocks
+            "wasted_slots": wasted_slots,
+            "allocated_bytes": self.capacity * self.block_bytes,
+            "used_bytes": used_blocks * self.block_bytes,
+        }
@@ -1,16 +1,36 @@
 # app/models/model_pool.py
 import asyncio
+import importlib.util
+import os
+import re
 import torch
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Dict, Any
 from fastapi import HTTPException
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
-import threading
+from transformers import AutoModelForCausalLM, AutoTokenizer
 import time as time_module
 import json
-import gc
 
 from app.handlers.context_handler import ContextPreparer
+from app.handlers.context_ranker import ContextRanker
+from app.handlers.query_planner import PLAN_SCHEMA, QueryPlanner, Subquery, extract_json
+from app.handlers.query_rephraser import QueryRephraser
+from app.models.admission import AdmissionController, AdmissionTicket
+from app.models.async_streamer import AsyncTextStreamer
+from app.models.batch_scheduler import ContinuousBatchScheduler
+from app.models.context_cache import CachedContext, ContextCache, context_key
+from app.models.json_constraint import JSONConstraint, JSONGrammarCache, TokenVocabulary, token_texts
+from app.models.kv_cache import PagedKVCache
+from app.models.prefix_cache import PrefixCache
+from app.models.process_worker import ProcessWorker, WorkerStatsView, worker_cores
+from app.models.prompt_templates import PromptTemplateRegistry
+from app.models.prompt_tokenizer import PromptTokenizer
+from app.models.quantization import QUANTIZATION_MODES, load_dtype, quantize_model
+from app.models.session_store import SessionState, SessionStore
+from app.models.slot_scheduler import PRIORITY_CLASSES, create_slot_scheduler
+from app.tools.runtime import ToolRuntime, parse_tool_calls, tool_calls_schema
+from app.utils.memory_maintenance import current_rss_bytes
 from app.utils.system_prompt import *
 
 logger = logging.getLogger(__name__)
@@ -18,28 +38,174 @@ logger = logging.getLogger(__name__)
 class ParallelModelPool:
     """
     Manages a pool of model instances for parallel inference across multiple CUDA devices.
-    Utilizes an asyncio.Queue to handle request queuing when all models are busy.
+    Each instance runs a continuous batching scheduler that decodes up to `max_batch_size`
+    sequences per forward pass. A pluggable `SlotScheduler` hands out the batch slots and
+    decides which request goes next when every slot is busy. Instances on the same device
+    share one copy of the read-only weights and keep their own KV cache and scheduler.
+    With the "process" execution backend each instance instead runs in its own
+    worker process pinned to a group of cores. Construction loads nothing; `start`
+    brings the instances up in the background.
     """
     def __init__(
         self, 
         model_path: str, 
         num_instances: int = 4, 
         dtype=torch.float16, 
-        devices: Optional[List[str]] = None
+        devices: Optional[List[str]] = None,
+        max_batch_size: int = 8,
+        kv_block_size: int = 16,
+        kv_cache_max_blocks: int = 2048,
+        prefix_cache_max_blocks: int = 512,
+        stream_flush_tokens: int = 4,
+        stream_flush_interval: float = 0.05,
+        prompt_cache_entries: int = 4096,
+        session_ttl: float = 1800.0,
+        max_sessions: int = 64,
+        session_pinned_fraction: float = 0.25,
+        max_queue_depth: int = 64,
+        request_deadline: Optional[float] = 30.0,
+        scheduling_policy: str = "fifo",
+        tenant_weights: Optional[Dict[str, float]] = None,
+        num_draft_tokens: int = 5,
+        draft_max_ngram: int = 3,
+        load_workers: Optional[int] = None,
+        snapshot_dir: Optional[str] = None,
+        warmup_tokens: int = 8,
+        execution_backend: str = "thread",
+        worker_threads: Optional[int] = None,
+        quantization: Optional[str] = None,
+        context_max_tokens: Optional[int] = None,
+        context_ranking: bool = True,
+        context_dedup_threshold: Optional[float] = 0.9,
+        context_cache_bytes: int = 64 * 2**20,
+        query_planning: bool = False,
+        plan_max_tokens: int = 512,
+        subquery_max_tokens: int = 256,
+        tool_runtime: Optional[ToolRuntime] = None,
+        constrained_decoding: bool = True,
+        query_rephrasing: bool = False,
+        rephrase_max_tokens: int = 64,
+        rephrase_cache_entries: int = 1024
     ):
         """
         Initializes the model pool.
 
         Args:
             model_path (str): Path or name of the pretrained model.
-            num_instances (int): Number of model instances to load.
+            num_instances (int): Number of model instances to create. Weights are loaded
+                                 once per device and shared by its instances.
             dtype: Data type for the model parameters.
             devices (Optional[List[str]]): Specific devices to load models onto. 
                                            If None, all available CUDA devices are used.
+            max_batch_size (int): Number of sequences each instance decodes concurrently.
+            kv_block_size (int): Number of tokens per KV cache block.
+            kv_cache_max_blocks (int): Maximum number of KV cache blocks per instance.
+            prefix_cache_max_blocks (int): KV blocks per instance kept for shared prompt
+                                           prefixes. 0 disables prefix caching.
+            stream_flush_tokens (int): Tokens buffered before streamed text is flushed.
+            stream_flush_interval (float): Seconds after which streamed text is flushed.
+            prompt_cache_entries (int): Number of tokenized message segments kept in the LRU cache.
+            session_ttl (float): Seconds a conversation session is kept after its last turn.
+            max_sessions (int): Maximum number of conversation sessions kept.
+            session_pinned_fraction (float): Share of an instance's KV cache blocks its sessions
+                                             may keep pinned between turns.
+            max_queue_depth (int): Maximum number of requests waiting for a batch slot.
+            request_deadline (Optional[float]): Default seconds a request may wait for a batch slot.
+            scheduling_policy (str): Order in which waiting requests get batch slots, "fifo" or
+                                     "fair" (priority classes and weighted fair share per tenant).
+            tenant_weights (Optional[Dict[str, float]]): Share of each tenant under the "fair" policy.
+            num_draft_tokens (int): Prompt-lookup tokens verified per step for speculative requests.
+            draft_max_ngram (int): Longest trailing n-gram looked up for speculative drafts.
+            load_workers (Optional[int]): Threads loading weights concurrently. Defaults to one per device.
+            snapshot_dir (Optional[str]): Directory for a warm snapshot of the weights, saved as
+                                          safetensors in `dtype` after the first load and
+                                          memory-mapped on later starts.
+            warmup_tokens (int): Tokens generated by each instance before it takes requests.
+                                 0 disables the warm-up.
+            execution_backend (str): "thread" runs every instance's scheduler in this process,
+                                     "process" runs each instance in a worker process with
+                                     its own copy of the weights, pinned to its share of the cores.
+            worker_threads (Optional[int]): Intra-op threads per worker process. Defaults to
+                                            the number of cores the worker is pinned to.
+            quantization (Optional[str]): Quantize the linear layers after loading, one of
+                                          `QUANTIZATION_MODES`. Quantized CPU models are loaded
+                                          in fp32 regardless of `dtype`.
+            context_max_tokens (Optional[int]): Token budget of the context placed in the prompt.
+                                                Lowest-priority sources are cut beyond it.
+            context_ranking (bool): Rank context sources by BM25 relevance to the query and drop
+                                    near-duplicates before packing them into the budget.
+            context_dedup_threshold (Optional[float]): Word-trigram Jaccard similarity at which a
+                                                       source counts as a near-duplicate.
+            context_cache_bytes (int): Memory for formatted contexts and their token ids, shared
+                                       by requests over the same documents. 0 disables it.
+            query_planning (bool): Whether requests are decomposed into subqueries by default,
+                                   see `QueryPlanner`.
+            plan_max_tokens (int): Token limit of the query decomposition output.
+            subquery_max_tokens (int): Token limit of each subquery answer.
+            tool_runtime (Optional[ToolRuntime]): Executes the function calls of "Function Calling"
+                                                  subqueries. Without it (or any registered tool)
+                                                  they are answered by the model.
+            constrained_decoding (bool): Mask the logits of internal JSON outputs (query plans,
+                                         function calls) against their schema, so they parse
+                                         on the first pass and stop when the value closes.
+            query_rephrasing (bool): Whether follow-up queries are rewritten into standalone ones
+                                     before planning by default, see `QueryRephraser`.
+            rephrase_max_tokens (int): Token limit of a rephrased query.
+            rephrase_cache_entries (int): Rephrased queries kept by history and query. 0 disables it.
         """
-        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        self.queue = asyncio.Queue(maxsize=num_instances)
+        if execution_backend not in ("thread", "process"):
+            raise ValueError(f"Unknown execution backend: {execution_backend}")
+        if quantization and quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {quantization}")
+        self.model_path = model_path
+        self.dtype = dtype
+        self.max_batch_size = max_batch_size
+        self.kv_block_size = kv_block_size
+        self.kv_cache_max_blocks = kv_cache_max_blocks
+        self.prefix_cache_max_blocks = prefix_cache_max_blocks
+        self.draft_max_ngram = draft_max_ngram
+        self.snapshot_dir = snapshot_dir
+        self.prompt_cache_entries = prompt_cache_entries
+        self.context_max_tokens = context_max_tokens
+        self.context_ranker = ContextRanker(dedup_threshold=context_dedup_threshold) if context_ranking else None
+        # Loaded by `start`
+        self.tokenizer = None
+        self.prompt_tokenizer: Optional[PromptTokenizer] = None
+        self.context_preparer: Optional[ContextPreparer] = None
+        self.prompt_templates: Optional[PromptTemplateRegistry] = None
+        self.query_planner: Optional[QueryPlanner] = None
+        self.query_planning = query_planning
+        self.plan_max_tokens = plan_max_tokens
+        self.subquery_max_tokens = subquery_max_tokens
+        self.tool_runtime = tool_runtime
+        self.query_rephraser: Optional[QueryRephraser] = None
+        self.query_rephrasing = query_rephrasing
+        self.rephrase_max_tokens = rephrase_max_tokens
+        self.rephrase_cache_entries = rephrase_cache_entries
+        self.constrained_decoding = constrained_decoding
+        # Builds the token vocabulary of the JSON grammars in the background, see `json_constraint`
+        self._json_grammars: Optional[asyncio.Task] = None
+        # With the process backend each worker builds its own grammars from these token texts
+        self._token_texts: Optional[List[str]] = None
+        self._tool_calls_schema: Optional[dict] = None
+        self.context_cache = ContextCache(max_bytes=context_cache_bytes)
+        self.sessions = SessionStore(
+            ttl=session_ttl,
+            max_sessions=max_sessions,
+            max_pinned_blocks=int(session_pinned_fraction * kv_cache_max_blocks)
+        )
+        self.stream_flush_tokens = stream_flush_tokens
+        self.stream_flush_interval = stream_flush_interval
+        self.num_draft_tokens = num_draft_tokens
+        self.slots = create_slot_scheduler(scheduling_policy, tenant_weights)
         self.model_instances = []
+        # Retired instances still finishing their streams, stopped by `stop` if shutdown comes first
+        self.draining_instances = []
+        # One copy of the weights per device, shared by the instances placed on it
+        self.models: Dict[str, Any] = {}
+        # Activity tracking for background maintenance
+        self.last_activity = time_module.monotonic()
+        self.requests_completed = 0
 
         # Detect available CUDA devices if not specified
         if devices is None:
@@ -47,65 +213,729 @@ class ParallelModelPool:
             devices = [f"cuda:{i}" for i in range(available_cuda)] if available_cuda > 0 else ["cpu"]
             if not devices:
                 devices = ["cpu"]
+        self.devices = devices
+        self.num_instances = num_instances
+        self._next_index = num_instances
+        self.load_workers = load_workers
+        self.warmup_tokens = warmup_tokens
+        self.execution_backend = execution_backend
+        self.worker_threads = worker_threads
+        self.quantization = quantization or None
 
-        logger.info(f"Using devices: {devices}")
-
-        for i in range(num_instances):
-            try:
-                # Assign devices in a round-robin fashion if instances exceed devices
-                device = devices[i % len(devices)]
-                
-                logger.debug(f"Loading model instance {i} on {device}")
-
-                model = AutoModelForCausalLM.from_pretrained(
-                    model_path, 
-                    torch_dtype=dtype
-                ).to(device)
-                
-                model_instance = {
-                    'model': model, 
-                    'device': device
-                }
-                self.model_instances.append(model_instance)
-                
-                # Enqueue the model instance as available
-                self.queue.put_nowait(model_instance)
-                
-                logger.info(f"Loaded and enqueued model instance {i} on {device}")
-            except Exception as e:
-                logger.error(f"Failed to load model instance {i} on {device}: {e}")
+        # Startup progress, see `start`
+        self.state = "created"
+        self.first_ready_seconds: Optional[float] = None
+        self.startup_seconds: Optional[float] = None
+
+        self.admission = AdmissionController(
+            num_slots=0,
+            max_queue_depth=max_queue_depth,
+            default_deadline=request_deadline
+        )
+
+    @property
+    def snapshot_path(self) -> Optional[str]:
+        """Directory of the warm snapshot for this model and dtype, if snapshots are enabled."""
+        if not self.snapshot_dir or self.quantization:
+            # Quantized layers do not round-trip through save_pretrained
+            return None
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "--", self.model_path.strip("/"))
+        return os.path.join(self.snapshot_dir, f"{name}-{str(self.dtype).replace('torch.', '')}")
+
+    def _weights_source(self, device: str):
+        """
+        Picks the checkpoint to load, the warm snapshot if present, and its `from_pretrained` arguments.
+
+        Returns:
+            Tuple: The path and the keyword arguments.
+        """
+        path = self.model_path
+        snapshot_path = self.snapshot_path
+        if snapshot_path and os.path.isfile(os.path.join(snapshot_path, "config.json")):
+            path = snapshot_path
+            logger.info(f"Loading weights for {device} from snapshot {snapshot_path}")
+
+        load_kwargs = {"torch_dtype": load_dtype(self.quantization, device, self.dtype)}
+        if os.path.isdir(path):
+            # Hub checkpoints already prefer safetensors; local ones may only have pytorch_model.bin
+            load_kwargs["use_safetensors"] = any(name.endswith(".safetensors") for name in os.listdir(path))
+        if importlib.util.find_spec("accelerate") is not None:
+            # Builds the model on the meta device and fills it from the checkpoint directly
+            load_kwargs["low_cpu_mem_usage"] = True
+        return path, load_kwargs
+
+    def _load_weights(self, device: str):
+        """
+        Loads the model weights onto a device.
+
+        Safetensors checkpoints are memory-mapped, so the weights are paged in from
+        the file instead of being read into a temporary copy first. A warm snapshot,
+        if present, is already in the target dtype.
+
+        Returns:
+            Tuple: The model, the load time in seconds and the RSS growth in bytes.
+        """
+        start = time_module.perf_counter()
+        rss_before = current_rss_bytes()
+        path, load_kwargs = self._weights_source(device)
+        model = AutoModelForCausalLM.from_pretrained(path, **load_kwargs).to(device)
+        model.eval()
+        # Inference only reads the parameters, so scheduler threads can share them
+        model.requires_grad_(False)
+        model = quantize_model(model, self.quantization)
+        return model, time_module.perf_counter() - start, current_rss_bytes() - rss_before
+
+    def _save_snapshot(self, model):
+        """
+        Writes the loaded weights as a warm snapshot unless one exists already.
+        """
+        snapshot_path = self.snapshot_path
+        if not snapshot_path or os.path.isfile(os.path.join(snapshot_path, "config.json")):
+            return
+        try:
+            tmp_path = f"{snapshot_path}.tmp-{os.getpid()}"
+            model.save_pretrained(tmp_path, safe_serialization=True)
+            os.replace(tmp_path, snapshot_path)
+            logger.info(f"Saved warm snapshot to {snapshot_path}")
+        except Exception as e:
+            logger.warning(f"Failed to save warm snapshot to {snapshot_path}: {e}")
+
+    def _create_instance(self, index: int, device: str, model, shares_weights: bool) -> Dict[str, Any]:
+        """
+        Builds the KV cache and batch scheduler of one instance around loaded weights.
+        """
+        if self.execution_backend == "process":
+            return self._create_worker_instance(index, device)
+        kv_cache = PagedKVCache.for_model(
+            model,
+            block_size=self.kv_block_size,
+            max_blocks=self.kv_cache_max_blocks
+        )
+        prefix_cache = (
+            PrefixCache(kv_cache, self.prefix_cache_max_blocks) if self.prefix_cache_max_blocks > 0 else None
+        )
+        scheduler = ContinuousBatchScheduler(
+            model,
+            max_batch_size=self.max_batch_size,
+            eos_token_ids=self._eos_token_ids(model),
+            kv_cache=kv_cache,
+            name=f"batch-scheduler-{index}",
+            draft_max_ngram=self.draft_max_ngram
+        )
+        # A prefill that runs out of blocks drops idle sessions' pinned blocks before failing
+        scheduler.reclaim_blocks = lambda num_blocks: self.sessions.reclaim(scheduler, num_blocks)
+        return {
+            'model': model,
+            'device': device,
+            'scheduler': scheduler,
+            'kv_cache': kv_cache,
+            'prefix_cache': prefix_cache,
+            'in_use': 0,
+            'shares_weights': shares_weights,
+            'draining': False
+        }
+
+    def _create_worker_instance(self, index: int, device: str) -> Dict[str, Any]:
+        """
+        Starts a worker process that loads its own weights and runs the instance's scheduler.
+        """
+        path, load_kwargs = self._weights_source(device)
+        cores = worker_cores(index, self.num_instances)
+        worker = ProcessWorker(
+            path,
+            load_kwargs,
+            device=device,
+            max_batch_size=self.max_batch_size,
+            kv_block_size=self.kv_block_size,
+            kv_cache_max_blocks=self.kv_cache_max_blocks,
+            prefix_cache_max_blocks=self.prefix_cache_max_blocks,
+            draft_max_ngram=self.draft_max_ngram,
+            quantization=self.quantization,
+            extra_eos_token_ids=[self.tokenizer.eos_token_id] if self.tokenizer.eos_token_id is not None else [],
+            vocabulary=self._worker_vocabulary(),
+            cores=cores,
+            num_threads=self.worker_threads,
+            name=f"model-worker-{index}"
+        )
+        logger.info(f"Started model worker {index} (pid {worker.pid}) on cores {cores} with {worker.num_threads} threads")
+        # The worker's scheduler asks for idle sessions' pinned blocks through the parent
+        worker.reclaim_blocks = lambda num_blocks: self.sessions.reclaim(worker, num_blocks)
+        return {
+            'model': None,
+            'device': device,
+            'scheduler': worker,
+            'kv_cache': WorkerStatsView(worker, "kv_cache"),
+            'prefix_cache': WorkerStatsView(worker, "prefix_cache") if self.prefix_cache_max_blocks > 0 else None,
+            'in_use': 0,
+            'shares_weights': False,
+            'draining': False
+        }
+
+    async def _warm_up(self, model_instance: Dict[str, Any]):
+        """
+        Runs a short generation on a new instance so kernels and allocators are primed
+        before it takes requests. It also puts the system prompt into the prefix cache.
+        """
+        if self.warmup_tokens <= 0:
+            return
+        start = time_module.perf_counter()
+        prompt_ids = self.prompt_tokenizer.encode([
+            {"role": "system", "content": agentic_prompt},
+            {"role": "user", "content": "Hello"}
+        ])
+        streamer = AsyncTextStreamer(self.tokenizer, skip_prompt=False, skip_special_tokens=True)
+        sequence = model_instance['scheduler'].submit(
+            prompt_ids=prompt_ids,
+            streamer=streamer,
+            max_new_tokens=self.warmup_tokens,
+            temperature=0
+        )
+        async for _ in streamer:
+            pass
+        if sequence.error is not None:
+            raise sequence.error
+        model_instance['warmup_seconds'] = time_module.perf_counter() - start
+
+    async def _add_instance(
+        self, index: int, device: str, model, shares_weights: bool, load_seconds: float, rss_bytes: int
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Creates an instance around loaded weights, warms it up and opens its batch slots.
+
+        Returns:
+            Optional[Dict[str, Any]]: The new instance, or None if its warm-up failed.
+        """
+        loop = asyncio.get_running_loop()
+        instance_start = time_module.perf_counter()
+        rss_before = current_rss_bytes()
+        model_instance = await loop.run_in_executor(
+            None, self._create_instance, index, device, model, shares_weights
+        )
+        # The first instance on a device accounts for loading its weights
+        model_instance['load_seconds'] = time_module.perf_counter() - instance_start + load_seconds
+        model_instance['rss_bytes'] = current_rss_bytes() - rss_before + rss_bytes
+        try:
+            await self._warm_up(model_instance)
+        except Exception as e:
+            logger.error(f"Warm-up of model instance {index} on {device} failed: {e}")
+            await asyncio.to_thread(model_instance['scheduler'].stop)
+            return None
+
+        self.model_instances.append(model_instance)
+        self.slots.add_slots(model_instance, self.max_batch_size)
+        self.admission.num_slots = self.slots.num_slots
+        if self.first_ready_seconds is None:
+            self.first_ready_seconds = time_module.perf_counter() - self._startup_start
+        logger.info(
+            f"Loaded model instance {index} on {device} in {model_instance['load_seconds']:.2f}s "
+            f"(+{model_instance['rss_bytes'] / 2**20:.0f} MiB RSS, shared weights: {shares_weights})"
+        )
+        return model_instance
+
+    async def _load_instances(self):
+        """
+        Loads the weights for every device concurrently and brings up the instances.
+
+        Instances are assigned to devices round-robin. Each device's weights are
+        loaded once in a worker thread; its instances start serving as soon as they
+        are warmed up, while other devices are still loading.
+        """
+        loop = asyncio.get_running_loop()
+        if self.execution_backend == "process":
+            # Every worker loads its own weights, so all of them start at once
+            async def start_worker(i: int):
+                device = self.devices[i % len(self.devices)]
+                try:
+                    await self._add_instance(i, device, None, shares_weights=False, load_seconds=0.0, rss_bytes=0)
+                except Exception as e:
+                    logger.error(f"Failed to start model worker {i} on {device}: {e}")
+
+            await asyncio.gather(*(start_worker(i) for i in range(self.num_instances)))
+            return
+
+        placement: Dict[str, List[int]] = {}
+        for i in range(self.num_instances):
+            # Assign devices in a round-robin fashion if instances exceed devices
+            placement.setdefault(self.devices[i % len(self.devices)], []).append(i)
+
+        executor = ThreadPoolExecutor(
+            max_workers=self.load_workers or len(placement), thread_name_prefix="model-loader"
+        )
+        try:
+            async def load_device(device: str):
+                try:
+                    model, load_seconds, rss_bytes = await loop.run_in_executor(executor, self._load_weights, device)
+                except Exception as e:
+                    logger.error(f"Failed to load model weights on {device}: {e}")
+                    return
+                self.models[device] = model
+                for position, i in enumerate(placement[device]):
+                    try:
+                        await self._add_instance(
+                            i, device, model,
+                            shares_weights=position > 0,
+                            load_seconds=load_seconds if position == 0 else 0.0,
+                            rss_bytes=rss_bytes if position == 0 else 0
+                        )
+                    except Exception as e:
+                        logger.error(f"Failed to load model instance {i} on {device}: {e}")
+
+            await asyncio.gather(*(load_device(device) for device in placement))
+        finally:
+            executor.shutdown(wait=False)
+
+        if self.models:
+            await loop.run_in_executor(None, self._save_snapshot, next(iter(self.models.values())))
+
+    async def start(self):
+        """
+        Loads the tokenizer and the model instances. Meant to run as a task of the
+        application lifespan; requests are served as soon as the first instance is up.
+        """
+        self.state = "loading"
+        self._startup_start = time_module.perf_counter()
+        logger.info(f"Using devices: {self.devices}")
+        try:
+            self.tokenizer = await asyncio.to_thread(AutoTokenizer.from_pretrained, self.model_path)
+            self.prompt_tokenizer = PromptTokenizer(self.tokenizer, max_entries=self.prompt_cache_entries)
+            self.prompt_templates = await asyncio.to_thread(PromptTemplateRegistry, self.tokenizer, PROMPT_TEMPLATES)
+            self.context_preparer = ContextPreparer(
+                max_tokens=self.context_max_tokens,
+                count_tokens=lambda text: len(self.tokenizer.encode(text, add_special_tokens=False)),
+                ranker=self.context_ranker
+            )
+            self.query_planner = QueryPlanner(
+                self.complete,
+                self.prompt_templates,
+                max_plan_tokens=self.plan_max_tokens,
+                max_answer_tokens=self.subquery_max_tokens
+            )
+            self.query_rephraser = QueryRephraser(
+                self.complete,
+                self.prompt_templates,
+                max_new_tokens=self.rephrase_max_tokens,
+                max_entries=self.rephrase_cache_entries
+            )
+            if self.tool_runtime is not None and self.tool_runtime.available:
+                # Only the functions that can actually run are offered to the model
+                self.prompt_templates.register(
+                    "function_call",
+                    function_call_prompt_template,
+                    functions=json.dumps(self.tool_runtime.available, indent=4)
+                )
+                self._tool_calls_schema = tool_calls_schema(self.tool_runtime.available)
+                self.query_planner.register_resolver("Function Calling", self._resolve_function_call)
+            if self.constrained_decoding and self.execution_backend == "process":
+                self._token_texts = await asyncio.to_thread(token_texts, self.tokenizer)
+            elif self.constrained_decoding:
+                self._json_grammars = asyncio.ensure_future(asyncio.to_thread(self._build_json_grammars))
+            await self._load_instances()
+        except Exception as e:
+            logger.error(f"Model pool startup failed: {e}")
+            self.state = "failed"
+            raise
+        self.startup_seconds = time_module.perf_counter() - self._startup_start
+        self.state = "ready" if self.model_instances else "failed"
+        logger.info(
+            f"Model pool {self.state}: {len(self.model_instances)}/{self.num_instances} instances "
+            f"in {self.startup_seconds:.2f}s"
+        )
+
+    async def add_instance(self) -> Optional[Dict[str, Any]]:
+        """
+        Brings up one more instance at runtime on the device with the fewest instances,
+        sharing that device's weights if they are loaded already.
+
+        Returns:
+            Optional[Dict[str, Any]]: The new instance, or None if it failed to start.
+        """
+        counts = {device: 0 for device in self.devices}
+        for model_instance in self.model_instances:
+            counts[model_instance['device']] = counts.get(model_instance['device'], 0) + 1
+        device = min(self.devices, key=lambda d: counts[d])
+        index = self._next_index
+        self._next_index += 1
+
+        try:
+            if self.execution_backend == "process":
+                return await self._add_instance(index, device, None, shares_weights=False, load_seconds=0.0, rss_bytes=0)
+            model = self.models.get(device)
+            shares_weights = model is not None
+            load_seconds, rss_bytes = 0.0, 0
+            if not shares_weights:
+                model, load_seconds, rss_bytes = await asyncio.to_thread(self._load_weights, device)
+                self.models[device] = model
+            return await self._add_instance(
+                index, device, model,
+                shares_weights=shares_weights,
+                load_seconds=load_seconds,
+                rss_bytes=rss_bytes
+            )
+        except Exception as e:
+            logger.error(f"Failed to add model instance {index} on {device}: {e}")
+            return None
+
+    async def retire_instance(self, model_instance: Optional[Dict[str, Any]] = None, poll_interval: float = 0.1):
+        """
+        Removes an instance at runtime. It stops taking requests right away, and is
+        stopped once its in-flight streams have finished, or when the retirement is
+        cancelled. Sessions pinned to it are dropped, so they release its KV cache.
+
+        Args:
+            model_instance (Optional[Dict[str, Any]]): Instance to retire. Defaults to the
+                                                       least busy, most recently added one.
+            poll_interval (float): Seconds between checks of the in-flight stream count.
+        """
+        if model_instance is None:
+            model_instance = min(reversed(self.model_instances), key=lambda instance: instance['in_use'])
+        model_instance['draining'] = True
+        self.model_instances.remove(model_instance)
+        self.draining_instances.append(model_instance)
+        self.slots.remove_slots(model_instance)
+        self.admission.num_slots = self.slots.num_slots
+        logger.info(f"Draining model instance on {model_instance['device']} ({model_instance['in_use']} in flight)")
+
+        try:
+            while model_instance['in_use'] > 0:
+                await asyncio.sleep(poll_interval)
+        finally:
+            await self._stop_draining(model_instance)
+
+        device = model_instance['device']
+        if not any(instance['device'] == device for instance in self.model_instances):
+            # Last instance on the device, release its weights as well
+            self.models.pop(device, None)
+            if device.startswith("cuda"):
+                torch.cuda.empty_cache()
+        logger.info(f"Retired model instance on {device}")
+
+    async def _stop_draining(self, model_instance: Dict[str, Any]):
+        """Stops a retired instance once, whether its drain ended or shutdown came first."""
+        if model_instance not in self.draining_instances:
+            return
+        self.draining_instances.remove(model_instance)
+        # Later turns of its sessions start over on another instance
+        self.sessions.drop_scheduler(model_instance['scheduler'])
+        await asyncio.to_thread(model_instance['scheduler'].stop)
+
+    async def stop(self):
+        """
+        Stops the batch schedulers of all instances, including those still draining.
+        """
+        for model_instance in self.model_instances:
+            await asyncio.to_thread(model_instance['scheduler'].stop)
+        for model_instance in list(self.draining_instances):
+            await self._stop_draining(model_instance)
+        self.state = "stopped"
+
+    @property
+    def ready(self) -> bool:
+        """Whether at least one instance is serving."""
+        return bool(self.model_instances) and self.state in ("loading", "ready")
+
+    def _eos_token_ids(self, model) -> List[int]:
+        """
+        Collects the token ids that end generation for a model.
+        """
+        eos = model.generation_config.eos_token_id
+        eos_ids = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+        if self.tokenizer.eos_token_id is not None:
+            eos_ids.add(self.tokenizer.eos_token_id)
+        return list(eos_ids)
+
+    @property
+    def num_active(self) -> int:
+        """Number of requests currently holding a batch slot."""
+        return sum(instance['in_use'] for instance in self.model_instances)
+
+    def admit(self, deadline: Optional[float] = None) -> AdmissionTicket:
+        """
+        Rejects a request early if it cannot get a batch slot in time.
+
+        Args:
+            deadline (Optional[float]): Seconds the request may wait for a slot.
+
+        Returns:
+            AdmissionTicket: The request's queue position, consumed by `get_free_model`.
+
+        Raises:
+            HTTPException: 429 if the queue is full, 503 if the deadline cannot be met
+                           or no instance is serving yet.
+        """
+        if not self.ready:
+            raise HTTPException(
+                503, "Model pool is not ready. Please try again later.", headers={"Retry-After": "5"}
+            )
+        return self.admission.admit(self.slots.free_slots, deadline)
+
+    def get_admission_stats(self) -> dict:
+        return self.admission.get_stats(self.slots.free_slots)
+
+    def _json_schemas(self) -> List[dict]:
+        """The schemas of internal outputs, compiled up front so no request waits for them."""
+        return [PLAN_SCHEMA, *([self._tool_calls_schema] if self._tool_calls_schema is not None else [])]
+
+    def _build_json_grammars(self) -> JSONGrammarCache:
+        start = time_module.perf_counter()
+        eos_token_ids = [self.tokenizer.eos_token_id] if self.tokenizer.eos_token_id is not None else []
+        grammars = JSONGrammarCache(TokenVocabulary.from_tokenizer(self.tokenizer, eos_token_ids))
+        grammars.warm_up(self._json_schemas())
+        logger.info(f"JSON grammar vocabulary built in {time_module.perf_counter() - start:.2f}s")
+        return grammars
+
+    def _worker_vocabulary(self) -> Optional[Dict[str, Any]]:
+        """What a worker builds its JSON grammars from, or None if constrained decoding is disabled."""
+        if self._token_texts is None:
+            return None
+        return {
+            "texts": self._token_texts,
+            "eos_token_ids": [self.tokenizer.eos_token_id] if self.tokenizer.eos_token_id is not None else [],
+            "schemas": self._json_schemas(),
+        }
+
+    async def json_constraint(self, json_schema: dict) -> Optional[JSONConstraint]:
+        """
+        Constraint restricting a sequence to JSON values of a schema, or None if
+        constrained decoding is disabled or its vocabulary could not be built.
+        """
+        if self._json_grammars is None:
+            return None
+        try:
+            # Shielded, so a cancelled request does not cancel the build others wait for
+            grammars = await asyncio.shield(self._json_grammars)
+        except Exception as e:
+            logger.warning(f"Constrained decoding unavailable: {e}")
+            self._json_grammars = None
+            return None
+        # A schema seen for the first time is compiled in a worker thread
+        return await asyncio.to_thread(grammars.constraint, json_schema)
+
+    def get_json_constraint_stats(self) -> Optional[dict]:
+        if self.execution_backend == "process":
+            # Summed over the workers, each of which compiles its own grammars
+            reports = [instance['scheduler'].latest_stats.get("json_constraints") for instance in self.model_instances]
+            reports = [report for report in reports if report is not None]
+            return {key: sum(report[key] for report in reports) for key in reports[0]} if reports else None
+        task = self._json_grammars
+        if task is None or not task.done() or task.cancelled() or task.exception() is not None:
+            return None
+        return task.result().get_stats()
 
-    async def get_free_model(self, timeout: Optional[float] = None):
+    async def get_free_model(
+        self,
+        timeout: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        cost: float = 1.0,
+        ticket: Optional[AdmissionTicket] = None
+    ):
         """
-        Retrieves a free model instance from the queue.
-        Waits until a model becomes available or until timeout.
+        Retrieves a model instance with a free batch slot from the slot scheduler.
+        Waits until a slot becomes available or until timeout.
 
         Args:
             timeout (Optional[float]): Maximum time to wait for a model.
+            tenant (Optional[str]): Tenant the request is accounted to.
+            priority (Optional[str]): Priority class, one of `PRIORITY_CLASSES`.
+            cost (float): Estimated cost of the request in tokens.
+            ticket (Optional[AdmissionTicket]): Queue position from `admit` (or a `nested` one for
+                                                an internal stage), released once the wait ends.
+                                                Without one the request is queued here, within the
+                                                queue bound.
 
         Returns:
             dict: A dictionary containing the model and its device.
 
         Raises:
-            HTTPException: If no model becomes available within the timeout.
+            HTTPException: 429 if the queue is full and no ticket was given, 503 if no model
+                           becomes available within the timeout.
         """
+        if priority is not None and priority not in PRIORITY_CLASSES:
+            raise HTTPException(400, f"Unknown priority class: {priority}")
+
+        if ticket is None:
+            ticket = self.admission.reserve()
         try:
-            model_instance = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+            model_instance = await self.slots.acquire(
+                tenant=tenant or "default",
+                priority=PRIORITY_CLASSES[priority or "default"],
+                cost=cost,
+                timeout=timeout
+            )
+            model_instance['in_use'] += 1
+            self.last_activity = time_module.monotonic()
             logger.debug(f"Acquired model on {model_instance['device']}")
             return model_instance
         except asyncio.TimeoutError:
             logger.warning("No model instances available and timeout reached.")
-            raise HTTPException(503, "No model instances available. Please try again later.")
+            self.admission.record_timeout()
+            retry_after = str(max(1, round(self.admission.service_time)))
+            raise HTTPException(
+                503, "No model instances available. Please try again later.", headers={"Retry-After": retry_after}
+            )
+        finally:
+            ticket.release()
 
     async def release_model(self, model_instance):
         """
-        Releases a model instance back to the queue.
+        Releases a model instance's batch slot back to the slot scheduler.
 
         Args:
             model_instance (dict): The model instance to release.
         """
-        await self.queue.put(model_instance)
-        logger.debug(f"Released model on {model_instance['device']} back to the queue")
+        model_instance['in_use'] -= 1
+        self.last_activity = time_module.monotonic()
+        self.requests_completed += 1
+        self.slots.release(model_instance)
+        logger.debug(f"Released model on {model_instance['device']} back to the slot scheduler")
+
+    async def complete(
+        self,
+        messages: List[Dict],
+        max_new_tokens: int = 256,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
+        timeout: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        json_schema: Optional[dict] = None,
+        ticket: Optional[AdmissionTicket] = None
+    ) -> str:
+        """
+        Generates a whole answer to chat messages without streaming, for internal steps
+        such as query planning. The request takes a batch slot like any other.
+
+        Args:
+            messages (List[Dict]): Chat messages, which may carry pre-tokenized `token_ids`.
+            max_new_tokens (int): Maximum number of tokens to generate.
+            temperature (float): Sampling temperature. 0 decodes greedily.
+            top_p (float): Top-p sampling threshold.
+            timeout (Optional[float]): Maximum time to wait for a model instance.
+            tenant (Optional[str]): Tenant or API key the request is accounted to.
+            priority (Optional[str]): Priority class, one of `PRIORITY_CLASSES`.
+            json_schema (Optional[dict]): Constrains the answer to a JSON value of this schema,
+                                          ending generation when the value closes.
+            ticket (Optional[AdmissionTicket]): Queue position from `admit`.
+
+        Returns:
+            str: The generated text.
+        """
+        if json_schema is None:
+            constraint = {}
+        elif self.execution_backend == "process":
+            # Workers compile the schema themselves, so only the schema is sent
+            constraint = {"json_schema": json_schema} if self.constrained_decoding else {}
+        else:
+            constraint = {"constraint": await self.json_constraint(json_schema)}
+        prompt_ids = self.prompt_tokenizer.encode(messages)
+        model_instance = await self.get_free_model(
+            timeout=self.admission.resolve_deadline(timeout),
+            tenant=tenant,
+            priority=priority,
+            cost=len(prompt_ids) + max_new_tokens,
+            ticket=ticket
+        )
+        sequence = None
+        try:
+            # Text is decoded once at the end, so the streamer only signals progress
+            streamer = AsyncTextStreamer(
+                self.tokenizer, skip_prompt=False, flush_tokens=max_new_tokens, skip_special_tokens=True
+            )
+            sequence = model_instance['scheduler'].submit(
+                prompt_ids=prompt_ids,
+                streamer=streamer,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                **constraint
+            )
+            async for _ in streamer:
+                pass
+            if sequence.error is not None:
+                raise sequence.error
+            return self.tokenizer.decode(sequence.output_ids, skip_special_tokens=True)
+        except asyncio.CancelledError:
+            if sequence is not None:
+                model_instance['scheduler'].cancel(sequence)
+            raise
+        finally:
+            await self.release_model(model_instance)
+
+    async def _resolve_function_call(self, subquery: Subquery, question: str, **completion_kwargs):
+        """
+        Resolves a "Function Calling" subquery: the model picks the calls, the tool runtime
+        runs them concurrently and their outputs become "Action" context. A question no
+        function answers is answered by the model instead.
+        """
+        prompt = self.prompt_templates.render("function_call", question=question)
+        output = await self.complete(
+            [prompt.message("user")], max_new_tokens=self.plan_max_tokens, temperature=0.0,
+            json_schema=self._tool_calls_schema, **completion_kwargs
+        )
+        calls = parse_tool_calls(extract_json(output))
+        if not calls:
+            return await self.query_planner.answer(subquery, question, **completion_kwargs)
+        results = await self.tool_runtime.execute(calls)
+        logger.info(f"Tool calls for {subquery.name}: {[(r.call.name, r.ok, round(r.latency, 3)) for r in results]}")
+        return "\n".join(result.output_text() for result in results), ToolRuntime.to_context(results)
+
+    def _prepare_context(self, context, key: Optional[str], query: str) -> Optional[CachedContext]:
+        """
+        Formats the context into its system message, from the context cache if the same
+        payload was seen before.
+
+        Args:
+            context: Context payload of the request.
+            key (Optional[str]): Content address of the payload, see `context_key`.
+            query (str): The user's question.
+
+        Returns:
+            Optional[CachedContext]: The formatted context with its message's token ids,
+                                     or None if the request has no context.
+        """
+        if not context:
+            return None
+        cached = self.context_cache.get(key, query)
+        if cached is not None:
+            return cached
+
+        prepared = self.context_preparer.prepare(context, query=query)
+        segment = self.prompt_tokenizer.encode_message(self._context_message(prepared.text))
+        cached = CachedContext(prepared, *(segment or ()))
+        self.context_cache.put(key, cached, query)
+        return cached
+
+    @staticmethod
+    def _context_message(context_str: str) -> Dict[str, str]:
+        return {"role": "system", "content": f"Context Information:\n{context_str}"}
+
+    def _update_session(
+        self,
+        session_id: str,
+        model_instance,
+        sequence,
+        history_messages: List[Dict[str, str]],
+        with_citation: bool,
+        context_key: Optional[str] = None
+    ):
+        """
+        Stores the state of a finished turn, or drops the session if the turn cannot be continued.
+        """
+        eos_token_ids = model_instance['scheduler'].eos_token_ids
+        if not sequence.output_ids or sequence.output_ids[-1] not in eos_token_ids:
+            # Cut off by max_new_tokens: the next turn's template renders an end of
+            # turn the model never produced, so the tokens would not line up
+            self.sessions.discard(session_id)
+            return
+
+        self.sessions.put(session_id, SessionState(
+            token_ids=sequence.prompt_ids + sequence.output_ids,
+            history_messages=history_messages,
+            with_citation=with_citation,
+            scheduler=model_instance['scheduler'],
+            pinned_blocks=sequence.pinned_blocks,
+            context_key=context_key
+        ))
 
     async def generate_text_stream(
         self, 
@@ -115,11 +945,17 @@ class ParallelModelPool:
         max_new_tokens: int = 1024, 
         temperature: float = 0.7, 
         top_p: float = 0.9,
-        timeout: Optional[float] = None  # Optional timeout for acquiring a model
+        timeout: Optional[float] = None,  # Optional timeout for acquiring a model
+        session_id: Optional[str] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        speculative: bool = False,
+        ticket: Optional[AdmissionTicket] = None
     ):
         """
         Generates text in a streaming fashion using an available model instance.
-        Requests are queued if all model instances are busy.
+        The request joins the instance's running decode batch and is queued if all
+        batch slots are busy.
 
         Args:
             query (str): The input prompt for text generation.
@@ -127,185 +963,163 @@ class ParallelModelPool:
             max_new_tokens (int): Maximum number of tokens to generate.
             temperature (float): Sampling temperature.
             top_p (float): Top-p sampling threshold.
-            timeout (Optional[float]): Maximum time to wait for a model instance.
+            timeout (Optional[float]): Maximum time to wait for a model instance. Defaults
+                                       to the admission controller's request deadline.
+            session_id (Optional[str]): Conversation ID. A follow-up turn of a known session
+                                        reuses the previous turn's tokens and KV blocks.
+            tenant (Optional[str]): Tenant or API key used for fair-share scheduling.
+            priority (Optional[str]): Priority class, one of `PRIORITY_CLASSES`.
+            speculative (bool): Decode speculatively with prompt-lookup drafts, which pays off
+                                when the answer copies spans from the context.
+            ticket (Optional[AdmissionTicket]): Queue position from `admit`.
 
         Yields:
             str: Generated text chunks and metrics as Server-Sent Events (SSE).
         """
-        model_instance = await self.get_free_model(timeout=timeout)
+        model_instance = None
+        sequence = None
         try:
-            # messages = [
-            #     {"role": "system", "content": "You are a helpful assistant."}, 
-            #     *(history_messages or []), 
-            #     {"role": "user", "content": query}
-            # ]
-            history_messages = history_messages if history_messages else ""
-   
-
-            # Prepare context string using ContextPreparer
-            context_preparer = ContextPreparer()
-            context_str = context_preparer.prepare_context(context)
-
-            logger.info(f"context_Str: {context_str}")
-
-            # Prepare the user message with constraints and instructions
-            user_message = f"""
-            Please answer the following question using **only** the provided context and function call responses. **Do not use any external information or your own knowledge.**
-
-            When you reference information from the context or function call responses, you **must** cite the source from the provided metadata by including an inline citation in the format `[Document Name](URL)(Page X)` for documents, or `[Function Name](Reference)` for function calls.
-
-            ### Example of metadata in the retrieved documents:
-
-            {{"Subquery-1": {{"Source": [{{"name": "Resume.pdf", "page":1, "url": "user_data/Candidate/Resume.pdf", "text": "Document Content"}}], "Type": "RAG"}}}}
-
-            The format of the citation becomes `[Resume.pdf](user_data/Candidate/Resume.pdf)(page 1)`
-
-            ### Example of metadata in the function call responses:
-
-            {{'Subquery-1': {{'Source': [{{'FunctionName': [{{'name': 'google_search', 'arguments': {{'query': '2024 US election', 'num_results': '10'}}}}], 'Output': 'output of the function call'}}], 'Type': 'Action'}}}}
-
-            The format of the citation becomes `[google_search](query: '2024 US election', num_results: '10')`
-
-            Ensure that the citations are properly formatted as clickable links in Markdown.
-
-            If the context and function call responses do not contain enough information to answer the question, politely inform the user of this limitation.
-
-            ---
-
-            **Question:**
-
-            {query}
-
-            ---
-
-            **Context:**
-
-            {context_str}
-
-            ---
-
-            **Instructions:**
-
-            - Provide a clear and concise answer to the question.
-            - Do not include any information that is not in the provided context or function call responses.
-            - If the answer cannot be found in the context or function call responses, state that the information is not available.
-            - **Every time** you use information from the context or function call responses, include an inline citation immediately after the information.
-            - Always prioritize the most recent information if there are conflicting information from the context or function call responses.
-
-            **Example:**
-
-            "According to [Resume.pdf](user_data/Candidate/Resume.pdf)(page 1), ..."
-
-            "As provided by [Function Name], ..."
-
-            **Citation Format requirement:**
-            - Citation Format: `[Document Name](URL)(page X)`
-            - Place citation IMMEDIATELY after used information
-            - Use metadata from the context to get the right page number
-                
-            **Validation:**
-            - Don't cite Document Name that does not have a page number.
-            - Double check if you have cited the correct document.
-
-            ---
-
-            **Answer:**
-            """
+            # History is sent as chat turns rather than one flattened system string, so
+            # earlier turns keep identical segments (and token ids) from turn to turn
+            history_messages = [
+                {"role": message.get("role", "user"), "content": str(message.get("content", ""))}
+                for message in (history_messages or [])
+            ]
 
+            # Prepare context string within the context token budget, or reuse it
+            context_cache_key = context_key(context) if context else None
+            cached_context = self._prepare_context(context, context_cache_key, query)
+            if cached_context is not None:
+                logger.info(f"context_Str: {cached_context.prepared.text}")
 
-            user_message = user_message if context else query
+            # The fixed citation instructions and then the context go in their own system
+            # messages ahead of the history and question, so requests over the same
+            # documents share the KV blocks of the whole prefix through the prefix cache
+            # The question template is tokenized once; only the query is tokenized per request
+            user_message = (
+                self.prompt_templates.render("question", query=query).message("user")
+                if context else {"role": "user", "content": query}
+            )
             messages = [
                 {"role": "system", "content": agentic_prompt},
-                {"role": "system", "content": f"Message history: {history_messages}"},
-                # {"role": "system", "content": f"Context Information: {context}"},
-                {"role": "user", "content": user_message}
+                *([{"role": "system", "content": citation_prompt}] if context else []),
+                *([self._context_message(cached_context.prepared.text)] if cached_context is not None else []),
+                *history_messages,
+                user_message
             ]
-            logger.info(f"Generating text for messages: {messages}")
-
-            # Prepare inputs using tokenizer
-            input_ids = self.tokenizer.apply_chat_template(
-                messages, 
-                add_generation_prompt=True, 
-                return_tensors="pt", 
-                return_dict=True
+            logger.info(f"Generating text for messages: {[{key: value for key, value in message.items() if key != 'token_ids'} for message in messages]}")
+
+            # A follow-up turn of a known session appends only the new user turn to the
+            # previous turn's exact tokens, whose KV blocks are pinned in the prefix cache
+            prompt_ids = None
+            session = self.sessions.get(session_id) if session_id else None
+            if session is not None and session.matches(history_messages, bool(context), context_cache_key):
+                continuation_ids = self.prompt_tokenizer.encode_continuation(messages[-1:])
+                if continuation_ids is not None:
+                    prompt_ids = session.token_ids + continuation_ids
+
+            # Prepare inputs using the segment-cached tokenizer
+            if prompt_ids is None:
+                pretokenized = (
+                    {cached_context.segment_text: cached_context.segment_ids}
+                    if cached_context is not None and cached_context.segment_text is not None else None
+                )
+                prompt_ids = self.prompt_tokenizer.encode(messages, pretokenized=pretokenized)
+
+            # The prompt is tokenized before waiting, so the slot scheduler knows the request's cost
+            model_instance = await self.get_free_model(
+                timeout=self.admission.resolve_deadline(timeout),
+                tenant=tenant,
+                priority=priority,
+                cost=len(prompt_ids) + max_new_tokens,
+                ticket=ticket
             )
-            inputs = {k: v.to(model_instance['model'].device) for k, v in input_ids.items()}
-            streamer = TextIteratorStreamer(
+            # The scheduler only pushes generated tokens, so there is no prompt to skip
+            streamer = AsyncTextStreamer(
                 self.tokenizer, 
-                skip_prompt=True, 
+                skip_prompt=False, 
+                flush_tokens=self.stream_flush_tokens,
+                flush_interval=self.stream_flush_interval,
                 skip_special_tokens=True
             )
 
-            # Define generation parameters
-            generation_kwargs = {
-                **inputs,
-                'streamer': streamer,
-                'max_new_tokens': max_new_tokens,
-                'temperature': temperature,
-                'top_p': top_p,
-                'do_sample': True,
-                'pad_token_id': self.tokenizer.eos_token_id,
-            }
-
-            # Start model generation in a separate thread
-            generation_thread = threading.Thread(
-                target=model_instance['model'].generate, 
-                kwargs=generation_kwargs
+            # Join the instance's running decode batch
+            sequence = model_instance['scheduler'].submit(
+                prompt_ids=prompt_ids,
+                streamer=streamer,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                pin_blocks=bool(session_id),
+                num_draft_tokens=self.num_draft_tokens if speculative else 0
             )
-            generation_thread.start()
-            logger.debug(f"Started generation thread on {model_instance['device']}")
-
-            loop = asyncio.get_event_loop()
-
-            # Define a synchronous function to get the next chunk
-            def get_next_chunk():
-                try:
-                    return next(streamer)
-                except StopIteration:
-                    return None  # Indicate the end of the stream
+            logger.debug(f"Submitted sequence {sequence.seq_id} on {model_instance['device']}")
 
-            token_count = 0
             start_time = time_module.perf_counter()
 
             # Stream response using an asynchronous generator
-            while True:
-                next_text = await loop.run_in_executor(None, get_next_chunk)
-                if next_text is None:
-                    break
+            answer_parts = []
+            async for next_text in streamer:
+                answer_parts.append(next_text)
                 yield f"data: {next_text}\n\n"  # SSE format
-                token_count += 1
 
-            # Ensure the generation thread has finished
-            generation_thread.join()
+            if sequence.error is not None:
+                raise sequence.error
+            token_count = len(sequence.output_ids)
 
-            # Cleanup
-            del input_ids
-            del inputs
-            del streamer
-            del generation_thread
+            if session_id:
+                # The client's next history holds this turn's question and answer
+                self._update_session(
+                    session_id, model_instance, sequence,
+                    history_messages=[
+                        *history_messages,
+                        {"role": "user", "content": query},
+                        {"role": "assistant", "content": "".join(answer_parts)}
+                    ],
+                    with_citation=bool(context),
+                    context_key=context_cache_key
+                )
 
-            # Force garbage collection
-            gc.collect()
-            torch.cuda.empty_cache()
+            # Cleanup. Garbage collection runs in the background MemoryMaintainer
+            del prompt_ids
+            del streamer
 
             # Compute metrics
             end_time = time_module.perf_counter()
             latency = end_time - start_time
             tokens_per_second = token_count / latency if latency > 0 else 0
+            self.admission.record_completion(token_count, latency)
 
             # Create metrics dict
             metrics = {
                 "metrics": {
                     "latency": latency,
                     "tokens": token_count,
-                    "tokens_per_second": tokens_per_second
+                    "tokens_per_second": tokens_per_second,
+                    "prompt_tokens": len(sequence.prompt_ids),
+                    "cached_prompt_tokens": sequence.cached_tokens
                 }
             }
+            if cached_context is not None:
+                metrics["metrics"]["context"] = cached_context.prepared.get_stats()
+            if speculative:
+                metrics["metrics"]["speculative"] = {
+                    "verify_steps": sequence.verify_steps,
+                    "draft_tokens": sequence.draft_tokens,
+                    "accepted_tokens": sequence.accepted_tokens,
+                    "acceptance_rate": (
+                        sequence.accepted_tokens / sequence.draft_tokens if sequence.draft_tokens else 0.0
+                    )
+                }
 
             # Send metrics as a JSON string
             yield f"data: {json.dumps(metrics)}\n\n"
-        except asyncio.CancelledError:
+        except (asyncio.CancelledError, GeneratorExit):
             logger.info("Client disconnected. Releasing model instance.")
+            if sequence is not None:
+                model_instance['scheduler'].cancel(sequence)
+            if session_id:
+                self.sessions.discard(session_id)
             raise  # Ensures the finally block executes
         except HTTPException as he:
             # Re-raise HTTP exceptions to be handled by FastAPI
@@ -314,5 +1128,6 @@ class ParallelModelPool:
             logger.error(f"Generation error: {e}")
             raise HTTPException(500, f"Generation error: {e}")
         finally:
-            # Release the model instance back to the queue regardless of success or failure
-            await self.release_model(model_instance)
+            # Release the model instance back to the slot scheduler regardless of success or failure
+            if model_instance is not None:
+                await self.release_model(model_instance)
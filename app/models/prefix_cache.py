@@ -0,0 +1,157 @@
+# app/models/prefix_cache.py
+import hashlib
+import logging
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+from app.models.kv_cache import PagedKVCache
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixCache:
+    """
+    Keeps the KV blocks of previously seen prompt prefixes for reuse.
+
+    Every full block of a prompt is keyed by a chained hash of all token ids up to
+    and including that block, so a lookup walks the prompt block by block and stops
+    at the first miss. The hash is a 128-bit BLAKE2b digest, since a collision would
+    hand a sequence the keys and values of a different prompt. Matched blocks are
+    shared with the new sequence through the reference counts of the `PagedKVCache`,
+    which means the shared system prompt and instruction blocks are prefilled once
+    instead of on every request.
+
+    Blocks that no running sequence references stay cached and are evicted in LRU
+    order, either when the cache needs free blocks or when more than
+    `max_cached_blocks` blocks are cached.
+    """
+    def __init__(self, kv_cache: PagedKVCache, max_cached_blocks: int = 512):
+        """
+        Attaches the prefix cache to a paged KV cache.
+
+        Args:
+            kv_cache (PagedKVCache): Cache whose blocks are shared.
+            max_cached_blocks (int): Memory budget in blocks for cached prefixes.
+        """
+        self.kv_cache = kv_cache
+        self.block_size = kv_cache.block_size
+        self.max_cached_blocks = max_cached_blocks
+
+        self.blocks: Dict[bytes, int] = {}        # prefix hash -> block id
+        self.block_hashes: Dict[int, bytes] = {}  # block id -> prefix hash
+        # Cached blocks without references, least recently released first
+        self.evictable: "OrderedDict[int, None]" = OrderedDict()
+        # Last stats snapshot taken by the scheduler thread, see `publish_stats`
+        self.published_stats: Optional[dict] = None
+
+        self.stats = {
+            "queries": 0,
+            "query_tokens": 0,
+            "hit_tokens": 0,
+            "evictions": 0,
+        }
+        kv_cache.prefix_cache = self
+
+    def _prefix_hashes(self, token_ids: Sequence[int], num_blocks: int) -> List[bytes]:
+        hashes = []
+        parent = b""
+        for i in range(num_blocks):
+            block_tokens = array("q", token_ids[i * self.block_size:(i + 1) * self.block_size])
+            parent = hashlib.blake2b(parent + block_tokens.tobytes(), digest_size=16).digest()
+            hashes.append(parent)
+        return hashes
+
+    def match(self, token_ids: Sequence[int]) -> List[int]:
+        """
+        Finds the cached blocks covering the longest block-aligned prefix of `token_ids`.
+        At least one token is always left uncached so the caller gets logits for it.
+
+        Returns:
+            List[int]: Block ids, in order, to pass to `PagedKVCache.allocate`.
+        """
+        usable_blocks = (len(token_ids) - 1) // self.block_size
+        matched = []
+        for prefix_hash in self._prefix_hashes(token_ids, usable_blocks):
+            block = self.blocks.get(prefix_hash)
+            if block is None:
+                break
+            matched.append(block)
+
+        self.stats["queries"] += 1
+        self.stats["query_tokens"] += len(token_ids)
+        self.stats["hit_tokens"] += len(matched) * self.block_size
+        return matched
+
+    def insert(self, token_ids: Sequence[int], blocks: Sequence[int]):
+        """
+        Registers the full blocks of a sequence whose keys and values are written.
+
+        Args:
+            token_ids (Sequence[int]): Tokens stored in `blocks`, starting at position 0.
+            blocks (Sequence[int]): Page table of the sequence.
+        """
+        num_blocks = min(len(blocks), len(token_ids) // self.block_size)
+        for prefix_hash, block in zip(self._prefix_hashes(token_ids, num_blocks), blocks):
+            if prefix_hash in self.blocks or block in self.block_hashes:
+                continue
+            if len(self.block_hashes) >= self.max_cached_blocks and not self.evict(1):
+                break
+            self.blocks[prefix_hash] = block
+            self.block_hashes[block] = prefix_hash
+
+    def holds(self, block: int) -> bool:
+        return block in self.block_hashes
+
+    def acquire(self, block: int):
+        """
+        Called when a cached block gains a reference; it can no longer be evicted.
+        """
+        self.evictable.pop(block, None)
+
+    def mark_evictable(self, block: int):
+        """
+        Called when the last reference to a cached block is dropped.
+        """
+        self.evictable[block] = None
+        self.evictable.move_to_end(block)
+        while len(self.block_hashes) > self.max_cached_blocks and self.evictable:
+            self.evict(1)
+
+    def num_evictable(self) -> int:
+        return len(self.evictable)
+
+    def evict(self, num_blocks: int) -> int:
+        """
+        Returns up to `num_blocks` least recently used, unreferenced blocks to the free list.
+
+        Returns:
+            int: Number of blocks evicted.
+        """
+        evicted = 0
+        while evicted < num_blocks and self.evictable:
+            block, _ = self.evictable.popitem(last=False)
+            del self.blocks[self.block_hashes.pop(block)]
+            self.kv_cache.free_blocks.append(block)
+            evicted += 1
+        self.stats["evictions"] += evicted
+        return evicted
+
+    def publish_stats(self):
+        """Takes a stats snapshot for other threads, see `PagedKVCache.publish_stats`."""
+        self.published_stats = self._collect_stats()
+
+    def get_stats(self) -> dict:
+        stats = self.published_stats
+        return stats if stats is not None else self._collect_stats()
+
+    def _collect_stats(self) -> dict:
+        query_tokens = self.stats["query_tokens"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hit_tokens"] / query_tokens if query_tokens else 0.0,
+            "cached_blocks": len(self.block_hashes),
+            "evictable_blocks": len(self.evictable),
+            "max_cached_blocks": self.max_cached_blocks,
+            "cached_bytes": len(self.block_hashes) * self.kv_cache.block_bytes,
+        }
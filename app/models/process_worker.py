@@ -0,0 +1,637 @@
+# app/models/process_worker.py
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from app.models.batch_scheduler import ContinuousBatchScheduler
+from app.models.json_constraint import JSONGrammarCache, TokenVocabulary
+from app.models.kv_cache import PagedKVCache
+from app.models.prefix_cache import PrefixCache
+from app.models.quantization import quantize_model, weight_bytes
+from app.utils.memory_maintenance import current_rss_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def worker_cores(index: int, num_workers: int) -> Optional[List[int]]:
+    """
+    Splits the cores this process may run on into equal groups, one per worker.
+
+    Args:
+        index (int): Index of the worker. Indexes beyond `num_workers` wrap around.
+        num_workers (int): Number of workers sharing the cores.
+
+    Returns:
+        Optional[List[int]]: Core ids for the worker, or None if affinity is not supported.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // max(1, num_workers))
+    num_groups = max(1, len(cores) // per_worker)
+    start = (index % num_groups) * per_worker
+    return cores[start:start + per_worker]
+
+
+class _Channel:
+    """
+    Pipe end shared by the threads of a process. `Connection.send` is not thread-safe.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            self.conn.send(message)
+
+
+class _PipeStreamer:
+    """
+    Worker-side streamer that forwards the tokens of one sequence to the parent process.
+    """
+    def __init__(self, channel: _Channel, request_id: int, sequences: Dict[int, Any]):
+        self.channel = channel
+        self.request_id = request_id
+        self.sequences = sequences
+        self.sequence = None
+        # Held while the sequence is submitted, so `end` always sees it
+        self.lock = threading.Lock()
+
+    def put(self, value: torch.Tensor):
+        self.channel.send(("tokens", self.request_id, value.tolist()))
+
+    def end(self):
+        with self.lock:
+            seq = self.sequence
+        self.sequences.pop(self.request_id, None)
+        self.channel.send(("end", self.request_id, {
+            "output_ids": seq.output_ids,
+            "cached_tokens": seq.cached_tokens,
+            "pinned_blocks": seq.pinned_blocks,
+            "verify_steps": seq.verify_steps,
+            "draft_tokens": seq.draft_tokens,
+            "accepted_tokens": seq.accepted_tokens,
+            "error": _error_text(seq.error) if seq.error is not None else None,
+        }))
+
+
+def _error_text(error: BaseException) -> str:
+    return f"{type(error).__name__}: {error}"
+
+
+class _ParentReclaim:
+    """
+    `reclaim_blocks` hook of the worker's scheduler. The session store that pins
+    blocks lives in the parent, so the hook asks the parent to drop sessions and
+    waits for its answer.
+
+    The scheduler calls the hook with its condition held, so the `release_blocks`
+    commands the parent sends meanwhile are handed to the waiting call instead of
+    to `ContinuousBatchScheduler.release_blocks`, which would block on it.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, channel: _Channel, scheduler: ContinuousBatchScheduler, timeout: float = 5.0):
+        self.channel = channel
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._replied = threading.Event()
+        self._request_id: Optional[int] = None
+        self._blocks: Optional[List[List[int]]] = None
+
+    def __call__(self, num_blocks: int) -> int:
+        with self._lock:
+            self._request_id = next(self._ids)
+            self._blocks = []
+            self._replied.clear()
+        try:
+            self.channel.send(("reclaim", self._request_id, num_blocks))
+            if not self._replied.wait(self.timeout):
+                logger.warning(f"Parent did not answer a request for {num_blocks} KV blocks in {self.timeout}s")
+        finally:
+            with self._lock:
+                blocks, self._blocks = self._blocks, None
+        for released in blocks:
+            self.scheduler.release_blocks(released)
+        return sum(len(released) for released in blocks)
+
+    def deliver(self, blocks: List[int]) -> bool:
+        """Takes released blocks if a reclaim is waiting for them."""
+        with self._lock:
+            if self._blocks is None:
+                return False
+            self._blocks.append(blocks)
+            return True
+
+    def reply(self, request_id: int):
+        """The parent has sent every block it released for the request."""
+        with self._lock:
+            if request_id == self._request_id:
+                self._replied.set()
+
+
+class _WorkerCommands:
+    """
+    Serves the parent's commands in a worker process.
+
+    Constrained sequences are compiled and submitted on a helper thread, which
+    also builds the grammars from the vocabulary sent at start-up, so neither
+    holds up cancels and released blocks. It is a single thread, so the grammars
+    are built before any schema is compiled.
+    """
+    def __init__(
+        self,
+        channel: _Channel,
+        scheduler: ContinuousBatchScheduler,
+        name: str,
+        vocabulary: Optional[Dict[str, Any]] = None
+    ):
+        self.channel = channel
+        self.scheduler = scheduler
+        self.sequences: Dict[int, Any] = {}
+        # Constrained sequences not submitted yet, and those of them already cancelled
+        self.compiling: Set[int] = set()
+        self.cancelled: Set[int] = set()
+        self._lock = threading.Lock()
+        self.grammars: Optional[JSONGrammarCache] = None
+        self._grammar_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-grammars")
+        self.reclaim = _ParentReclaim(channel, scheduler)
+        scheduler.reclaim_blocks = self.reclaim
+        if vocabulary is not None:
+            self._grammar_thread.submit(self._build_grammars, vocabulary)
+
+    def handle(self, command: str, request_id: Optional[int], payload) -> bool:
+        """
+        Runs one command.
+
+        Returns:
+            bool: False once the worker should stop.
+        """
+        if command == "submit":
+            json_schema = payload.pop("json_schema", None)
+            if json_schema is None:
+                self._submit(request_id, payload)
+            else:
+                with self._lock:
+                    self.compiling.add(request_id)
+                self._grammar_thread.submit(self._submit_constrained, request_id, payload, json_schema)
+        elif command == "cancel":
+            with self._lock:
+                seq = self.sequences.get(request_id)
+                if seq is None and request_id in self.compiling:
+                    self.cancelled.add(request_id)
+            if seq is not None:
+                self.scheduler.cancel(seq)
+        elif command == "release_blocks":
+            if not self.reclaim.deliver(payload):
+                self.scheduler.release_blocks(payload)
+        elif command == "reclaimed":
+            self.reclaim.reply(request_id)
+        elif command == "stop":
+            return False
+        return True
+
+    def fail(self, request_id: int, error: BaseException):
+        """Ends a request that never reached the scheduler."""
+        try:
+            self.channel.send(("end", request_id, {
+                "output_ids": [],
+                "cached_tokens": 0,
+                "pinned_blocks": [],
+                "verify_steps": 0,
+                "draft_tokens": 0,
+                "accepted_tokens": 0,
+                "error": _error_text(error),
+            }))
+        except Exception as e:
+            logger.error(f"Could not report failed request {request_id}: {e}")
+
+    def close(self):
+        self._grammar_thread.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, request_id: int, payload: Dict[str, Any]):
+        streamer = _PipeStreamer(self.channel, request_id, self.sequences)
+        with streamer.lock:
+            streamer.sequence = self.scheduler.submit(streamer=streamer, **payload)
+            self.sequences[request_id] = streamer.sequence
+        return streamer.sequence
+
+    def _submit_constrained(self, request_id: int, payload: Dict[str, Any], json_schema: dict):
+        seq = None
+        try:
+            if self.grammars is not None:
+                payload["constraint"] = self.grammars.constraint(json_schema)
+            else:
+                logger.warning("Constrained decoding unavailable, generating unconstrained")
+            seq = self._submit(request_id, payload)
+        except Exception as e:
+            logger.error(f"Constrained request {request_id} failed: {_error_text(e)}")
+            self.fail(request_id, e)
+        finally:
+            with self._lock:
+                self.compiling.discard(request_id)
+                cancelled = request_id in self.cancelled
+                self.cancelled.discard(request_id)
+        if seq is not None and cancelled:
+            self.scheduler.cancel(seq)
+
+    def _build_grammars(self, vocabulary: Dict[str, Any]):
+        try:
+            grammars = JSONGrammarCache(TokenVocabulary(vocabulary["texts"], vocabulary["eos_token_ids"]))
+            grammars.warm_up(vocabulary["schemas"])
+            self.grammars = grammars
+        except Exception as e:
+            logger.error(f"JSON grammar vocabulary could not be built: {_error_text(e)}")
+
+
+def _worker_stats(
+    scheduler: ContinuousBatchScheduler,
+    kv_cache: PagedKVCache,
+    prefix_cache,
+    grammars: Optional[JSONGrammarCache] = None
+) -> dict:
+    return {
+        "scheduler": {**scheduler.get_stats(), "rss_bytes": current_rss_bytes()},
+        "kv_cache": kv_cache.get_stats(),
+        "prefix_cache": prefix_cache.get_stats() if prefix_cache is not None else None,
+        "json_constraints": grammars.get_stats() if grammars is not None else None,
+    }
+
+
+def _worker_main(conn, config: Dict[str, Any]):
+    """
+    Entry point of a worker process: pins itself to its cores, loads the weights,
+    runs a `ContinuousBatchScheduler` and serves commands from the parent until stopped.
+    """
+    channel = _Channel(conn)
+    try:
+        if config["cores"] and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, config["cores"])
+        torch.set_num_threads(config["num_threads"])
+
+        start = time_module.perf_counter()
+        model = AutoModelForCausalLM.from_pretrained(config["model_path"], **config["load_kwargs"]).to(config["device"])
+        model.eval()
+        model.requires_grad_(False)
+        model = quantize_model(model, config["quantization"])
+
+        eos = model.generation_config.eos_token_id
+        eos_ids = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+        eos_ids.update(config["extra_eos_token_ids"])
+
+        kv_cache = PagedKVCache.for_model(
+            model,
+            block_size=config["kv_block_size"],
+            max_blocks=config["kv_cache_max_blocks"]
+        )
+        prefix_cache = (
+            PrefixCache(kv_cache, config["prefix_cache_max_blocks"]) if config["prefix_cache_max_blocks"] > 0 else None
+        )
+        scheduler = ContinuousBatchScheduler(
+            model,
+            max_batch_size=config["max_batch_size"],
+            eos_token_ids=eos_ids,
+            kv_cache=kv_cache,
+            name=config["name"],
+            draft_max_ngram=config["draft_max_ngram"]
+        )
+    except Exception as e:
+        channel.send(("failed", None, _error_text(e)))
+        return
+
+    channel.send(("ready", None, {
+        "eos_token_ids": list(eos_ids),
+        "weight_bytes": weight_bytes(model),
+        "load_seconds": time_module.perf_counter() - start,
+        "stats": _worker_stats(scheduler, kv_cache, prefix_cache),
+    }))
+
+    commands = _WorkerCommands(channel, scheduler, config["name"], config["vocabulary"])
+    last_stats = time_module.monotonic()
+    try:
+        while True:
+            if conn.poll(config["stats_interval"]):
+                try:
+                    command, request_id, payload = conn.recv()
+                except EOFError:
+                    # The parent is gone
+                    break
+                # A failed command only fails its own request, the worker keeps serving
+                try:
+                    if not commands.handle(command, request_id, payload):
+                        break
+                except Exception as e:
+                    logger.error(f"Model worker command {command} failed: {_error_text(e)}")
+                    if command == "submit":
+                        commands.fail(request_id, e)
+            if time_module.monotonic() - last_stats >= config["stats_interval"]:
+                last_stats = time_module.monotonic()
+                try:
+                    channel.send(("stats", None, _worker_stats(scheduler, kv_cache, prefix_cache, commands.grammars)))
+                except Exception as e:
+                    logger.error(f"Model worker statistics failed: {_error_text(e)}")
+    finally:
+        commands.close()
+        scheduler.stop()
+
+
+class RemoteSequence:
+    """
+    Parent-side handle of a sequence generated in a worker process. It mirrors the
+    fields of `Sequence` that the pool reads once `done` is set.
+    """
+    def __init__(self, seq_id: int, prompt_ids: List[int], streamer):
+        self.seq_id = seq_id
+        self.prompt_ids = list(prompt_ids)
+        self.streamer = streamer
+        self.output_ids: List[int] = []
+        self.cached_tokens = 0
+        self.pinned_blocks: List[int] = []
+        self.verify_steps = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.error: Optional[Exception] = None
+        self.finished = False
+        self.done = threading.Event()
+
+
+class ProcessWorker:
+    """
+    Runs one model instance in its own process, so tokenization, SSE formatting and
+    the Python side of every instance's decode loop no longer share one GIL.
+
+    The worker is pinned to a group of cores and sets its intra-op thread count to
+    match. Commands go to the worker and generated token ids come back over a pipe;
+    a reader thread feeds them to each sequence's streamer. It exposes the parts of
+    the `ContinuousBatchScheduler` interface the pool uses, so an instance backed by
+    a worker is used like a threaded one.
+    """
+    _ids = itertools.count()
+
+    def __init__(
+        self,
+        model_path: str,
+        load_kwargs: Dict[str, Any],
+        device: str = "cpu",
+        max_batch_size: int = 8,
+        kv_block_size: int = 16,
+        kv_cache_max_blocks: int = 2048,
+        prefix_cache_max_blocks: int = 512,
+        draft_max_ngram: int = 3,
+        quantization: Optional[str] = None,
+        extra_eos_token_ids: Optional[List[int]] = None,
+        vocabulary: Optional[Dict[str, Any]] = None,
+        cores: Optional[List[int]] = None,
+        num_threads: Optional[int] = None,
+        name: str = "model-worker",
+        stats_interval: float = 1.0
+    ):
+        """
+        Starts the worker process and waits until its weights are loaded.
+
+        Args:
+            model_path (str): Path or name of the pretrained model (or its warm snapshot).
+            load_kwargs (Dict[str, Any]): Keyword arguments for `from_pretrained`.
+            device (str): Device the worker places the model on.
+            max_batch_size (int): Number of sequences the worker decodes concurrently.
+            kv_block_size (int): Number of tokens per KV cache block.
+            kv_cache_max_blocks (int): Maximum number of KV cache blocks.
+            prefix_cache_max_blocks (int): KV blocks kept for shared prompt prefixes.
+            draft_max_ngram (int): Longest trailing n-gram looked up for speculative drafts.
+            quantization (Optional[str]): Quantization applied after loading, see `quantize_model`.
+            extra_eos_token_ids (Optional[List[int]]): EOS ids besides the model's, e.g. the tokenizer's.
+            vocabulary (Optional[Dict[str, Any]]): Token `texts`, `eos_token_ids` and `schemas` to
+                                                   precompile, from which the worker builds its JSON
+                                                   grammars. None disables constrained decoding.
+            cores (Optional[List[int]]): Cores the worker is pinned to. None leaves affinity alone.
+            num_threads (Optional[int]): Intra-op threads of the worker. Defaults to one per pinned core.
+            name (str): Name of the worker process.
+            stats_interval (float): Seconds between statistics updates sent by the worker.
+
+        Raises:
+            RuntimeError: If the worker fails to load the model.
+        """
+        self.name = name
+        self.cores = cores
+        self.num_threads = num_threads or (len(cores) if cores else torch.get_num_threads())
+        config = {
+            "model_path": model_path,
+            "load_kwargs": load_kwargs,
+            "device": device,
+            "max_batch_size": max_batch_size,
+            "kv_block_size": kv_block_size,
+            "kv_cache_max_blocks": kv_cache_max_blocks,
+            "prefix_cache_max_blocks": prefix_cache_max_blocks,
+            "draft_max_ngram": draft_max_ngram,
+            "quantization": quantization,
+            "extra_eos_token_ids": list(extra_eos_token_ids or []),
+            "vocabulary": vocabulary,
+            "cores": cores,
+            "num_threads": self.num_threads,
+            "name": f"{name}-scheduler",
+            "stats_interval": stats_interval,
+        }
+
+        # Forking a process that already runs torch threads can deadlock the child
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, config), name=name, daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        try:
+            kind, _, payload = self._conn.recv()
+        except EOFError:
+            kind, payload = "failed", f"exit code {self.process.exitcode}"
+        if kind != "ready":
+            self.process.join(timeout=5)
+            raise RuntimeError(f"Model worker {name} failed to start: {payload}")
+
+        self.eos_token_ids = set(payload["eos_token_ids"])
+        self.weight_bytes = payload["weight_bytes"]
+        self.load_seconds = payload["load_seconds"]
+        self.latest_stats = payload["stats"]
+        self.sequences: Dict[int, RemoteSequence] = {}
+        self._channel = _Channel(self._conn)
+        self._lock = threading.Lock()
+        self._stopped = False
+        # Asks the owner of pinned blocks to hand some back, see `ContinuousBatchScheduler.reclaim_blocks`
+        self.reclaim_blocks: Optional[Callable[[int], int]] = None
+        self._reader = threading.Thread(target=self._read_loop, name=f"{name}-reader", daemon=True)
+        self._reader.start()
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self.process.pid
+
+    @property
+    def stats(self) -> dict:
+        """Scheduler counters last reported by the worker."""
+        return self.latest_stats["scheduler"]
+
+    def submit(
+        self,
+        prompt_ids: List[int],
+        streamer,
+        max_new_tokens: int = 1024,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        pin_blocks: bool = False,
+        num_draft_tokens: int = 0,
+        json_schema: Optional[dict] = None,
+    ) -> RemoteSequence:
+        """
+        Queues a sequence in the worker. See `ContinuousBatchScheduler.submit`.
+
+        Instead of a `JSONConstraint`, a constrained sequence takes the JSON schema,
+        which the worker compiles with its own grammars.
+
+        Returns:
+            RemoteSequence: Handle that can be cancelled and inspected once `done` is set.
+        """
+        seq = RemoteSequence(next(self._ids), prompt_ids, streamer)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Model worker has been stopped")
+            self.sequences[seq.seq_id] = seq
+        self._channel.send(("submit", seq.seq_id, {
+            "prompt_ids": seq.prompt_ids,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "pin_blocks": pin_blocks,
+            "num_draft_tokens": num_draft_tokens,
+            "json_schema": json_schema,
+        }))
+        return seq
+
+    def cancel(self, seq: RemoteSequence):
+        """
+        Cancels a sequence. The worker removes it from its batch on the next step.
+        """
+        if not seq.done.is_set():
+            self._send(("cancel", seq.seq_id, None))
+
+    def release_blocks(self, blocks: List[int]):
+        """
+        Hands back blocks pinned by a finished sequence in the worker.
+        """
+        self._send(("release_blocks", None, blocks))
+
+    def _send(self, message):
+        try:
+            self._channel.send(message)
+        except (BrokenPipeError, OSError) as e:
+            logger.warning(f"Model worker {self.name} is gone: {e}")
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Stops the worker process, ending all of its sequences.
+        """
+        with self._lock:
+            self._stopped = True
+        self._send(("stop", None, None))
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            logger.warning(f"Model worker {self.name} did not stop in {timeout}s, terminating it")
+            self.process.terminate()
+            self.process.join()
+        self._reader.join(timeout=timeout)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "pid": self.pid,
+            "cores": self.cores,
+            "num_threads": self.num_threads,
+        }
+
+    def _read_loop(self):
+        while True:
+            try:
+                kind, request_id, payload = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "tokens":
+                seq = self.sequences.get(request_id)
+                if seq is not None:
+                    for token_id in payload:
+                        seq.streamer.put(torch.tensor([token_id]))
+            elif kind == "end":
+                seq = self.sequences.pop(request_id, None)
+                if seq is not None:
+                    error = payload.pop("error")
+                    for key, value in payload.items():
+                        setattr(seq, key, value)
+                    if error is not None:
+                        seq.error = RuntimeError(error)
+                    self._finish(seq)
+            elif kind == "stats":
+                self.latest_stats = payload
+            elif kind == "reclaim":
+                # Answered off the reader, which must keep draining the worker's messages
+                threading.Thread(
+                    target=self._answer_reclaim, args=(request_id, payload), name=f"{self.name}-reclaim", daemon=True
+                ).start()
+
+        # The worker exited; nothing will finish the sequences still in flight
+        with self._lock:
+            self._stopped = True
+            orphans = list(self.sequences.values())
+            self.sequences.clear()
+        if orphans:
+            logger.error(f"Model worker {self.name} exited with {len(orphans)} sequences in flight")
+        for seq in orphans:
+            seq.error = RuntimeError(f"Model worker {self.name} exited")
+            self._finish(seq)
+
+    def _answer_reclaim(self, request_id: int, num_blocks: int):
+        """
+        Releases pinned blocks the worker's scheduler is short of. They reach the
+        worker as `release_blocks` commands ahead of the answer.
+        """
+        if self.reclaim_blocks is not None:
+            try:
+                self.reclaim_blocks(num_blocks)
+            except Exception as e:
+                logger.warning(f"Could not reclaim pinned KV blocks for model worker {self.name}: {e}")
+        self._send(("reclaimed", request_id, None))
+
+    @staticmethod
+    def _finish(seq: RemoteSequence):
+        seq.finished = True
+        try:
+            seq.streamer.end()
+        finally:
+            seq.done.set()
+
+
+class WorkerStatsView:
+    """
+    Read-only stand-in for the KV or prefix cache of a worker, backed by the
+    statistics the worker reports.
+    """
+    def __init__(self, worker: ProcessWorker, key: str):
+        self.worker = worker
+        self.key = key
+
+    def get_stats(self) -> dict:
+        return self.worker.latest_stats[self.key]
+
+    @property
+    def max_blocks(self) -> int:
+        return self.get_stats()["max_blocks"]
+
+    @property
+    def block_bytes(self) -> int:
+        return self.get_stats()["block_bytes"]
@@ -0,0 +1,159 @@
+# app/models/prompt_templates.py
+import logging
+from string import Template
+from typing import Dict, List, Optional, Tuple, Union
+
+from app.models.prompt_tokenizer import joins_cleanly
+
+logger = logging.getLogger(__name__)
+
+
+class RenderedPrompt:
+    """
+    Text of a rendered template and its token ids. Used as message content, the ids
+    let `PromptTokenizer` skip tokenizing the message.
+    """
+    def __init__(self, text: str, token_ids: List[int]):
+        self.text = text
+        self.token_ids = token_ids
+
+    def message(self, role: str = "user") -> Dict[str, object]:
+        """Chat message carrying the prompt and its token ids."""
+        return {"role": role, "content": self.text, "token_ids": self.token_ids}
+
+
+class CompiledTemplate:
+    """
+    A `string.Template` split into fixed text pieces and named slots.
+
+    The fixed pieces are tokenized once at compile time, so rendering only tokenizes
+    the slot values. Joining the pieces' and values' tokens is only exact where the
+    tokenizer splits at the seam anyway (e.g. at newlines); each seam is probed on
+    render, and if a token would span one the whole text is tokenized instead.
+    Leading and trailing whitespace of the template is dropped, as chat templates
+    trim message content.
+    """
+    def __init__(self, name: str, template: Union[str, Template], tokenizer, **constants: str):
+        """
+        Args:
+            name (str): Name of the template in the registry.
+            template (Union[str, Template]): Template text with `$name` or `${name}` slots.
+            tokenizer: Hugging Face tokenizer of the model.
+            **constants (str): Slot values fixed at compile time, e.g. the function list.
+        """
+        self.name = name
+        self.tokenizer = tokenizer
+        text = template.template if isinstance(template, Template) else template
+
+        # Alternating fixed text and slot names: pieces[0], slots[0], pieces[1], ...
+        pieces: List[str] = []
+        self.slots: List[str] = []
+        current = []
+        position = 0
+        for match in Template.pattern.finditer(text):
+            current.append(text[position:match.start()])
+            position = match.end()
+            if match.group("escaped") is not None:
+                current.append("$")
+                continue
+            slot = match.group("named") or match.group("braced")
+            if slot is None:
+                raise ValueError(f"Invalid placeholder in template {name} at offset {match.start()}")
+            if slot in constants:
+                current.append(str(constants[slot]))
+                continue
+            pieces.append("".join(current))
+            self.slots.append(slot)
+            current = []
+        current.append(text[position:])
+        pieces.append("".join(current))
+        pieces[0] = pieces[0].lstrip()
+        pieces[-1] = pieces[-1].rstrip()
+
+        self.pieces = pieces
+        self.piece_ids = [self._encode(piece) for piece in pieces]
+        self.fixed_tokens = sum(len(ids) for ids in self.piece_ids)
+        self.stats = {
+            "renders": 0,
+            "slot_tokens": 0,
+            "full_tokenizations": 0,
+        }
+
+    def _encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False) if text else []
+
+    def render(self, **values: str) -> RenderedPrompt:
+        """
+        Fills the slots and returns the text with its token ids.
+
+        Raises:
+            KeyError: If a slot has no value.
+        """
+        text_parts = [self.pieces[0]]
+        token_ids = list(self.piece_ids[0])
+        clean = True
+        for slot, piece, piece_ids in zip(self.slots, self.pieces[1:], self.piece_ids[1:]):
+            value = str(values[slot])
+            value_ids = self._encode(value)
+            self.stats["slot_tokens"] += len(value_ids)
+            clean = clean and joins_cleanly(self.tokenizer, text_parts[-1], value or piece) and (
+                not value or joins_cleanly(self.tokenizer, value, piece)
+            )
+            text_parts.extend((value, piece))
+            token_ids.extend(value_ids)
+            token_ids.extend(piece_ids)
+        self.stats["renders"] += 1
+
+        text = "".join(text_parts)
+        if not clean:
+            self.stats["full_tokenizations"] += 1
+            token_ids = self._encode(text)
+        return RenderedPrompt(text, token_ids)
+
+    def get_stats(self) -> dict:
+        renders = self.stats["renders"]
+        return {
+            "slots": self.slots,
+            "fixed_tokens": self.fixed_tokens,
+            "renders": renders,
+            "avg_slot_tokens": self.stats["slot_tokens"] / renders if renders else 0.0,
+            "avg_tokens": self.fixed_tokens + (self.stats["slot_tokens"] / renders if renders else 0.0),
+            "full_tokenizations": self.stats["full_tokenizations"],
+        }
+
+
+class PromptTemplateRegistry:
+    """
+    Named prompt templates compiled against one tokenizer.
+    """
+    def __init__(self, tokenizer, templates: Optional[Dict[str, Tuple[Union[str, Template], Dict[str, str]]]] = None):
+        """
+        Args:
+            tokenizer: Hugging Face tokenizer of the model.
+            templates (Optional[Dict[str, Tuple]]): Name to `(template, constants)` pairs to compile.
+        """
+        self.tokenizer = tokenizer
+        self.templates: Dict[str, CompiledTemplate] = {}
+        for name, (template, constants) in (templates or {}).items():
+            self.register(name, template, **constants)
+
+    def register(self, name: str, template: Union[str, Template], **constants: str) -> CompiledTemplate:
+        """
+        Compiles a template and registers it under `name`, replacing any previous one.
+        """
+        compiled = CompiledTemplate(name, template, self.tokenizer, **constants)
+        self.templates[name] = compiled
+        logger.info(f"Compiled prompt template {name}: {compiled.fixed_tokens} fixed tokens, slots {compiled.slots}")
+        return compiled
+
+    def get(self, name: str) -> CompiledTemplate:
+        return self.templates[name]
+
+    def render(self, name: str, **values: str) -> RenderedPrompt:
+        """
+        Renders a registered template. See `CompiledTemplate.render`.
+        """
+        return self.templates[name].render(**values)
+
+    def get_stats(self) -> dict:
+        return {name: template.get_stats() for name, template in self.templates.items()}
@@ -0,0 +1,269 @@
+# app/models/prompt_tokenizer.py
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Rendered ahead of a message to see the text it adds anywhere after the first position
+_ANCHOR = {"role": "system", "content": ""}
+
+
+def joins_cleanly(tokenizer, left: str, right: str, window: int = 16) -> bool:
+    """
+    Checks whether tokenizing `left + right` yields the tokens of `left` followed by
+    those of `right`, by tokenizing a few characters on each side of the seam.
+    Pre-tokenizers decide splits locally, so the window is enough to see whether
+    a token (e.g. whitespace attached to the next word) would span the seam.
+    """
+    if not left or not right:
+        return True
+    left, right = left[-window:], right[:window]
+    return (
+        tokenizer.encode(left + right, add_special_tokens=False)
+        == tokenizer.encode(left, add_special_tokens=False) + tokenizer.encode(right, add_special_tokens=False)
+    )
+
+
+class PromptTokenizer:
+    """
+    Incremental chat-template tokenizer with a per-segment token cache.
+
+    The text each message adds to the rendered prompt becomes one segment. Segments
+    are tokenized separately and cached by content hash, so on a follow-up turn the
+    system prompt and every earlier message come from the cache and only the new
+    user turn is tokenized. Chat templates delimit messages with special tokens, so
+    the segments tokenize exactly like the full prompt.
+
+    A message's segment is rendered on its own, after a placeholder message, and
+    cached by the message, so a prompt costs one full render of the template to
+    check that the segments add up to it. Templates whose output for a message
+    depends on the rest of the conversation fail that check; their segments come
+    from rendering every message prefix instead, and templates that are not
+    prefix-stable fall back to full tokenization.
+
+    A message may carry the token ids of its content under `token_ids`, e.g. from a
+    compiled prompt template; only the chat markup around it is tokenized then.
+    """
+    def __init__(self, tokenizer, max_entries: int = 4096):
+        """
+        Initializes the tokenizer cache.
+
+        Args:
+            tokenizer: Hugging Face tokenizer with a chat template.
+            max_entries (int): Maximum number of cached segments.
+        """
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.cache: "OrderedDict[bytes, List[int]]" = OrderedDict()
+        # Segment text of a message by (first position, message) digest
+        self.rendered: "OrderedDict[bytes, str]" = OrderedDict()
+        self._anchor_text: Optional[str] = None
+        self.stats = {
+            "prefix_renders": 0,
+            "hits": 0,
+            "misses": 0,
+            "cached_tokens": 0,
+            "encoded_tokens": 0,
+            "fallbacks": 0,
+            "pretokenized_tokens": 0,
+        }
+
+    def _render(self, messages: List[Dict[str, str]], add_generation_prompt: bool) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages,
+            add_generation_prompt=add_generation_prompt,
+            tokenize=False
+        )
+
+    def _message_segment(self, message: Dict[str, str], first: bool) -> str:
+        """
+        Text a message adds to the rendered prompt, rendered without the rest of the conversation.
+        """
+        fields = {name: value for name, value in message.items() if name != "token_ids"}
+        key = hashlib.blake2b(
+            json.dumps([first, fields], sort_keys=True, default=str).encode("utf-8"), digest_size=16
+        ).digest()
+        segment = self.rendered.get(key)
+        if segment is not None:
+            self.rendered.move_to_end(key)
+            return segment
+
+        if first:
+            segment = self._render([message], add_generation_prompt=False)
+        else:
+            if self._anchor_text is None:
+                self._anchor_text = self._render([_ANCHOR], add_generation_prompt=False)
+            text = self._render([_ANCHOR, message], add_generation_prompt=False)
+            if not text.startswith(self._anchor_text):
+                raise ValueError("Chat template is not prefix-stable")
+            segment = text[len(self._anchor_text):]
+        self.rendered[key] = segment
+        if len(self.rendered) > self.max_entries:
+            self.rendered.popitem(last=False)
+        return segment
+
+    def segments(self, messages: List[Dict[str, str]]) -> Optional[List[str]]:
+        """
+        Splits the rendered prompt into one text segment per message plus the generation prompt.
+
+        Returns:
+            Optional[List[str]]: The segments, or None if the template is not prefix-stable.
+        """
+        text = self._render(messages, add_generation_prompt=True)
+        try:
+            segments = [self._message_segment(message, index == 0) for index, message in enumerate(messages)]
+        except Exception as e:
+            # E.g. templates that only accept alternating roles
+            logger.debug(f"Chat template rejected a message rendered on its own: {e}")
+            segments = None
+        if segments is not None:
+            joined = "".join(segments)
+            if text.startswith(joined):
+                return [*segments, text[len(joined):]]
+        return self._prefix_segments(messages, text)
+
+    def _prefix_segments(self, messages: List[Dict[str, str]], text: str) -> Optional[List[str]]:
+        """
+        Segments from rendering every message prefix, for templates that render a
+        message differently depending on the rest of the conversation.
+        """
+        self.stats["prefix_renders"] += 1
+        segments = []
+        previous = ""
+        for end in range(1, len(messages) + 1):
+            rendered = self._render(messages[:end], add_generation_prompt=False)
+            if not rendered.startswith(previous):
+                return None
+            segments.append(rendered[len(previous):])
+            previous = rendered
+
+        if not text.startswith(previous):
+            return None
+        segments.append(text[len(previous):])
+        return segments
+
+    def encode_segment(self, text: str) -> List[int]:
+        """
+        Tokenizes one segment, serving repeated segments from the LRU cache.
+        """
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        token_ids = self.cache.get(key)
+        if token_ids is not None:
+            self.cache.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["cached_tokens"] += len(token_ids)
+            return token_ids
+
+        token_ids = self.tokenizer.encode(text, add_special_tokens=False)
+        self.cache[key] = token_ids
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        self.stats["misses"] += 1
+        self.stats["encoded_tokens"] += len(token_ids)
+        return token_ids
+
+    def encode(self, messages: List[Dict[str, str]], pretokenized: Optional[Dict[str, List[int]]] = None) -> List[int]:
+        """
+        Tokenizes a conversation with the generation prompt appended.
+
+        Args:
+            messages (List[Dict[str, str]]): Chat messages with `role` and `content`.
+            pretokenized (Optional[Dict[str, List[int]]]): Token ids of segments tokenized
+                                                           elsewhere, by segment text. They
+                                                           bypass the segment cache.
+
+        Returns:
+            List[int]: Prompt token ids.
+        """
+        segments = self.segments(messages)
+        if segments is None:
+            self.stats["fallbacks"] += 1
+            return self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True)
+
+        token_ids = []
+        for segment, message in zip(segments, [*messages, None]):
+            segment_ids = pretokenized.get(segment) if pretokenized else None
+            if segment_ids is not None:
+                self.stats["pretokenized_tokens"] += len(segment_ids)
+                token_ids.extend(segment_ids)
+            else:
+                token_ids.extend(self._encode_message_segment(segment, message))
+        return token_ids
+
+    def _encode_message_segment(self, segment: str, message: Optional[Dict]) -> List[int]:
+        """
+        Tokenizes the segment of a message, reusing the token ids of its content if it carries them.
+        """
+        content_ids = message.get("token_ids") if message else None
+        content = message.get("content") if message else None
+        start = segment.find(content) if content_ids is not None and content else -1
+        if start < 0:
+            # No ids, or the chat template rewrote the content
+            return self.encode_segment(segment)
+        prefix, suffix = segment[:start], segment[start + len(content):]
+        if not (joins_cleanly(self.tokenizer, prefix, content) and joins_cleanly(self.tokenizer, content, suffix)):
+            # A token would span the markup and the content with this tokenizer
+            return self.encode_segment(segment)
+
+        self.stats["pretokenized_tokens"] += len(content_ids)
+        # The role header and end-of-turn markup are the same for every message, so they hit the cache
+        return [
+            *(self.encode_segment(prefix) if prefix else []),
+            *content_ids,
+            *(self.encode_segment(suffix) if suffix else []),
+        ]
+
+    def encode_message(self, message: Dict[str, str]) -> Optional[Tuple[str, List[int]]]:
+        """
+        Renders and tokenizes the segment of one message as it appears anywhere after
+        the first message, without storing it in the segment cache. Meant for large
+        messages cached elsewhere, e.g. by the context cache.
+
+        Returns:
+            Optional[Tuple[str, List[int]]]: Segment text and token ids, or None if the
+                                             template cannot be split this way.
+        """
+        try:
+            segments = self.segments([{"role": "system", "content": ""}, message])
+        except Exception as e:
+            logger.debug(f"Chat template rejected message segment: {e}")
+            return None
+        if segments is None:
+            return None
+        return segments[1], self.tokenizer.encode(segments[1], add_special_tokens=False)
+
+    def encode_continuation(self, messages: List[Dict[str, str]]) -> Optional[List[int]]:
+        """
+        Tokenizes messages appended to an existing conversation, plus the generation prompt.
+
+        The segments are rendered after a placeholder system message, since chat
+        templates usually format the first message differently from the rest.
+
+        Returns:
+            Optional[List[int]]: Token ids, or None if the template cannot be split this way.
+        """
+        try:
+            segments = self.segments([{"role": "system", "content": ""}, *messages])
+        except Exception as e:
+            logger.debug(f"Chat template rejected continuation: {e}")
+            return None
+        if segments is None:
+            return None
+
+        token_ids = []
+        for segment, message in zip(segments[1:], [*messages, None]):
+            token_ids.extend(self._encode_message_segment(segment, message))
+        return token_ids
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.cache),
+            "rendered_entries": len(self.rendered),
+            "max_entries": self.max_entries,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+        }
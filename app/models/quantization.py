@@ -0,0 +1,104 @@
+# app/models/quantization.py
+import logging
+from typing import Iterable, Optional
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+# "int8-dynamic": int8 weights and activations quantized on the fly (CPU only, fp32 models)
+# "int8-weight":  int8 weights dequantized per forward pass, any device and dtype
+QUANTIZATION_MODES = ("int8-dynamic", "int8-weight")
+
+
+class WeightOnlyInt8Linear(nn.Module):
+    """
+    Linear layer storing its weight as int8 with one scale per output channel.
+
+    The weight is dequantized for every forward pass, so it trades some speed for
+    a quarter of the fp32 weight memory.
+    """
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        weight = linear.weight.detach()
+        scale = weight.abs().amax(dim=1, keepdim=True).float().clamp(min=1e-8) / 127
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.register_buffer("weight_int8", torch.round(weight.float() / scale).to(torch.int8))
+        self.register_buffer("scale", scale.to(weight.dtype))
+        self.register_buffer("bias", linear.bias.detach() if linear.bias is not None else None)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        weight = self.weight_int8.to(x.dtype) * self.scale
+        return nn.functional.linear(x, weight, self.bias)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}"
+
+
+def load_dtype(quantization: Optional[str], device: str, dtype: torch.dtype) -> torch.dtype:
+    """
+    Returns the dtype to load the weights in before quantizing them.
+
+    Dynamic int8 quantization only takes fp32 weights, and fp16 matmuls are slow on
+    most CPUs, so quantized CPU models are loaded in fp32.
+    """
+    if quantization and device.startswith("cpu") and dtype != torch.float32:
+        return torch.float32
+    return dtype
+
+
+def quantize_model(model: nn.Module, quantization: Optional[str], skip_modules: Iterable[str] = ("lm_head",)) -> nn.Module:
+    """
+    Quantizes the linear layers of a loaded model in place.
+
+    Args:
+        model: The model, already on its target device.
+        quantization (Optional[str]): One of `QUANTIZATION_MODES`, or None to leave it unchanged.
+        skip_modules (Iterable[str]): Names of linear layers kept in full precision. The
+                                      output projection decides every sampled token and is
+                                      the most sensitive to rounding.
+
+    Returns:
+        nn.Module: The quantized model.
+
+    Raises:
+        ValueError: If the mode is unknown or not supported for the model's device.
+    """
+    if not quantization:
+        return model
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {quantization}")
+
+    skip_modules = set(skip_modules)
+    names = [
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name.rsplit(".", 1)[-1] not in skip_modules
+    ]
+    if quantization == "int8-dynamic":
+        if model.device.type != "cpu":
+            raise ValueError("int8-dynamic quantization is only supported on the CPU")
+        model = torch.ao.quantization.quantize_dynamic(model, set(names), dtype=torch.qint8, inplace=True)
+    else:
+        for name in names:
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(parent, child_name, WeightOnlyInt8Linear(getattr(parent, child_name)))
+    logger.info(f"Quantized {len(names)} linear layers ({quantization})")
+    return model
+
+
+def weight_bytes(model: nn.Module) -> int:
+    """
+    Bytes held by a model's weights, including packed dynamic-quantized ones that are
+    neither parameters nor buffers.
+    """
+    total = sum(p.numel() * p.element_size() for p in model.parameters())
+    total += sum(b.numel() * b.element_size() for b in model.buffers())
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = module._weight_bias()
+            total += weight.numel() * weight.element_size()
+            total += bias.numel() * bias.element_size() if bias is not None else 0
+    return total
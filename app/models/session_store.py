@@ -0,0 +1,222 @@
+# app/models/session_store.py
+import hashlib
+import json
+import logging
+import threading
+import time as time_module
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def history_digest(history_messages: List[Dict[str, str]]) -> str:
+    """
+    Digest of a conversation's roles and (whitespace-stripped) contents, so two
+    histories match only if every message of them does.
+    """
+    canonical = json.dumps(
+        [[message.get("role", "user"), str(message.get("content", "")).strip()] for message in history_messages],
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class SessionState:
+    """
+    Token-level state of a conversation after its last completed turn.
+    """
+    def __init__(
+        self,
+        token_ids: List[int],
+        history_messages: List[Dict[str, str]],
+        with_citation: bool,
+        scheduler=None,
+        pinned_blocks: Optional[List[int]] = None,
+        context_key: Optional[str] = None,
+    ):
+        """
+        Args:
+            token_ids (List[int]): Prompt and generated tokens of the last turn, ending with EOS.
+            history_messages (List[Dict[str, str]]): The history the client sends on the next turn:
+                                                     the last turn's history, question and answer.
+            with_citation (bool): Whether the prompt carried the citation instructions.
+            scheduler: Scheduler holding `pinned_blocks`.
+            pinned_blocks (Optional[List[int]]): KV blocks kept referenced for this session.
+            context_key (Optional[str]): Content address of the context message in the prompt.
+        """
+        self.token_ids = token_ids
+        self.num_messages = len(history_messages)
+        self.history_digest = history_digest(history_messages)
+        self.with_citation = with_citation
+        self.scheduler = scheduler
+        self.pinned_blocks = pinned_blocks or []
+        self.context_key = context_key
+        self.last_used = time_module.monotonic()
+
+    def matches(
+        self, history_messages: List[Dict[str, str]], with_citation: bool, context_key: Optional[str] = None
+    ) -> bool:
+        """
+        Checks that the client's history is the conversation this state was built from,
+        with the same context ahead of it.
+        """
+        if (
+            with_citation != self.with_citation
+            or context_key != self.context_key
+            or len(history_messages) != self.num_messages
+        ):
+            return False
+        return history_digest(history_messages) == self.history_digest
+
+
+class SessionStore:
+    """
+    Per-session conversation state with TTL and LRU eviction.
+
+    A follow-up turn of a known session reuses the exact token ids of the previous
+    turn, and the KV blocks pinned for it stay in the prefix cache, so only the new
+    user message is prefilled. Dropping a session hands its pinned blocks back to
+    the scheduler that owns them.
+
+    Pinned blocks are taken from the same KV cache running requests need, so each
+    scheduler's sessions may pin at most `max_pinned_blocks`, and a scheduler that
+    runs out of blocks can `reclaim` them from its least recently used sessions.
+    Blocks are handed back outside the store's lock, since schedulers call
+    `reclaim` from their own thread.
+    """
+    def __init__(self, ttl: float = 1800.0, max_sessions: int = 64, max_pinned_blocks: Optional[int] = None):
+        """
+        Args:
+            ttl (float): Seconds of inactivity after which a session is dropped.
+            max_sessions (int): Maximum number of sessions kept; the least recently used is dropped first.
+            max_pinned_blocks (Optional[int]): KV blocks the sessions of one scheduler may pin.
+                                               None leaves them unbounded.
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_pinned_blocks = max_pinned_blocks
+        self.sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evicted": 0,
+            "reclaimed": 0,
+        }
+
+    @staticmethod
+    def _release(dropped: List[SessionState]) -> int:
+        released = 0
+        for state in dropped:
+            if state.scheduler is not None and state.pinned_blocks:
+                state.scheduler.release_blocks(state.pinned_blocks)
+                released += len(state.pinned_blocks)
+        return released
+
+    def _purge_expired(self) -> List[SessionState]:
+        cutoff = time_module.monotonic() - self.ttl
+        expired = [session_id for session_id, state in self.sessions.items() if state.last_used < cutoff]
+        self.stats["expired"] += len(expired)
+        return [self.sessions.pop(session_id) for session_id in expired]
+
+    def _pop_lru(self, scheduler, num_blocks: int) -> List[SessionState]:
+        """Pops the least recently used sessions of a scheduler until they pin `num_blocks`."""
+        dropped = []
+        for session_id in [
+            session_id for session_id, state in self.sessions.items()
+            if state.scheduler is scheduler and state.pinned_blocks
+        ]:
+            if num_blocks <= 0:
+                break
+            state = self.sessions.pop(session_id)
+            num_blocks -= len(state.pinned_blocks)
+            dropped.append(state)
+        return dropped
+
+    def get(self, session_id: str) -> Optional[SessionState]:
+        with self._lock:
+            dropped = self._purge_expired()
+            state = self.sessions.get(session_id)
+            if state is None:
+                self.stats["misses"] += 1
+            else:
+                self.sessions.move_to_end(session_id)
+                state.last_used = time_module.monotonic()
+                self.stats["hits"] += 1
+        self._release(dropped)
+        return state
+
+    def put(self, session_id: str, state: SessionState):
+        with self._lock:
+            dropped = [self.sessions.pop(session_id)] if session_id in self.sessions else []
+            self.sessions[session_id] = state
+            dropped += self._purge_expired()
+            while len(self.sessions) > self.max_sessions:
+                dropped.append(self.sessions.pop(next(iter(self.sessions))))
+                self.stats["evicted"] += 1
+            if self.max_pinned_blocks is not None:
+                pinned = sum(
+                    len(other.pinned_blocks) for other in self.sessions.values() if other.scheduler is state.scheduler
+                )
+                over_budget = self._pop_lru(state.scheduler, pinned - self.max_pinned_blocks)
+                self.stats["evicted"] += len(over_budget)
+                dropped += over_budget
+        self._release(dropped)
+
+    def reclaim(self, scheduler, num_blocks: int) -> int:
+        """
+        Drops the least recently used sessions pinning blocks of a scheduler that
+        is out of KV cache blocks.
+
+        Args:
+            scheduler: The scheduler asking for blocks.
+            num_blocks (int): Blocks it is short of.
+
+        Returns:
+            int: Number of pinned blocks handed back.
+        """
+        with self._lock:
+            dropped = self._pop_lru(scheduler, num_blocks)
+            self.stats["reclaimed"] += len(dropped)
+        if dropped:
+            logger.info(f"Dropped {len(dropped)} sessions to free KV cache blocks")
+        return self._release(dropped)
+
+    def drop_scheduler(self, scheduler) -> int:
+        """
+        Drops every session pinned to a scheduler that is being stopped, handing
+        its blocks back first.
+
+        Returns:
+            int: Number of sessions dropped.
+        """
+        with self._lock:
+            dropped = [
+                self.sessions.pop(session_id)
+                for session_id, state in list(self.sessions.items()) if state.scheduler is scheduler
+            ]
+        self._release(dropped)
+        if dropped:
+            logger.info(f"Dropped {len(dropped)} sessions of a stopped scheduler")
+        return len(dropped)
+
+    def discard(self, session_id: str):
+        with self._lock:
+            dropped = [self.sessions.pop(session_id)] if session_id in self.sessions else []
+        self._release(dropped)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            dropped = self._purge_expired()
+            stats = {
+                **self.stats,
+                "sessions": len(self.sessions),
+                "max_sessions": self.max_sessions,
+                "pinned_blocks": sum(len(state.pinned_blocks) for state in self.sessions.values()),
+                "max_pinned_blocks": self.max_pinned_blocks,
+            }
+        self._release(dropped)
+        return stats
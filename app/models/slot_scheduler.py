@@ -0,0 +1,303 @@
+# app/models/slot_scheduler.py
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, served strictly in this order
+PRIORITY_CLASSES = {
+    "interactive": 0,
+    "default": 1,
+    "batch": 2,
+}
+
+
+class SlotRequest:
+    """
+    A request waiting for a batch slot.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, tenant: str, priority: int, cost: float, future: asyncio.Future):
+        self.seq = next(self._ids)
+        self.tenant = tenant
+        self.priority = priority
+        self.cost = cost
+        self.future = future
+
+
+class SlotScheduler:
+    """
+    Hands out the batch slots of the model instances to waiting requests.
+
+    Free slots are kept in arrival order of their release, so slots stay spread
+    across instances. Subclasses only decide which waiting request goes next
+    through `_push` and `_pop`.
+
+    Per-tenant counters are kept for the first `max_tracked_tenants` tenants; the
+    rest are counted under "other", so the stats stay bounded however many
+    tenants show up.
+    """
+    policy = "base"
+
+    def __init__(self, max_tracked_tenants: int = 64):
+        self.free: Deque[dict] = deque()
+        self.num_slots = 0
+        self.num_waiting = 0
+        self.max_tracked_tenants = max_tracked_tenants
+        self.stats = {
+            "dispatched": defaultdict(int),
+            "cost": defaultdict(float),
+        }
+
+    def add_slot(self, model_instance: dict):
+        """
+        Adds one batch slot of a model instance.
+        """
+        self.num_slots += 1
+        self.release(model_instance)
+
+    def add_slots(self, model_instance: dict, count: int):
+        """
+        Adds `count` batch slots of a model instance, interleaving them with the free
+        slots of the other instances so that concurrent requests spread across instances.
+        """
+        new_slots = []
+        for _ in range(count):
+            self.num_slots += 1
+            if not self._hand_over(model_instance):
+                new_slots.append(model_instance)
+
+        by_instance: Dict[int, List[dict]] = {}
+        for slot in list(self.free) + new_slots:
+            by_instance.setdefault(id(slot), []).append(slot)
+        self.free = deque(
+            slot for round_ in itertools.zip_longest(*by_instance.values()) for slot in round_ if slot is not None
+        )
+
+    def remove_slots(self, model_instance: dict) -> int:
+        """
+        Takes the free slots of an instance out of rotation. Slots it still has in use
+        are dropped on release once the instance is marked as draining.
+
+        Returns:
+            int: Number of slots removed.
+        """
+        kept = deque(slot for slot in self.free if slot is not model_instance)
+        removed = len(self.free) - len(kept)
+        self.free = kept
+        self.num_slots -= removed
+        return removed
+
+    @property
+    def free_slots(self) -> int:
+        return len(self.free)
+
+    def _account_tenant(self, tenant: str) -> str:
+        """Tenant a request is queued and counted under."""
+        return tenant
+
+    def _push(self, request: SlotRequest):
+        raise NotImplementedError
+
+    def _pop(self) -> Optional[SlotRequest]:
+        raise NotImplementedError
+
+    def _abandon(self, request: SlotRequest):
+        """Called when a queued request times out or is cancelled before it got a slot."""
+
+    def _dispatch(self, request: SlotRequest, model_instance: dict):
+        tenant = request.tenant
+        if tenant not in self.stats["dispatched"] and len(self.stats["dispatched"]) >= self.max_tracked_tenants:
+            tenant = "other"
+        self.stats["dispatched"][tenant] += 1
+        self.stats["cost"][tenant] += request.cost
+        request.future.set_result(model_instance)
+
+    async def acquire(
+        self,
+        tenant: str = "default",
+        priority: int = PRIORITY_CLASSES["default"],
+        cost: float = 1.0,
+        timeout: Optional[float] = None
+    ) -> dict:
+        """
+        Waits for a batch slot.
+
+        Args:
+            tenant (str): Tenant or API key the request is accounted to.
+            priority (int): Priority class; lower values are served first.
+            cost (float): Estimated cost, e.g. prompt tokens plus `max_new_tokens`.
+            timeout (Optional[float]): Maximum time to wait.
+
+        Returns:
+            dict: The model instance owning the slot.
+
+        Raises:
+            asyncio.TimeoutError: If no slot becomes free within the timeout.
+        """
+        future = asyncio.get_running_loop().create_future()
+        request = SlotRequest(self._account_tenant(tenant), priority, cost, future)
+        if self.free and not self.num_waiting:
+            self._dispatch(request, self.free.popleft())
+            return future.result()
+
+        self._push(request)
+        self.num_waiting += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the wait ended
+                self.release(future.result())
+            else:
+                # Skipped when popped
+                future.cancel()
+                self.num_waiting -= 1
+                self._abandon(request)
+            raise
+
+    def _hand_over(self, model_instance: dict) -> bool:
+        """
+        Gives a slot to the next waiting request. Returns False if nobody is waiting.
+        """
+        while self.num_waiting:
+            request = self._pop()
+            if request is None:
+                break
+            if request.future.cancelled():
+                continue
+            self.num_waiting -= 1
+            self._dispatch(request, model_instance)
+            return True
+        return False
+
+    def release(self, model_instance: dict):
+        """
+        Returns a batch slot, handing it straight to the next waiting request if any.
+        """
+        if model_instance.get('draining'):
+            # The instance is being retired, its slots are not handed out again
+            self.num_slots -= 1
+            return
+        if not self._hand_over(model_instance):
+            self.free.append(model_instance)
+
+    def get_stats(self) -> dict:
+        """Totals without tenant names, safe for the public status endpoint."""
+        return {
+            "policy": self.policy,
+            "num_slots": self.num_slots,
+            "free_slots": self.free_slots,
+            "waiting": self.num_waiting,
+            "dispatched": sum(self.stats["dispatched"].values()),
+            "cost": sum(self.stats["cost"].values()),
+            "tenants": len(self.stats["dispatched"]),
+        }
+
+
+class FifoSlotScheduler(SlotScheduler):
+    """
+    First come, first served. Tenants and priorities are ignored.
+    """
+    policy = "fifo"
+
+    def __init__(self):
+        super().__init__()
+        self.waiters: Deque[SlotRequest] = deque()
+
+    def _push(self, request: SlotRequest):
+        self.waiters.append(request)
+
+    def _pop(self) -> Optional[SlotRequest]:
+        return self.waiters.popleft() if self.waiters else None
+
+
+class FairShareSlotScheduler(SlotScheduler):
+    """
+    Strict priority classes with weighted fair queuing between tenants inside a class.
+
+    Each request gets a virtual finish tag of
+    `max(virtual_time, tenant's last finish tag) + cost / weight`, and the smallest
+    tag is served first. A tenant sending many long requests therefore queues
+    behind its own backlog, while a tenant with short requests is served after
+    roughly its fair share of cost instead of after everything that arrived first.
+
+    A request that gives up before it is served hands its cost back, so a tenant
+    whose requests time out is not charged for service it never received.
+
+    Only tenants listed in `weights` get their own share; requests of any other
+    tenant are queued as the "default" tenant. This keeps the scheduler's state
+    bounded, and minting new tenant names gains a client no extra share.
+    """
+    policy = "fair"
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, default_weight: float = 1.0):
+        """
+        Args:
+            weights (Optional[Dict[str, float]]): Share of each tenant.
+            default_weight (float): Share of tenants not listed in `weights`.
+        """
+        super().__init__()
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.heap: List[tuple] = []
+        self.virtual_time: Dict[int, float] = defaultdict(float)
+        self.last_finish: Dict[tuple, float] = defaultdict(float)
+
+    def _push(self, request: SlotRequest):
+        weight = self.weights.get(request.tenant, self.default_weight)
+        key = (request.priority, request.tenant)
+        start = max(self.virtual_time[request.priority], self.last_finish[key])
+        finish = start + request.cost / weight
+        self.last_finish[key] = finish
+        heapq.heappush(self.heap, (request.priority, finish, request.seq, start, request))
+
+    def _pop(self) -> Optional[SlotRequest]:
+        if not self.heap:
+            return None
+        priority, _, _, start, request = heapq.heappop(self.heap)
+        self.virtual_time[priority] = max(self.virtual_time[priority], start)
+        return request
+
+    def _abandon(self, request: SlotRequest):
+        # Takes the request out of the queue and moves the tenant's later requests up by its share
+        share = request.cost / self.weights.get(request.tenant, self.default_weight)
+        key = (request.priority, request.tenant)
+        floor = self.virtual_time[request.priority]
+        heap = []
+        for entry in self.heap:
+            queued = entry[4]
+            if queued is request:
+                continue
+            if (queued.priority, queued.tenant) == key and queued.seq > request.seq:
+                start = max(floor, entry[3] - share)
+                entry = (entry[0], max(start, entry[1] - share), entry[2], start, queued)
+            heap.append(entry)
+        heapq.heapify(heap)
+        self.heap = heap
+        self.last_finish[key] = max(floor, self.last_finish[key] - share)
+
+    def _account_tenant(self, tenant: str) -> str:
+        return tenant if tenant in self.weights else "default"
+
+    def get_stats(self) -> dict:
+        return {
+            **super().get_stats(),
+            "weighted_tenants": len(self.weights),
+        }
+
+
+def create_slot_scheduler(policy: str = "fifo", weights: Optional[Dict[str, float]] = None) -> SlotScheduler:
+    """
+    Builds the slot scheduler for a policy name ("fifo" or "fair").
+    """
+    if policy == "fifo":
+        return FifoSlotScheduler()
+    if policy == "fair":
+        return FairShareSlotScheduler(weights)
+    raise ValueError(f"Unknown slot scheduling policy: {policy}")
@@ -0,0 +1,38 @@
+# app/models/speculative.py
+from typing import List
+
+
+def propose_prompt_lookup(
+    token_ids: List[int],
+    num_draft_tokens: int = 5,
+    max_ngram: int = 3,
+    min_ngram: int = 1
+) -> List[int]:
+    """
+    Drafts the next tokens by looking up the trailing n-gram earlier in the sequence.
+
+    RAG answers copy long spans from the context in the prompt, so when the last few
+    tokens also occur earlier, the tokens that followed them there are a good guess
+    for what comes next. Longer n-grams are tried first, and the most recent
+    occurrence wins.
+
+    Args:
+        token_ids (List[int]): Prompt and generated tokens so far.
+        num_draft_tokens (int): Maximum number of tokens to propose.
+        max_ngram (int): Longest trailing n-gram to look up.
+        min_ngram (int): Shortest trailing n-gram to look up.
+
+    Returns:
+        List[int]: Proposed tokens, empty if the trailing n-gram does not occur earlier.
+    """
+    length = len(token_ids)
+    if num_draft_tokens <= 0:
+        return []
+    for n in range(min(max_ngram, length - 1), min_ngram - 1, -1):
+        pattern = token_ids[length - n:]
+        first = pattern[0]
+        # Scan right to left, skipping the trailing occurrence itself
+        for start in range(length - n - 1, -1, -1):
+            if token_ids[start] == first and token_ids[start:start + n] == pattern:
+                return token_ids[start + n:start + n + num_draft_tokens]
+    return []
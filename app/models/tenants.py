@@ -0,0 +1,78 @@
+# app/models/tenants.py
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.models.slot_scheduler import PRIORITY_CLASSES
+
+logger = logging.getLogger(__name__)
+
+
+def key_alias(api_key: str) -> str:
+    """Tenant name of an API key without a configured one: a short hash, so keys never appear in stats or logs."""
+    return "key-" + hashlib.blake2b(api_key.encode("utf-8"), digest_size=6).hexdigest()
+
+
+class TenantPolicy:
+    """
+    Maps the caller's API key to the tenant it is accounted to and the priority
+    classes it may use.
+
+    The tenant comes from the key only, never from the request body, so a client
+    cannot claim another tenant's share. Keys with a configured tenant use that
+    name; other keys get a hashed alias and requests without a key share the
+    "anonymous" tenant.
+    """
+    def __init__(
+        self,
+        key_tenants: Optional[Dict[str, str]] = None,
+        max_priorities: Optional[Dict[str, str]] = None,
+        default_max_priority: str = "default"
+    ):
+        """
+        Args:
+            key_tenants (Optional[Dict[str, str]]): Tenant name per API key.
+            max_priorities (Optional[Dict[str, str]]): Most urgent priority class each tenant may use.
+            default_max_priority (str): Most urgent class for tenants not listed in `max_priorities`.
+
+        Raises:
+            ValueError: If a priority class is unknown.
+        """
+        self.key_tenants = dict(key_tenants or {})
+        self.max_priorities = dict(max_priorities or {})
+        self.default_max_priority = default_max_priority
+        for priority in [*self.max_priorities.values(), default_max_priority]:
+            if priority not in PRIORITY_CLASSES:
+                raise ValueError(f"Unknown priority class: {priority}")
+
+    def tenant(self, api_key: Optional[str]) -> str:
+        if not api_key:
+            return "anonymous"
+        return self.key_tenants.get(api_key) or key_alias(api_key)
+
+    def resolve(self, api_key: Optional[str], priority: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Tenant and priority class of a request.
+
+        Args:
+            api_key (Optional[str]): The X-API-Key header.
+            priority (Optional[str]): Requested priority class. None picks "default",
+                                      or the tenant's limit if that is less urgent.
+
+        Returns:
+            Tuple[str, str]: The tenant name and the priority class.
+
+        Raises:
+            HTTPException: 400 for an unknown class, 403 for a class the key may not use.
+        """
+        tenant = self.tenant(api_key)
+        limit = self.max_priorities.get(tenant, self.default_max_priority)
+        if priority is None:
+            return tenant, max("default", limit, key=PRIORITY_CLASSES.__getitem__)
+        if priority not in PRIORITY_CLASSES:
+            raise HTTPException(400, f"Unknown priority class: {priority}")
+        if PRIORITY_CLASSES[priority] < PRIORITY_CLASSES[limit]:
+            raise HTTPException(403, f"Priority class {priority} is not allowed for this API key")
+        return tenant, priority
@@ -1,5 +1,5 @@
 # app/schemas/frontend.py
-from typing import List, Optional, Union, Any, Dict
+from typing import List, Literal, Optional, Union, Any, Dict
 from pydantic import BaseModel
 
 class FrontendPayload(BaseModel):
@@ -10,3 +10,17 @@ class FrontendPayload(BaseModel):
     temperature: float = 0.7
     top_p: float = 0.9
     top_k: Optional[int] = None  # Optional, can be ignored or used if needed
+    session_id: Optional[str] = None  # Reuses the previous turn's KV cache when set
+    deadline: Optional[float] = None  # Seconds the request may wait for a model instance
+    # The tenant is derived from the X-API-Key header, see `TenantPolicy`
+    priority: Optional[Literal["interactive", "default", "batch"]] = None
+    speculative: bool = False  # Prompt-lookup speculative decoding
+    plan: Optional[bool] = None  # Decompose into subqueries first; defaults to QUERY_PLANNING
+    rephrase: Optional[bool] = None  # Plan a standalone rewrite of a follow-up; defaults to QUERY_REPHRASING
+
+
+class RephrasePayload(BaseModel):
+    query: str
+    history_messages: Optional[Union[str, List[Dict[str, str]]]] = None
+    deadline: Optional[float] = None  # Seconds the request may wait for a model instance
+    priority: Optional[Literal["interactive", "default", "batch"]] = None
@@ -8,3 +8,4 @@ class LLMRequest(BaseModel):
     max_new_tokens: int = 1024
     temperature: float = 0.7
     top_p: float = 0.9
+    session_id: Optional[str] = None
@@ -0,0 +1,146 @@
+# app/tools/local_tools.py
+"""
+Local stand-ins for the functions in `function_definitions_list`.
+
+They return deterministic synthetic data (the same arguments always give the
+same output) without touching any external service, for development and for
+exercising the tool runtime. Enabled with LOCAL_TOOLS=1; never use them where
+answers must be real.
+"""
+import datetime
+import hashlib
+import random
+from typing import Optional
+
+from app.tools.runtime import ToolRuntime
+
+_MARKETS = ["North America", "Europe", "Asia Pacific", "Latin America"]
+_AGENTS = ["Alice Martin", "Bruno Costa", "Chen Wei", "Dana Okafor"]
+_INDUSTRIES = ["Retail", "Finance", "Healthcare", "Manufacturing"]
+
+
+def _rng(*key) -> random.Random:
+    """Random generator seeded by the arguments, so outputs are reproducible."""
+    return random.Random(hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).digest())
+
+
+def get_current_date() -> str:
+    return datetime.date.today().strftime("%d/%m/%Y")
+
+
+def query_sales_data(query_type: str, parameters: dict, chart_type: str = "LineChart") -> dict:
+    rng = _rng(query_type, sorted(parameters.items()))
+    groups = {
+        "sales_by_market": _MARKETS,
+        "sales_by_agent": _AGENTS,
+        "clients_by_industry": _INDUSTRIES,
+        "segment_of_enterprise": ["Small", "Medium", "Enterprise"],
+        "top_customers_by_sales": [f"Customer {i + 1}" for i in range(parameters.get("top_n", 5))],
+        "sales_by_product_code": [f"P-{100 + i}" for i in range(5)],
+    }
+    if query_type in groups:
+        data = [{"label": label, "value": round(rng.uniform(10_000, 500_000), 2)} for label in groups[query_type]]
+    elif query_type in ("total_sales_over_time", "sales_in_date_range"):
+        data = [{"label": f"{parameters.get('year', 2024)}-{month:02d}", "value": round(rng.uniform(50_000, 250_000), 2)}
+                for month in range(1, 13)]
+    elif query_type == "average_sales_per_order":
+        data = [{"label": "average_sales_per_order", "value": round(rng.uniform(100, 5_000), 2)}]
+    else:
+        raise ValueError(f"Unsupported query type: {query_type}")
+    return {"query_type": query_type, "chart_type": chart_type, "data": data}
+
+
+def get_average_price_of_a_crypto_coin_by_year(name: str, year: str) -> str:
+    price = _rng(name.lower(), year).uniform(0.05, 60_000)
+    return f"The average price of {name} in {year} was ${price:,.2f}."
+
+
+def get_coin_surpass_date(coin_name_1: str, coin_name_2: str) -> Optional[str]:
+    rng = _rng(coin_name_1.lower(), coin_name_2.lower())
+    if rng.random() < 0.3:
+        return None
+    return (datetime.date(2017, 1, 1) + datetime.timedelta(days=rng.randrange(2_500))).isoformat()
+
+
+def get_crypto_coin_ema_values(
+    coin_slug: str,
+    start_date: str,
+    end_date: str,
+    period: int = 20,
+    chart_type: str = "LineChart",
+    chart_colors: Optional[dict] = None
+) -> dict:
+    start, end = datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date)
+    if end < start:
+        raise ValueError("end_date is before start_date")
+    rng = _rng(coin_slug.lower(), period)
+    price = rng.uniform(1, 50_000)
+    open_ema = close_ema = price
+    alpha = 2 / (period + 1)
+    values = []
+    for day in range(min((end - start).days + 1, 366)):
+        price *= 1 + rng.gauss(0, 0.03)
+        open_ema += alpha * (price * (1 + rng.gauss(0, 0.005)) - open_ema)
+        close_ema += alpha * (price - close_ema)
+        date = (start + datetime.timedelta(days=day)).isoformat()
+        values.append({"date": date, "open_ema": round(open_ema, 2), "close_ema": round(close_ema, 2)})
+    return {"coin": coin_slug, "period": period, "chart_type": chart_type, "chart_colors": chart_colors or {}, "data": values}
+
+
+def _bitcoin_values(column_name: str, time_period: str, value: int):
+    if time_period not in ("month", "year"):
+        raise ValueError('time_period must be "month" or "year"')
+    rng = _rng(column_name, time_period, value)
+    return [rng.uniform(100, 100_000) for _ in range(30 if time_period == "month" else 365)]
+
+
+def get_single_metric_bitcoin_data(operation: str, column_name: str, time_period: str, value: int) -> dict:
+    metrics = get_all_metrics_bitcoin_data(column_name, time_period, value)
+    if operation not in metrics:
+        raise ValueError('operation must be one of "sum", "min", "max", "count" or "average"')
+    return {"column_name": column_name, "time_period": time_period, "value": value, operation: metrics[operation]}
+
+
+def get_all_metrics_bitcoin_data(column_name: str, time_period: str, value: int) -> dict:
+    values = _bitcoin_values(column_name, time_period, value)
+    return {
+        "column_name": column_name,
+        "time_period": time_period,
+        "value": value,
+        "sum": round(sum(values), 2),
+        "min": round(min(values), 2),
+        "max": round(max(values), 2),
+        "count": len(values),
+        "average": round(sum(values) / len(values), 2),
+    }
+
+
+def google_search(query: str, api_key: Optional[str] = None, cx_code: Optional[str] = None, num_results: int = 10) -> list:
+    slug = "-".join(query.lower().split())[:60]
+    return [
+        {
+            "title": f"{query} - result {i + 1}",
+            "link": f"https://example.com/{slug}/{i + 1}",
+            "snippet": f"Placeholder search result {i + 1} for '{query}'.",
+        }
+        for i in range(max(1, min(num_results, 10)))
+    ]
+
+
+LOCAL_TOOLS = {
+    "get_current_date": get_current_date,
+    "query_sales_data": query_sales_data,
+    "get_average_price_of_a_crypto_coin_by_year": get_average_price_of_a_crypto_coin_by_year,
+    "get_coin_surpass_date": get_coin_surpass_date,
+    "get_crypto_coin_ema_values": get_crypto_coin_ema_values,
+    "get_single_metric_bitcoin_data": get_single_metric_bitcoin_data,
+    "get_all_metrics_bitcoin_data": get_all_metrics_bitcoin_data,
+    "google_search": google_search,
+}
+
+
+def register_local_tools(runtime: ToolRuntime):
+    """Registers the stand-in of every declared function that has one."""
+    for name, function in LOCAL_TOOLS.items():
+        if name in runtime.definitions:
+            runtime.register(name, function)
@@ -0,0 +1,119 @@
+# app/tools/result_cache.py
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def call_key(name: str, arguments: Dict[str, Any]) -> str:
+    """
+    Key of a tool call: the tool name and a hash of its canonical JSON arguments, so
+    calls that differ only in argument order share an entry.
+    """
+    canonical = json.dumps(arguments, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return f"{name}:{hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()}"
+
+
+class CachedToolOutput:
+    """
+    Output of a successful call and when it was produced.
+    """
+    def __init__(self, output: Any, output_text: str, created_at: float, expires_at: float):
+        """
+        Args:
+            output (Any): What the tool returned.
+            output_text (str): The output as placed in the prompt, used for the size.
+            created_at (float): Wall-clock time of the call.
+            expires_at (float): Monotonic time after which the entry is stale.
+        """
+        self.output = output
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.nbytes = len(output_text.encode("utf-8"))
+
+
+class ToolResultCache:
+    """
+    LRU cache of tool outputs keyed by tool name and canonical arguments, with a
+    time-to-live per tool and a byte budget.
+
+    Only successful calls are stored. A TTL of 0 disables caching for a tool, e.g.
+    for functions with side effects.
+    """
+    def __init__(self, max_bytes: int = 16 * 2**20, default_ttl: float = 300.0, ttls: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            max_bytes (int): Budget for the cached outputs. 0 disables the cache.
+            default_ttl (float): Seconds an output stays valid unless its tool has its own TTL.
+            ttls (Optional[Dict[str, float]]): TTL per tool name.
+        """
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttls = dict(ttls or {})
+        self.entries: "OrderedDict[str, CachedToolOutput]" = OrderedDict()
+        self.nbytes = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "expired": 0,
+            "evictions": 0,
+        }
+
+    def ttl(self, name: str) -> float:
+        return self.ttls.get(name, self.default_ttl)
+
+    def get(self, key: str) -> Optional[CachedToolOutput]:
+        """Returns the unexpired output of a call, or None."""
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.stats["expired"] += 1
+            entry = None
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, key: str, name: str, output: Any, output_text: str) -> Optional[CachedToolOutput]:
+        """
+        Stores the output of a successful call, evicting the least recently used beyond the byte budget.
+
+        Returns:
+            Optional[CachedToolOutput]: The entry, or None if the tool is not cached or the output is too big.
+        """
+        ttl = self.ttl(name)
+        if ttl <= 0:
+            return None
+        entry = CachedToolOutput(output, output_text, time.time(), time.monotonic() + ttl)
+        if entry.nbytes > self.max_bytes:
+            return None
+        self._remove(key)
+        self.entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.stats["evictions"] += 1
+        return entry
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,323 @@
+# app/tools/runtime.py
+import asyncio
+import bisect
+import datetime
+import inspect
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from app.tools.result_cache import ToolResultCache, call_key
+from app.tools.schema import ToolValidationError, validate_arguments
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets; the last one is open-ended
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram, cheap enough to update on every call.
+    """
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile, 0 without observations."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def get_stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_seconds": self.total / self.count if self.count else 0.0,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "p99_seconds": self.quantile(0.99),
+            # Cumulative counts per upper bound, as in Prometheus histograms
+            "buckets": {
+                ("+Inf" if bound == float("inf") else str(bound)): sum(self.counts[:i + 1])
+                for i, bound in enumerate(self.buckets)
+            },
+        }
+
+
+class ToolCall:
+    """
+    A function call requested by the model.
+    """
+    def __init__(self, name: str, arguments: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.arguments = arguments if arguments is not None else {}
+
+
+def parse_tool_calls(data: Any) -> List[ToolCall]:
+    """
+    Reads calls from parsed model output: a list of `{"name": ..., "arguments": {...}}`
+    objects or a single one. Arguments given as a JSON string are decoded.
+
+    Raises:
+        ValueError: If an entry is not a call.
+    """
+    entries = data if isinstance(data, list) else [data]
+    calls = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+            raise ValueError(f"Not a function call: {entry!r}")
+        arguments = entry.get("arguments") or entry.get("parameters") or {}
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments)
+        calls.append(ToolCall(entry["name"], arguments))
+    return calls
+
+
+def tool_calls_schema(definitions: Sequence[dict]) -> dict:
+    """
+    JSON schema of a list of calls to the given functions, for constrained decoding.
+    Each function is one `oneOf` branch told apart by its `name`, so the arguments
+    follow that function's `parameters`. Keywords the grammar does not enforce (e.g.
+    formats) are still checked by `validate_arguments`.
+    """
+    return {
+        "type": "array",
+        "items": {
+            "oneOf": [
+                {
+                    "type": "object",
+                    "properties": {
+                        "name": {"const": definition["name"]},
+                        "arguments": definition.get("parameters") or {"type": "object"},
+                    },
+                    "required": ["name", "arguments"],
+                    "additionalProperties": False,
+                }
+                for definition in definitions
+            ],
+        },
+    }
+
+
+class ToolResult:
+    """
+    Outcome of a tool call. Failed calls carry the error instead of an output.
+    """
+    def __init__(
+        self,
+        call: ToolCall,
+        output: Any = None,
+        error: Optional[str] = None,
+        latency: float = 0.0,
+        cached_at: Optional[float] = None
+    ):
+        self.call = call
+        self.output = output
+        self.error = error
+        self.latency = latency
+        # Wall-clock time of the earlier call whose output was reused
+        self.cached_at = cached_at
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def output_text(self) -> str:
+        """Output as placed in the prompt; errors are reported so the model can explain them."""
+        if self.error is not None:
+            return f"Error: {self.error}"
+        if isinstance(self.output, str):
+            return self.output
+        return json.dumps(self.output, ensure_ascii=False, default=str)
+
+    def source(self) -> dict:
+        """Entry of the "Action" context type, as read by `ContextPreparer.function_call_entries`."""
+        source = {
+            "FunctionName": [{"name": self.call.name, "arguments": self.call.arguments}],
+            "Output": self.output_text(),
+        }
+        if self.cached_at is not None:
+            source["Cached"] = datetime.datetime.fromtimestamp(self.cached_at, datetime.timezone.utc).isoformat(timespec="seconds")
+        return source
+
+
+class _Tool:
+    def __init__(self, definition: dict, function: Callable, timeout: float):
+        self.definition = definition
+        self.function = function
+        self.is_async = inspect.iscoroutinefunction(function)
+        self.timeout = timeout
+        self.latency = LatencyHistogram()
+        self.stats = {
+            "calls": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "invalid": 0,
+            "cache_hits": 0,
+        }
+
+
+class ToolRuntime:
+    """
+    Validates and executes tool calls against the declared function definitions.
+
+    Calls are checked against the `parameters` schema of their definition before
+    anything runs. Independent calls run concurrently: coroutine functions on the
+    event loop, plain functions on a thread pool. Every call has a timeout, per tool
+    or the default; a timed-out thread cannot be interrupted, so it finishes in the
+    background while the call reports the timeout. Results are returned in call
+    order and can be turned into the "Action" context the answer prompt cites.
+
+    With a `ToolResultCache`, a call repeating an earlier one within its tool's TTL
+    reuses the output, and concurrent identical calls share one execution.
+    """
+    def __init__(
+        self,
+        definitions: Sequence[dict],
+        default_timeout: float = 10.0,
+        timeouts: Optional[Dict[str, float]] = None,
+        max_workers: int = 8,
+        cache: Optional[ToolResultCache] = None
+    ):
+        """
+        Args:
+            definitions (Sequence[dict]): Function definitions, e.g. `function_definitions_list`.
+            default_timeout (float): Seconds a call may run unless its tool has its own timeout.
+            timeouts (Optional[Dict[str, float]]): Timeout per tool name.
+            max_workers (int): Threads running plain (non-async) tool functions.
+            cache (Optional[ToolResultCache]): Reuses outputs of identical calls. None disables it.
+        """
+        self.definitions = {definition["name"]: definition for definition in definitions}
+        self.default_timeout = default_timeout
+        self.timeouts = dict(timeouts or {})
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.tools: Dict[str, _Tool] = {}
+        self.cache = cache
+        # Running executions by call key, awaited by identical calls that arrive meanwhile
+        self.in_flight: Dict[str, asyncio.Task] = {}
+
+    def register(self, name: str, function: Callable, timeout: Optional[float] = None):
+        """
+        Provides the implementation of a declared function.
+
+        Args:
+            name (str): Name of the function definition.
+            function (Callable): Called with the validated arguments as keyword arguments;
+                                 may be a coroutine function.
+            timeout (Optional[float]): Overrides the configured timeout of this tool.
+
+        Raises:
+            KeyError: If no function of that name is declared.
+        """
+        if name not in self.definitions:
+            raise KeyError(f"No function definition named {name}")
+        self.tools[name] = _Tool(
+            self.definitions[name], function, timeout or self.timeouts.get(name, self.default_timeout)
+        )
+
+    @property
+    def available(self) -> List[dict]:
+        """Definitions of the functions that have an implementation."""
+        return [tool.definition for tool in self.tools.values()]
+
+    async def call(self, call: ToolCall) -> ToolResult:
+        """
+        Validates and runs one call. Never raises for a failing tool; the error is in the result.
+        """
+        tool = self.tools.get(call.name)
+        if tool is None:
+            return ToolResult(call, error=f"Unknown function {call.name}")
+        try:
+            arguments = validate_arguments(tool.definition.get("parameters") or {}, call.arguments)
+        except ToolValidationError as e:
+            tool.stats["invalid"] += 1
+            return ToolResult(call, error=f"Invalid arguments: {e}")
+        # The context shows the arguments the tool actually ran with
+        call = ToolCall(call.name, arguments)
+        if self.cache is None or self.cache.ttl(call.name) <= 0:
+            return await self._run(tool, call)
+
+        key = call_key(call.name, arguments)
+        entry = self.cache.get(key)
+        if entry is not None:
+            tool.stats["cache_hits"] += 1
+            return ToolResult(call, output=entry.output, cached_at=entry.created_at)
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_and_store(tool, call, key))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.cache.stats["coalesced"] += 1
+        # Shielded, so a caller that gives up does not cancel the execution others wait for
+        result = await asyncio.shield(task)
+        return ToolResult(call, result.output, result.error, result.latency)
+
+    async def _run_and_store(self, tool: _Tool, call: ToolCall, key: str) -> ToolResult:
+        result = await self._run(tool, call)
+        if result.ok:
+            self.cache.put(key, call.name, result.output, result.output_text())
+        return result
+
+    async def _run(self, tool: _Tool, call: ToolCall) -> ToolResult:
+        arguments = call.arguments
+        tool.stats["calls"] += 1
+        start = time.perf_counter()
+        try:
+            if tool.is_async:
+                output = await asyncio.wait_for(tool.function(**arguments), tool.timeout)
+            else:
+                loop = asyncio.get_running_loop()
+                output = await asyncio.wait_for(
+                    loop.run_in_executor(self.executor, lambda: tool.function(**arguments)), tool.timeout
+                )
+            result = ToolResult(call, output=output)
+        except asyncio.TimeoutError:
+            tool.stats["timeouts"] += 1
+            result = ToolResult(call, error=f"{call.name} timed out after {tool.timeout}s")
+        except Exception as e:
+            tool.stats["errors"] += 1
+            logger.warning(f"Tool {call.name} failed: {e}")
+            result = ToolResult(call, error=str(e) or type(e).__name__)
+        result.latency = time.perf_counter() - start
+        tool.latency.observe(result.latency)
+        return result
+
+    async def execute(self, calls: Sequence[ToolCall]) -> List[ToolResult]:
+        """
+        Runs independent calls concurrently.
+
+        Returns:
+            List[ToolResult]: One result per call, in call order.
+        """
+        return list(await asyncio.gather(*(self.call(call) for call in calls)))
+
+    @staticmethod
+    def to_context(results: Sequence[ToolResult]) -> dict:
+        """Context details of the "Action" type for the results."""
+        return {"Type": "Action", "Source": [result.source() for result in results]}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def get_stats(self) -> dict:
+        return {
+            name: {**tool.stats, "timeout": tool.timeout, "latency": tool.latency.get_stats()}
+            for name, tool in self.tools.items()
+        }
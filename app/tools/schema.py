@@ -0,0 +1,98 @@
+# app/tools/schema.py
+import re
+from typing import Any, Dict
+
+_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+class ToolValidationError(ValueError):
+    """Raised when tool call arguments do not match the tool's parameter schema."""
+
+
+def _is_object_type(schema_type) -> bool:
+    # The function definitions use "dict" and "object" interchangeably
+    return schema_type in ("object", "dict")
+
+
+def _coerce(schema: Dict[str, Any], value: Any, path: str) -> Any:
+    """
+    Checks a value against a schema, converting scalars the model commonly
+    produces in the wrong type (e.g. the year "2024" for an integer, 2024 for a string).
+    """
+    schema_type = schema.get("type")
+    if _is_object_type(schema_type):
+        return validate_arguments(schema, value, path)
+    if schema_type == "array":
+        if not isinstance(value, list):
+            raise ToolValidationError(f"{path}: expected an array, got {type(value).__name__}")
+        items = schema.get("items") or {}
+        return [_coerce(items, item, f"{path}[{i}]") for i, item in enumerate(value)]
+    if schema_type == "string":
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ToolValidationError(f"{path}: expected a string, got {type(value).__name__}")
+        value = str(value)
+        if schema.get("format") == "date" and not _DATE.match(value):
+            raise ToolValidationError(f"{path}: expected a date in YYYY-MM-DD format, got {value!r}")
+    elif schema_type == "integer":
+        if isinstance(value, str) and re.fullmatch(r"-?\d+", value.strip()):
+            value = int(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ToolValidationError(f"{path}: expected an integer, got {value!r}")
+    elif schema_type == "number":
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ToolValidationError(f"{path}: expected a number, got {value!r}")
+    elif schema_type == "boolean":
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        if not isinstance(value, bool):
+            raise ToolValidationError(f"{path}: expected a boolean, got {value!r}")
+
+    if "enum" in schema and value not in schema["enum"]:
+        raise ToolValidationError(f"{path}: {value!r} is not one of {schema['enum']}")
+    return value
+
+
+def validate_arguments(schema: Dict[str, Any], arguments: Any, path: str = "arguments") -> Dict[str, Any]:
+    """
+    Validates tool call arguments against the `parameters` schema of a function definition.
+
+    Supports the JSON Schema subset the function definitions use: object ("dict"),
+    array, string (with the "date" format), integer, number and boolean types,
+    `required`, `properties`, `enum` and `additionalProperties: false`.
+
+    Args:
+        schema (Dict[str, Any]): Object schema of the parameters.
+        arguments (Any): Arguments of the call.
+        path (str): Location of `arguments` in error messages.
+
+    Returns:
+        Dict[str, Any]: The arguments, with scalars converted to their declared types.
+
+    Raises:
+        ToolValidationError: If the arguments do not match the schema.
+    """
+    if not isinstance(arguments, dict):
+        raise ToolValidationError(f"{path}: expected an object, got {type(arguments).__name__}")
+    properties = schema.get("properties") or {}
+    missing = [name for name in schema.get("required") or [] if name not in arguments]
+    if missing:
+        raise ToolValidationError(f"{path}: missing required {', '.join(missing)}")
+    if schema.get("additionalProperties") is False:
+        unknown = [name for name in arguments if name not in properties]
+        if unknown:
+            raise ToolValidationError(f"{path}: unknown {', '.join(unknown)}")
+
+    validated = {}
+    for name, value in arguments.items():
+        if name in properties:
+            validated[name] = _coerce(properties[name], value, f"{path}.{name}")
+        else:
+            validated[name] = value
+    return validated
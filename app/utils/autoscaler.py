@@ -0,0 +1,193 @@
+# app/utils/autoscaler.py
+import asyncio
+import logging
+import time as time_module
+from typing import Any, Dict, Optional
+
+from ..models.quantization import weight_bytes
+from .memory_maintenance import available_memory_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class PoolAutoscaler:
+    """
+    Background task that adds and retires model instances based on load.
+
+    Every `check_interval` seconds it samples the number of requests waiting for a
+    batch slot and the pool's generated tokens/s. It scales up while requests keep
+    queueing, as long as the device has memory headroom for another instance and
+    the previous scale-up actually raised throughput (instances sharing a
+    saturated device do not). It scales down once the queue is empty and the
+    remaining instances could hold the active requests with room to spare.
+    Instances are drained before they are retired, and at most one action is
+    taken per `cooldown` seconds.
+    """
+    def __init__(
+        self,
+        model_pool,
+        min_instances: int = 1,
+        max_instances: int = 1,
+        check_interval: float = 5.0,
+        cooldown: float = 60.0,
+        scale_up_queue_depth: int = 4,
+        scale_down_utilization: float = 0.5,
+        min_free_memory_mb: float = 1024.0,
+        min_throughput_gain: float = 0.1,
+    ):
+        """
+        Initializes the autoscaler.
+
+        Args:
+            model_pool: The `ParallelModelPool` to resize.
+            min_instances (int): Instances kept at all times.
+            max_instances (int): Upper bound on instances.
+            check_interval (float): Seconds between two load samples.
+            cooldown (float): Minimum seconds between two scaling actions.
+            scale_up_queue_depth (int): Waiting requests that trigger a scale-up.
+            scale_down_utilization (float): Slot utilization the remaining instances may
+                                            reach after a scale-down.
+            min_free_memory_mb (float): Memory that must stay free after adding an instance.
+            min_throughput_gain (float): Relative tokens/s gain the previous scale-up must
+                                         have brought before scaling up again.
+        """
+        self.model_pool = model_pool
+        self.min_instances = min_instances
+        self.max_instances = max_instances
+        self.check_interval = check_interval
+        self.cooldown = cooldown
+        self.scale_up_queue_depth = scale_up_queue_depth
+        self.scale_down_utilization = scale_down_utilization
+        self.min_free_memory_bytes = min_free_memory_mb * 1024 * 1024
+        self.min_throughput_gain = min_throughput_gain
+
+        self._last_action = 0.0
+        self._last_tokens: Optional[int] = None
+        self._last_sample: Optional[float] = None
+        # Throughput just before the last scale-up, None once it paid off
+        self._throughput_before_scale_up: Optional[float] = None
+        self.tokens_per_second = 0.0
+        self.stats = {
+            "scale_ups": 0,
+            "scale_downs": 0,
+            "blocked_by_memory": 0,
+            "blocked_by_throughput": 0,
+            "last_action": None,
+            "last_action_at": None,
+        }
+
+    def _sample_throughput(self):
+        tokens = sum(
+            instance['scheduler'].stats["tokens_generated"] for instance in self.model_pool.model_instances
+        )
+        now = time_module.monotonic()
+        if self._last_tokens is not None and now > self._last_sample:
+            # Retired instances take their counters with them; clamp the drop
+            self.tokens_per_second = max(0, tokens - self._last_tokens) / (now - self._last_sample)
+        self._last_tokens = tokens
+        self._last_sample = now
+
+    def _instance_bytes(self, device: str) -> int:
+        """Worst-case memory a new instance on `device` needs."""
+        instances = self.model_pool.model_instances
+        if not instances:
+            return 0
+        kv_cache = instances[0]['kv_cache']
+        needed = kv_cache.max_blocks * kv_cache.block_bytes
+        model = instances[0]['model']
+        if model is None:
+            # Worker processes each load their own copy of the weights
+            needed += instances[0]['scheduler'].weight_bytes
+        elif device not in self.model_pool.models:
+            needed += weight_bytes(model)
+        return needed
+
+    def _has_headroom(self) -> bool:
+        counts: Dict[str, int] = {device: 0 for device in self.model_pool.devices}
+        for instance in self.model_pool.model_instances:
+            counts[instance['device']] = counts.get(instance['device'], 0) + 1
+        device = min(self.model_pool.devices, key=lambda d: counts.get(d, 0))
+        available = available_memory_bytes(device)
+        if available is None:
+            return True
+        return available - self._instance_bytes(device) >= self.min_free_memory_bytes
+
+    def decide(self) -> Optional[str]:
+        """
+        Decides the next scaling action.
+
+        Returns:
+            Optional[str]: "up", "down" or None.
+        """
+        pool = self.model_pool
+        if pool.state != "ready" or time_module.monotonic() - self._last_action < self.cooldown:
+            return None
+
+        num_instances = len(pool.model_instances)
+        waiting = pool.admission.waiting
+        if waiting == 0:
+            # The burst that caused the last scale-up is over
+            self._throughput_before_scale_up = None
+        if waiting >= self.scale_up_queue_depth and num_instances < self.max_instances:
+            if self._throughput_before_scale_up is not None:
+                if self.tokens_per_second < self._throughput_before_scale_up * (1 + self.min_throughput_gain):
+                    self.stats["blocked_by_throughput"] += 1
+                    return None
+            if not self._has_headroom():
+                self.stats["blocked_by_memory"] += 1
+                return None
+            return "up"
+
+        if waiting == 0 and num_instances > self.min_instances:
+            remaining_slots = (num_instances - 1) * pool.max_batch_size
+            if pool.num_active <= remaining_slots * self.scale_down_utilization:
+                return "down"
+        return None
+
+    async def scale(self, action: str):
+        """
+        Applies a scaling action.
+        """
+        self._last_action = time_module.monotonic()
+        if action == "up":
+            self._throughput_before_scale_up = self.tokens_per_second
+            model_instance = await self.model_pool.add_instance()
+            if model_instance is None:
+                return
+            self.stats["scale_ups"] += 1
+        else:
+            self._throughput_before_scale_up = None
+            await self.model_pool.retire_instance()
+            self.stats["scale_downs"] += 1
+        self.stats["last_action"] = action
+        self.stats["last_action_at"] = time_module.time()
+        logger.info(f"Autoscaler scaled {action} to {len(self.model_pool.model_instances)} instances")
+
+    async def run(self):
+        """
+        Samples load and resizes the pool until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                self._sample_throughput()
+                if (
+                    self._throughput_before_scale_up is not None
+                    and self.tokens_per_second >= self._throughput_before_scale_up * (1 + self.min_throughput_gain)
+                ):
+                    # The last scale-up paid off
+                    self._throughput_before_scale_up = None
+                action = self.decide()
+                if action:
+                    await self.scale(action)
+            except Exception as e:
+                logger.error(f"Autoscaler failed: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "instances": len(self.model_pool.model_instances),
+            "min_instances": self.min_instances,
+            "max_instances": self.max_instances,
+            "tokens_per_second": self.tokens_per_second,
+        }
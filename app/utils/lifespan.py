@@ -1,17 +1,32 @@
 # app/utils/lifespan.py
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
+from ..dependencies import autoscaler, memory_maintainer, model_pool, tool_runtime
+
 logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Starting application...")
+    # The pool loads in the background; /health/ready reports when it serves
+    startup_task = asyncio.create_task(model_pool.start())
+    maintenance_task = asyncio.create_task(memory_maintainer.run())
+    autoscaler_task = (
+        asyncio.create_task(autoscaler.run()) if autoscaler.max_instances > autoscaler.min_instances else None
+    )
     try:
         yield
     except Exception as e:
         logger.error(f"Error during application lifespan: {e}")
         raise e
     finally:
+        maintenance_task.cancel()
+        if autoscaler_task is not None:
+            autoscaler_task.cancel()
+        startup_task.cancel()
+        await model_pool.stop()
+        tool_runtime.shutdown()
         logger.info("Application stopped.")
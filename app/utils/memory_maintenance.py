@@ -0,0 +1,194 @@
+# app/utils/memory_maintenance.py
+import asyncio
+import gc
+import logging
+import os
+import resource
+import time as time_module
+from typing import Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def current_rss_bytes() -> int:
+    """
+    Resident set size of this process. Falls back to the peak RSS where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is reported in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def available_memory_bytes(device: str) -> Optional[int]:
+    """
+    Memory still available for new allocations on a device, or None if unknown.
+    """
+    if device.startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    # Reported in kilobytes
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class MemoryMaintainer:
+    """
+    Background task that runs `gc.collect()` and `torch.cuda.empty_cache()` off the request path.
+
+    Every `check_interval` seconds it looks at memory pressure (process RSS, CUDA
+    reserved memory) and at pool activity. Collection runs when a pressure threshold
+    is crossed, or once the pool has been idle for `idle_seconds` after serving new
+    requests. It never runs more often than `min_interval` seconds.
+
+    A full `gc.collect()` holds the GIL for its whole duration, on the event loop or
+    not, so it only runs while no request holds a batch slot. Pressure while
+    requests are running triggers a collection of the young generations instead,
+    which takes milliseconds; the full one follows once the pool is idle. The CUDA
+    cache is emptied in a worker thread, since that call releases the GIL while it
+    synchronizes the device. `max_stall_ms` records the time the collection held
+    the event loop.
+
+    The paged KV caches keep their blocks allocated for the life of an instance, so
+    reserved CUDA memory alone stays high on a busy device. It only counts as
+    pressure while enough of it is cached by the allocator and not held by live
+    tensors, which is the part `empty_cache` can hand back.
+    """
+    def __init__(
+        self,
+        model_pool,
+        check_interval: float = 5.0,
+        idle_seconds: float = 30.0,
+        min_interval: float = 10.0,
+        rss_limit_mb: Optional[float] = None,
+        cuda_reserved_ratio: float = 0.9,
+        cuda_releasable_ratio: float = 0.05,
+    ):
+        """
+        Initializes the maintainer.
+
+        Args:
+            model_pool: Pool exposing `num_active`, `last_activity` and `requests_completed`.
+            check_interval (float): Seconds between pressure checks.
+            idle_seconds (float): Idle time after which a collection is triggered.
+            min_interval (float): Minimum seconds between two collections.
+            rss_limit_mb (Optional[float]): Process RSS that counts as memory pressure. None disables the check.
+            cuda_reserved_ratio (float): Fraction of device memory reserved by PyTorch that counts as pressure.
+            cuda_releasable_ratio (float): Fraction of device memory that must be reserved but unallocated
+                                           for reserved memory to count as pressure.
+        """
+        self.model_pool = model_pool
+        self.check_interval = check_interval
+        self.idle_seconds = idle_seconds
+        self.min_interval = min_interval
+        self.rss_limit_bytes = rss_limit_mb * 1024 * 1024 if rss_limit_mb else None
+        self.cuda_reserved_ratio = cuda_reserved_ratio
+        self.cuda_releasable_ratio = cuda_releasable_ratio
+
+        self._last_run = 0.0
+        self._requests_at_last_run = 0
+        self.stats = {
+            "runs": 0,
+            "runs_by_reason": {"rss": 0, "cuda": 0, "idle": 0},
+            "young_runs": 0,
+            "objects_collected": 0,
+            "last_stall_ms": 0.0,
+            "max_stall_ms": 0.0,
+            "total_stall_ms": 0.0,
+            "last_run_at": None,
+        }
+
+    def _cuda_pressure(self) -> bool:
+        if not torch.cuda.is_available():
+            return False
+        for device in range(torch.cuda.device_count()):
+            total = torch.cuda.get_device_properties(device).total_memory
+            reserved = torch.cuda.memory_reserved(device)
+            # Memory held by tensors, e.g. the KV cache blocks, is not released by a collection
+            releasable = reserved - torch.cuda.memory_allocated(device)
+            if reserved >= self.cuda_reserved_ratio * total and releasable >= self.cuda_releasable_ratio * total:
+                return True
+        return False
+
+    def check(self) -> Optional[str]:
+        """
+        Decides whether a collection is due.
+
+        Returns:
+            Optional[str]: The trigger ("rss", "cuda" or "idle"), or None.
+        """
+        now = time_module.monotonic()
+        if now - self._last_run < self.min_interval:
+            return None
+        if self.rss_limit_bytes and current_rss_bytes() >= self.rss_limit_bytes:
+            return "rss"
+        if self._cuda_pressure():
+            return "cuda"
+        if (
+            self.model_pool.num_active == 0
+            and self.model_pool.requests_completed > self._requests_at_last_run
+            and now - self.model_pool.last_activity >= self.idle_seconds
+        ):
+            return "idle"
+        return None
+
+    async def collect(self, reason: str):
+        """
+        Runs the collection and records how long it stalled the event loop.
+        """
+        # Only the youngest two generations while requests are being served
+        generation = 2 if self.model_pool.num_active == 0 else 1
+        start = time_module.perf_counter()
+        collected = gc.collect(generation)
+        stall_ms = (time_module.perf_counter() - start) * 1000
+        if torch.cuda.is_available():
+            await asyncio.to_thread(torch.cuda.empty_cache)
+
+        self._last_run = time_module.monotonic()
+        if generation == 2:
+            # A young collection leaves the idle one due
+            self._requests_at_last_run = self.model_pool.requests_completed
+        self.stats["runs"] += 1
+        self.stats["runs_by_reason"][reason] += 1
+        self.stats["young_runs"] += generation < 2
+        self.stats["objects_collected"] += collected
+        self.stats["last_stall_ms"] = stall_ms
+        self.stats["max_stall_ms"] = max(self.stats["max_stall_ms"], stall_ms)
+        self.stats["total_stall_ms"] += stall_ms
+        self.stats["last_run_at"] = time_module.time()
+        logger.info(
+            f"Memory maintenance ({reason}, generation {generation}): "
+            f"collected {collected} objects in {stall_ms:.1f} ms"
+        )
+
+    async def run(self):
+        """
+        Checks memory pressure periodically until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                reason = self.check()
+                if reason:
+                    await self.collect(reason)
+            except Exception as e:
+                logger.error(f"Memory maintenance failed: {e}")
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "rss_bytes": current_rss_bytes(),
+            "cuda_reserved_bytes": sum(
+                torch.cuda.memory_reserved(device) for device in range(torch.cuda.device_count())
+            ) if torch.cuda.is_available() else 0,
+        }
@@ -512,20 +512,12 @@ Don't add any other details or information than a list of dictionaries.
 
 """)
 
+# The rules come before the slots, so every rephrase shares their cached KV prefix
 tool_prompt_template = Template("""
 
 You are a helpful assistant that reformulates user queries into complete queries based on context, without significantly changing the terms in the original query.
 
 Before you begin, check the conversation context (if present and relevant to current user query) and rephrase it into a single query. If it is not relevant, then keep the original query as-is.
-**Conversation Context:**
-$history
-
----
-
-**User's Current Query:**
-$user_query
-
----                                
 
 Your task is to:
 1. Analyze the conversation history (if provided).
@@ -560,7 +552,15 @@ Response: "I cannot rephrase this query as it lacks context. Please provide more
 Query: "What is the capital of France?"
 Response: "What is the capital of France?"
 
+---
+
+**Conversation Context:**
+$history
+
+---
 
+**User's Current Query:**
+$user_query
 """)
 
 agentic_prompt = """
@@ -590,6 +590,87 @@ Examples
 
 """
 
+citation_prompt = """
+Please answer the following question using **only** the provided context and function call responses. **Do not use any external information or your own knowledge.**
+
+When you reference information from the context or function call responses, you **must** cite the source from the provided metadata by including an inline citation in the format `[Document Name](URL)(Page X)` for documents, or `[Function Name](Reference)` for function calls.
+
+### Example of metadata in the retrieved documents:
+
+{"Subquery-1": {"Source": [{"name": "Resume.pdf", "page":1, "url": "user_data/Candidate/Resume.pdf", "text": "Document Content"}], "Type": "RAG"}}
+
+The format of the citation becomes `[Resume.pdf](user_data/Candidate/Resume.pdf)(page 1)`
+
+### Example of metadata in the function call responses:
+
+{'Subquery-1': {'Source': [{'FunctionName': [{'name': 'google_search', 'arguments': {'query': '2024 US election', 'num_results': '10'}}], 'Output': 'output of the function call'}], 'Type': 'Action'}}
+
+The format of the citation becomes `[google_search](query: '2024 US election', num_results: '10')`
+
+Ensure that the citations are properly formatted as clickable links in Markdown.
+
+If the context and function call responses do not contain enough information to answer the question, politely inform the user of this limitation.
+
+**Instructions:**
+
+- Provide a clear and concise answer to the question.
+- Do not include any information that is not in the provided context or function call responses.
+- If the answer cannot be found in the context or function call responses, state that the information is not available.
+- **Every time** you use information from the context or function call responses, include an inline citation immediately after the information.
+- Always prioritize the most recent information if there are conflicting information from the context or function call responses.
+
+**Example:**
+
+"According to [Resume.pdf](user_data/Candidate/Resume.pdf)(page 1), ..."
+
+"As provided by [Function Name], ..."
+
+**Citation Format requirement:**
+- Citation Format: `[Document Name](URL)(page X)`
+- Place citation IMMEDIATELY after used information
+- Use metadata from the context to get the right page number
+    
+**Validation:**
+- Don't cite Document Name that does not have a page number.
+- Double check if you have cited the correct document.
+"""
+
+# User turn of a request with context; the context itself goes in a system message.
+# Not indented, so the query starts a line and its tokens do not merge with the template's
+question_prompt_template = Template("""
+**Question:**
+
+$query
+
+---
+
+**Answer:**
+""")
+
+# Turns a "Function Calling" subquery into calls; $functions is bound to the functions that are available
+function_call_prompt_template = Template("""
+You are an expert in calling functions. Choose the function calls that answer the question below, using only the functions in this list:
+$functions
+
+**Question:**
+$question
+
+**Output Format:**
+Respond only with a JSON list of calls, each with the function name and its arguments:
+[
+    {"name": "function_name", "arguments": {"argument_name": "value"}}
+]
+Use only the arguments declared by the function and include all of its required arguments.
+Respond with [] if no function answers the question.
+""")
+
+# Templates compiled by the model pool's PromptTemplateRegistry: name -> (template, constant slot values)
+PROMPT_TEMPLATES = {
+    "question": (question_prompt_template, {}),
+    "query_decomposition": (user_prompt_template, {"functions": function_definitions_json}),
+    "query_rephrase": (tool_prompt_template, {}),
+}
+
 tool_prompt = (
     "You are an expert assistant equipped with advanced tool-calling capabilities. "
     "When you receive a response from a tool invocation, you must perform the following steps:\n"
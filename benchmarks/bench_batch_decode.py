@@ -0,0 +1,120 @@
+# benchmarks/bench_batch_decode.py
+"""
+Compares decode throughput of the continuous batch scheduler with one request
+per model instance, at several context lengths.
+
+The same concurrent requests (random prompt tokens, fixed number of new tokens,
+greedy, no EOS) are served two ways by one copy of the weights:
+
+- single:   one request at a time with `model.generate`, as before batching
+- batched:  all requests in one `ContinuousBatchScheduler`, which gathers the
+            paged KV cache into a padded tensor on every decode step
+
+Reported per context length: generated tokens/s of both, the speedup, and the
+share of the batched decode time spent in `PagedKVCache.gather`, which is the
+per-step copy that grows with the context length.
+
+Usage:
+    python -m benchmarks.bench_batch_decode --model meta-llama/Llama-3.2-1B-Instruct --contexts 128,512,2048
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from app.models.batch_scheduler import ContinuousBatchScheduler
+from app.models.kv_cache import PagedKVCache
+
+
+class NullStreamer:
+    def put(self, value):
+        pass
+
+    def end(self):
+        pass
+
+
+class TimedGather:
+    """Wraps `PagedKVCache.gather` and adds up the time spent in it."""
+    def __init__(self, kv_cache: PagedKVCache):
+        self.gather = kv_cache.gather
+        self.seconds = 0.0
+        kv_cache.gather = self
+
+    def __call__(self, seq_ids):
+        start = time.perf_counter()
+        result = self.gather(seq_ids)
+        if result[0] and result[0][0][0].is_cuda:
+            torch.cuda.synchronize()
+        self.seconds += time.perf_counter() - start
+        return result
+
+
+def run_single(model, prompts, new_tokens: int) -> float:
+    start = time.perf_counter()
+    for prompt in prompts:
+        model.generate(
+            torch.tensor([prompt], device=model.device),
+            attention_mask=torch.ones(1, len(prompt), dtype=torch.long, device=model.device),
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        )
+    return len(prompts) * new_tokens / (time.perf_counter() - start)
+
+
+def run_batched(model, prompts, new_tokens: int, block_size: int):
+    max_blocks = len(prompts) * -(-(len(prompts[0]) + new_tokens + 1) // block_size)
+    kv_cache = PagedKVCache.for_model(model, block_size=block_size, max_blocks=max_blocks)
+    gather = TimedGather(kv_cache)
+    scheduler = ContinuousBatchScheduler(model, max_batch_size=len(prompts), eos_token_ids=[], kv_cache=kv_cache)
+    try:
+        start = time.perf_counter()
+        sequences = [
+            scheduler.submit(prompt, NullStreamer(), max_new_tokens=new_tokens, temperature=0.0) for prompt in prompts
+        ]
+        for sequence in sequences:
+            sequence.done.wait()
+        elapsed = time.perf_counter() - start
+    finally:
+        scheduler.stop()
+    errors = [sequence.error for sequence in sequences if sequence.error is not None]
+    if errors:
+        raise errors[0]
+    return len(prompts) * new_tokens / elapsed, gather.seconds / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH", "meta-llama/Llama-3.2-1B-Instruct"))
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--contexts", default="128,512,2048", help="Comma-separated prompt lengths in tokens")
+    parser.add_argument("--requests", type=int, default=8, help="Concurrent requests")
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--block-size", type=int, default=16)
+    args = parser.parse_args()
+
+    dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=dtype).to(args.device).eval()
+    generator = torch.Generator().manual_seed(0)
+
+    print(f"{'context':>8} {'single tok/s':>13} {'batched tok/s':>14} {'speedup':>8} {'gather share':>13}")
+    for context in (int(context) for context in args.contexts.split(",")):
+        prompts = [
+            torch.randint(100, model.config.vocab_size, (context,), generator=generator).tolist()
+            for _ in range(args.requests)
+        ]
+        with torch.inference_mode():
+            single = run_single(model, prompts, args.new_tokens)
+        batched, gather_share = run_batched(model, prompts, args.new_tokens, args.block_size)
+        print(f"{context:>8} {single:>13.1f} {batched:>14.1f} {batched / single:>7.2f}x {gather_share:>12.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# benchmarks/bench_prompt_tokenizer.py
+"""
+Compares prompt tokenization with PromptTokenizer against the plain chat template.
+
+Each conversation is the system prompt followed by alternating user/assistant
+turns, tokenized with the generation prompt appended:
+
+- template:     `tokenizer.apply_chat_template(messages, tokenize=True)`
+- prefix walk:  the previous segmentation, one template render per message prefix
+                (segments only, before any tokenization)
+- cold:         `PromptTokenizer.encode` with empty caches
+- follow-up:    `PromptTokenizer.encode` of the conversation after the same
+                tokenizer encoded it without its last two messages, as on a new turn
+
+Reported per conversation length: mean milliseconds per prompt of each mode.
+
+Usage:
+    python -m benchmarks.bench_prompt_tokenizer --tokenizer meta-llama/Llama-3.2-1B-Instruct --turns 1,4,16,64
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import AutoTokenizer
+
+from app.models.prompt_tokenizer import PromptTokenizer
+from app.utils.system_prompt import agentic_prompt
+
+
+def conversation(turns: int):
+    messages = [{"role": "system", "content": agentic_prompt}]
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"Question {turn}: what does section {turn} of the report say?"})
+        messages.append({
+            "role": "assistant",
+            "content": f"Section {turn} describes the quarterly figures and how they compare to last year. " * 4
+        })
+    messages.append({"role": "user", "content": "Summarize everything above."})
+    return messages
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokenizer", default=os.getenv("MODEL_PATH", "meta-llama/Llama-3.2-1B-Instruct"))
+    parser.add_argument("--turns", default="1,4,16,64", help="Comma-separated user/assistant turns per conversation")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    print(f"{'messages':>8} {'template':>10} {'prefix walk':>12} {'cold':>10} {'follow-up':>10}  (ms per prompt)")
+    for turns in (int(turns) for turns in args.turns.split(",")):
+        messages = conversation(turns)
+        reference = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True)
+        if PromptTokenizer(tokenizer).encode(messages) != reference:
+            print(f"{len(messages):>8} token ids differ from the chat template, skipped")
+            continue
+
+        template_ms = timed(
+            lambda: tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True), args.repeat
+        )
+        walker = PromptTokenizer(tokenizer)
+        prefix_walk_ms = timed(
+            lambda: walker._prefix_segments(messages, walker._render(messages, add_generation_prompt=True)),
+            args.repeat
+        )
+        cold_ms = timed(lambda: PromptTokenizer(tokenizer).encode(messages), args.repeat)
+
+        def follow_up():
+            prompt_tokenizer = PromptTokenizer(tokenizer)
+            prompt_tokenizer.encode(messages[:-2])
+            start = time.perf_counter()
+            prompt_tokenizer.encode(messages)
+            return time.perf_counter() - start
+        follow_up_ms = sum(follow_up() for _ in range(args.repeat)) / args.repeat * 1000
+
+        print(f"{len(messages):>8} {template_ms:>10.2f} {prefix_walk_ms:>12.2f} {cold_ms:>10.2f} {follow_up_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
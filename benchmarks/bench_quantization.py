@@ -0,0 +1,137 @@
+# benchmarks/bench_quantization.py
+"""
+Compares quantization modes of ParallelModelPool on the CPU.
+
+Each mode builds a one-instance pool in a new process and decodes a fixed prompt
+set greedily, all prompts in one continuous batch:
+
+- fp32:          unquantized fp32 weights (the baseline)
+- int8-dynamic:  int8 linear layers with dynamically quantized activations
+- int8-weight:   int8 weights dequantized per forward pass
+
+Reported per mode: decode throughput in tokens/s, weight memory, process RSS,
+and agreement with the fp32 baseline: the fraction of prompts whose output is
+identical, and the mean fraction of baseline tokens reproduced before the first
+differing token.
+
+Usage:
+    python -m benchmarks.bench_quantization --model meta-llama/Llama-3.2-1B-Instruct --max-new-tokens 64
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROMPTS = [
+    "What is the capital of France?",
+    "Explain what a hash table is in two sentences.",
+    "Write a haiku about autumn leaves.",
+    "List three benefits of regular exercise.",
+    "Translate 'good morning' into Spanish and German.",
+    "What causes the seasons on Earth?",
+    "Summarize the plot of Romeo and Juliet.",
+    "How do I reverse a list in Python?",
+]
+
+
+def run_mode(mode, args, results):
+    import asyncio
+
+    import torch
+
+    from app.models.async_streamer import AsyncTextStreamer
+    from app.models.model_pool import ParallelModelPool
+    from app.models.quantization import weight_bytes
+    from app.utils.memory_maintenance import current_rss_bytes
+
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+
+    async def generate(pool, prompt):
+        model_instance = await pool.get_free_model()
+        try:
+            prompt_ids = pool.prompt_tokenizer.encode([{"role": "user", "content": prompt}])
+            streamer = AsyncTextStreamer(pool.tokenizer, skip_prompt=False, skip_special_tokens=True)
+            sequence = model_instance['scheduler'].submit(
+                prompt_ids=prompt_ids,
+                streamer=streamer,
+                max_new_tokens=args.max_new_tokens,
+                temperature=0
+            )
+            async for _ in streamer:
+                pass
+            return sequence.output_ids
+        finally:
+            await pool.release_model(model_instance)
+
+    async def build_and_generate():
+        pool = ParallelModelPool(
+            args.model,
+            num_instances=1,
+            dtype=torch.float32,
+            devices=["cpu"],
+            max_batch_size=len(PROMPTS),
+            prefix_cache_max_blocks=0,
+            warmup_tokens=4,
+            quantization=None if mode == "fp32" else mode,
+        )
+        await pool.start()
+        start = time.perf_counter()
+        outputs = await asyncio.gather(*(generate(pool, prompt) for prompt in PROMPTS))
+        elapsed = time.perf_counter() - start
+        results.put({
+            "mode": mode,
+            "tokens_per_second": sum(len(output) for output in outputs) / elapsed,
+            "weight_mib": weight_bytes(pool.model_instances[0]['model']) / 2**20,
+            "rss_mib": current_rss_bytes() / 2**20,
+            "outputs": outputs,
+        })
+        await pool.stop()
+
+    asyncio.run(build_and_generate())
+
+
+def agreement(baseline, outputs):
+    """Exact-match rate and mean matching-prefix fraction against the baseline outputs."""
+    exact, prefix = 0, 0.0
+    for expected, actual in zip(baseline, outputs):
+        exact += expected == actual
+        matched = 0
+        for a, b in zip(expected, actual):
+            if a != b:
+                break
+            matched += 1
+        prefix += matched / len(expected) if expected else 1.0
+    return exact / len(baseline), prefix / len(baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH", "meta-llama/Llama-3.2-1B-Instruct"))
+    parser.add_argument("--modes", default="fp32,int8-dynamic,int8-weight")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads, defaults to torch's choice")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    baseline = None
+    for mode in args.modes.split(","):
+        results = context.Queue()
+        process = context.Process(target=run_mode, args=(mode, args, results))
+        process.start()
+        result = results.get()
+        process.join()
+
+        outputs = result.pop("outputs")
+        if baseline is None:
+            # The first mode is the reference, fp32 unless --modes says otherwise
+            baseline = outputs
+        result["exact_match"], result["prefix_agreement"] = agreement(baseline, outputs)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
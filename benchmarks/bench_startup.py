@@ -0,0 +1,91 @@
+# benchmarks/bench_startup.py
+"""
+Measures cold-start time of ParallelModelPool.
+
+Each mode builds a fresh pool in a new process, so file caches aside nothing is
+shared between runs:
+
+- sequential:      one loader thread (the previous one-instance-after-another loading)
+- parallel:        one loader thread per device
+- snapshot-write:  parallel, then writes a warm snapshot of the loaded weights
+- snapshot:        parallel, loading from that warm snapshot
+
+Reported per mode: time to the first servable instance, time to the full pool,
+time to the first generated token after the pool is built, and process RSS.
+
+Usage:
+    python -m benchmarks.bench_startup --model meta-llama/Llama-3.2-1B-Instruct --devices cuda:0,cuda:1 --instances 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_mode(mode, args, snapshot_dir, results):
+    import asyncio
+
+    import torch
+
+    from app.models.model_pool import ParallelModelPool
+    from app.utils.memory_maintenance import current_rss_bytes
+
+    async def build_and_generate():
+        start = time.perf_counter()
+        pool = ParallelModelPool(
+            args.model,
+            num_instances=args.instances,
+            dtype=getattr(torch, args.dtype),
+            devices=args.devices.split(",") if args.devices else None,
+            max_batch_size=args.max_batch_size,
+            load_workers=1 if mode == "sequential" else None,
+            snapshot_dir=snapshot_dir if mode.startswith("snapshot") else None,
+            warmup_tokens=0,
+        )
+        await pool.start()
+        built = time.perf_counter() - start
+        first_token = None
+        async for _ in pool.generate_text_stream("Hello", None, max_new_tokens=1, temperature=0):
+            if first_token is None:
+                first_token = time.perf_counter() - start - built
+        results.put({
+            "mode": mode,
+            "first_ready_seconds": pool.first_ready_seconds,
+            "full_pool_seconds": pool.startup_seconds,
+            "constructor_seconds": built,
+            "first_token_seconds": first_token,
+            "rss_mib": current_rss_bytes() / 2**20,
+        })
+
+    asyncio.run(build_and_generate())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH", "meta-llama/Llama-3.2-1B-Instruct"))
+    parser.add_argument("--devices", default=None, help="Comma-separated devices, defaults to all CUDA devices")
+    parser.add_argument("--instances", type=int, default=2)
+    parser.add_argument("--dtype", default="float16")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--snapshot-dir", default=None, help="Defaults to a temporary directory")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_dir = args.snapshot_dir or tmp_dir
+        for mode in ("sequential", "parallel", "snapshot-write", "snapshot"):
+            results = context.Queue()
+            process = context.Process(target=run_mode, args=(mode, args, snapshot_dir, results))
+            process.start()
+            result = results.get()
+            process.join()
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# benchmarks/bench_token_stream.py
+"""
+Compares the old executor-polling token stream with AsyncTextStreamer.
+
+A single producer thread plays the batch scheduler: every decode step it pushes
+one token id into each concurrent stream. The consumer side runs on the event
+loop exactly like `ParallelModelPool.generate_text_stream`:
+
+- executor:  TextIteratorStreamer + one `loop.run_in_executor(None, next)` per chunk
+- async:     AsyncTextStreamer flushing every token + `async for`
+- batched:   AsyncTextStreamer with the default token/interval flush batching
+
+Reported per mode: executor calls per token, p50/p99 gap between chunks seen by
+the consumer, p50/p99 token delivery delay (producer `put` to consumer receipt)
+and p99 event-loop lag.
+
+Usage:
+    python -m benchmarks.bench_token_stream --tokenizer meta-llama/Llama-3.2-1B-Instruct --streams 64
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from transformers import AutoTokenizer, TextIteratorStreamer
+
+from app.models.async_streamer import AsyncTextStreamer
+
+SAMPLE_TEXT = (
+    "According to the provided context, the quarterly report shows that revenue grew "
+    "by twelve percent while operating costs stayed flat. The growth came mostly from "
+    "the enterprise segment, which added several large customers during the period. "
+)
+
+
+class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Default executor that counts submitted calls."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def submit(self, *args, **kwargs):
+        self.calls += 1
+        return super().submit(*args, **kwargs)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def produce(streamers, token_ids, interval, put_times):
+    for token_id in token_ids:
+        time.sleep(interval)
+        token = torch.tensor([token_id])
+        for streamer, times in zip(streamers, put_times):
+            times.append(time.perf_counter())
+            streamer.put(token)
+    for streamer in streamers:
+        streamer.end()
+
+
+def record_delivery(put_times, delivered, delays, now):
+    """Marks every token put before `now` as delivered. Returns the new delivered count."""
+    while delivered < len(put_times) and put_times[delivered] <= now:
+        delays.append(now - put_times[delivered])
+        delivered += 1
+    return delivered
+
+
+async def consume_executor(streamer, gaps, put_times, delays):
+    loop = asyncio.get_running_loop()
+
+    def get_next_chunk():
+        try:
+            return next(streamer)
+        except StopIteration:
+            return None
+
+    last = time.perf_counter()
+    delivered = 0
+    while True:
+        text = await loop.run_in_executor(None, get_next_chunk)
+        if text is None:
+            break
+        if not text:
+            # TextIteratorStreamer emits empty chunks while a word is incomplete
+            continue
+        now = time.perf_counter()
+        gaps.append(now - last)
+        delivered = record_delivery(put_times, delivered, delays, now)
+        last = now
+
+
+async def consume_async(streamer, gaps, put_times, delays):
+    last = time.perf_counter()
+    delivered = 0
+    async for _ in streamer:
+        now = time.perf_counter()
+        gaps.append(now - last)
+        delivered = record_delivery(put_times, delivered, delays, now)
+        last = now
+
+
+async def measure_loop_lag(stop, lags, period=0.005):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(period)
+        lags.append(time.perf_counter() - start - period)
+
+
+async def run_mode(mode, tokenizer, token_ids, streams, interval):
+    loop = asyncio.get_running_loop()
+    executor = CountingExecutor()
+    loop.set_default_executor(executor)
+
+    gaps, lags, delays = [], [], []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lags))
+
+    consumers, streamers, put_times = [], [], []
+    for _ in range(streams):
+        times = []
+        if mode == "executor":
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=False, skip_special_tokens=True)
+            consumers.append(consume_executor(streamer, gaps, times, delays))
+        else:
+            flush_tokens = 1 if mode == "async" else 4
+            streamer = AsyncTextStreamer(
+                tokenizer, loop=loop, skip_prompt=False, flush_tokens=flush_tokens, skip_special_tokens=True
+            )
+            consumers.append(consume_async(streamer, gaps, times, delays))
+        streamers.append(streamer)
+        put_times.append(times)
+    producer = threading.Thread(target=produce, args=(streamers, token_ids, interval, put_times))
+
+    start = time.perf_counter()
+    producer.start()
+    await asyncio.gather(*consumers)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await lag_task
+    producer.join()
+    executor.shutdown(wait=False)
+
+    tokens = streams * len(token_ids)
+    return {
+        "mode": mode,
+        "tokens": tokens,
+        "chunks": len(gaps),
+        "executor_calls_per_token": executor.calls / tokens,
+        "chunk_gap_p50_ms": percentile(gaps, 50) * 1000,
+        "chunk_gap_p99_ms": percentile(gaps, 99) * 1000,
+        "token_delay_p50_ms": percentile(delays, 50) * 1000,
+        "token_delay_p99_ms": percentile(delays, 99) * 1000,
+        "loop_lag_p99_ms": percentile(lags, 99) * 1000,
+        "throughput_tokens_per_s": tokens / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokenizer", default=os.getenv("MODEL_PATH", "meta-llama/Llama-3.2-1B-Instruct"))
+    parser.add_argument("--streams", type=int, default=64, help="Concurrent streams")
+    parser.add_argument("--tokens", type=int, default=200, help="Tokens per stream")
+    parser.add_argument("--token-interval-ms", type=float, default=20.0, help="Delay between decode steps")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    base_ids = tokenizer.encode(SAMPLE_TEXT, add_special_tokens=False)
+    token_ids = (base_ids * (args.tokens // len(base_ids) + 1))[:args.tokens]
+
+    for mode in ("executor", "async", "batched"):
+        result = asyncio.run(run_mode(mode, tokenizer, token_ids, args.streams, args.token_interval_ms / 1000))
+        print(
+            f"{result['mode']:>8}: {result['executor_calls_per_token']:.3f} executor calls/token, "
+            f"{result['chunks']} chunks, chunk gap p50 {result['chunk_gap_p50_ms']:.1f} ms "
+            f"p99 {result['chunk_gap_p99_ms']:.1f} ms, token delay p50 {result['token_delay_p50_ms']:.1f} ms "
+            f"p99 {result['token_delay_p99_ms']:.1f} ms, loop lag p99 {result['loop_lag_p99_ms']:.1f} ms, "
+            f"{result['throughput_tokens_per_s']:.0f} tokens/s"
+        )
+
+
+if __name__ == "__main__":
+    main()